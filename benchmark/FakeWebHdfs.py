@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+进程内的WebHDFS模拟服务, 供基准测试使用:
+NameNode请求重定向到同一端口下的/datanode路径, 支持区间读取、延迟与带宽限制、IncompleteRead故障注入,
+文件内容保存在内存中
+"""
+
+import sys
+import json
+import time
+import zlib
+import struct
+import bisect
+import socket
+import urllib
+import hashlib
+import urlparse
+import posixpath
+import threading
+import SocketServer
+import BaseHTTPServer
+
+DEFAULT_BLOCK_SIZE = 128*1024*1024
+SEND_SIZE = 64*1024
+RETRY_STATUS = {'standby': 'StandbyException', 'retriable': 'RetriableException'}
+
+
+class FakeFS:
+    """内存文件系统, 目录记录子节点名, list与du不需要扫描全部路径"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.files = {}
+        self.meta = {}
+        self.dirs = {'/': set()}
+
+    def mkdirs(self, path):
+        with self.lock:
+            cur = '/'
+            for part in path.strip('/').split('/'):
+                if not part:
+                    continue
+                child = posixpath.join(cur, part)
+                if child in self.files:
+                    return False
+                if child not in self.dirs:
+                    self.dirs[child] = set()
+                    self.dirs[cur].add(part)
+                cur = child
+            return True
+
+    def write(self, path, data, append=False, block_size=None):
+        with self.lock:
+            if path not in self.files:
+                if not self.mkdirs(posixpath.dirname(path)) or path in self.dirs:
+                    return False
+                self.dirs[posixpath.dirname(path)].add(posixpath.basename(path))
+                self.files[path] = bytearray()
+                self.meta[path] = [0, block_size or DEFAULT_BLOCK_SIZE]
+            if append:
+                self.files[path] += data
+            else:
+                self.files[path] = bytearray(data)
+                if block_size:
+                    self.meta[path][1] = block_size
+            self.meta[path][0] = int(time.time() * 1000)
+            return True
+
+    def read(self, path, offset=0, length=None):
+        with self.lock:
+            data = self.files[path]
+            end = len(data) if length is None else min(len(data), offset + length)
+            return str(data[offset:end])
+
+    def status(self, path, name=''):
+        with self.lock:
+            now = int(time.time() * 1000)
+            if path in self.dirs:
+                return {'accessTime': 0, 'blockSize': 0, 'childrenNum': len(self.dirs[path]), 'fileId': 1,
+                        'group': 'supergroup', 'length': 0, 'modificationTime': now, 'owner': 'pyback',
+                        'pathSuffix': name, 'permission': '755', 'replication': 0, 'storagePolicy': 0,
+                        'type': 'DIRECTORY'}
+            if path in self.files:
+                mtime, block_size = self.meta[path]
+                return {'accessTime': now, 'blockSize': block_size, 'childrenNum': 0, 'fileId': 2,
+                        'group': 'supergroup', 'length': len(self.files[path]), 'modificationTime': mtime,
+                        'owner': 'pyback', 'pathSuffix': name, 'permission': '644', 'replication': 3,
+                        'storagePolicy': 0, 'type': 'FILE'}
+            return None
+
+    def list(self, path, start_after=None, limit=None):
+        """按名字排序返回子节点状态, 只构造start_after之后的limit个"""
+        with self.lock:
+            names = sorted(self.dirs[path])
+            start = bisect.bisect_right(names, start_after) if start_after else 0
+            end = len(names) if limit is None else min(len(names), start + limit)
+            return [self.status(posixpath.join(path, name), name) for name in names[start:end]], len(names) - end
+
+    def walk(self, path):
+        """返回path及其下所有路径"""
+        with self.lock:
+            paths = [path]
+            pending = [path] if path in self.dirs else []
+            while pending:
+                cur = pending.pop()
+                for name in self.dirs[cur]:
+                    child = posixpath.join(cur, name)
+                    paths.append(child)
+                    if child in self.dirs:
+                        pending.append(child)
+            return paths
+
+    def rename(self, path, dest):
+        with self.lock:
+            if self.status(path) is None or self.status(dest) is not None or \
+                    posixpath.dirname(dest) not in self.dirs or (dest + '/').startswith(path + '/'):
+                return False
+            for old in self.walk(path):
+                new = dest + old[len(path):]
+                if old in self.files:
+                    self.files[new] = self.files.pop(old)
+                    self.meta[new] = self.meta.pop(old)
+                else:
+                    self.dirs[new] = self.dirs.pop(old)
+            self.dirs[posixpath.dirname(path)].discard(posixpath.basename(path))
+            self.dirs[posixpath.dirname(dest)].add(posixpath.basename(dest))
+            return True
+
+    def delete(self, path):
+        with self.lock:
+            if path == '/' or self.status(path) is None:
+                return False
+            for old in self.walk(path):
+                self.files.pop(old, None)
+                self.meta.pop(old, None)
+                self.dirs.pop(old, None)
+            self.dirs[posixpath.dirname(path)].discard(posixpath.basename(path))
+            return True
+
+    def summary(self, path):
+        with self.lock:
+            paths = self.walk(path)
+            files = [p for p in paths if p in self.files]
+            length = sum(len(self.files[p]) for p in files)
+            return {'directoryCount': len(paths) - len(files), 'fileCount': len(files), 'length': length,
+                    'quota': -1, 'spaceConsumed': length * 3, 'spaceQuota': -1}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # 响应头与响应体分开写出, 不关闭Nagle时每个请求会多等待一次延迟ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_exception(self, code, exception, message):
+        self.send_json(code, {'RemoteException': {'exception': exception,
+                                                  'javaClassName': 'org.apache.hadoop.' + exception,
+                                                  'message': message}})
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = []
+            while True:
+                size = int(self.rfile.readline().strip().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                data.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(data)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        path = urllib.unquote(url.path)
+        op = params.get('op', '').upper()
+        if server.latency:
+            time.sleep(server.latency)
+        if path.startswith('/datanode/'):
+            server.count('datanode.' + op)
+            return self.datanode(op, path[len('/datanode'):], params)
+
+        server.count('namenode.' + op)
+        body = self.read_body() if method in ('PUT', 'POST') else ''
+        if not path.startswith('/webhdfs/v1/'):
+            return self.send_exception(404, 'FileNotFoundException', 'Invalid path: %s' % path)
+        path = posixpath.normpath(path[len('/webhdfs/v1'):])
+        error = server.take_namenode_error()
+        if error:
+            return self.send_exception(403, RETRY_STATUS[error], 'Operation category is not supported')
+        if op in server.unsupported:
+            return self.send_exception(400, 'UnsupportedOperationException', 'Operation %s is not supported' % op)
+        handler = getattr(self, 'op_' + op.lower(), None)
+        if handler is None:
+            return self.send_exception(400, 'IllegalArgumentException', 'Invalid value for webhdfs parameter op')
+        return handler(path, params, body)
+
+    def not_found(self, path):
+        return self.send_exception(404, 'FileNotFoundException', 'File does not exist: %s' % path)
+
+    def op_getfilestatus(self, path, params, body):
+        status = self.server.fs.status(path)
+        if status is None:
+            return self.not_found(path)
+        return self.send_json(200, {'FileStatus': status})
+
+    def op_liststatus(self, path, params, body):
+        status = self.server.fs.status(path)
+        if status is None:
+            return self.not_found(path)
+        entries = [status] if status['type'] == 'FILE' else self.server.fs.list(path)[0]
+        return self.send_json(200, {'FileStatuses': {'FileStatus': entries}})
+
+    def op_liststatus_batch(self, path, params, body):
+        status = self.server.fs.status(path)
+        if status is None:
+            return self.not_found(path)
+        if status['type'] == 'FILE':
+            batch, remaining = [status], 0
+        else:
+            batch, remaining = self.server.fs.list(path, params.get('startAfter'), self.server.batch_size)
+        return self.send_json(200, {'DirectoryListing': {
+            'partialListing': {'FileStatuses': {'FileStatus': batch}},
+            'remainingEntries': remaining}})
+
+    def op_getcontentsummary(self, path, params, body):
+        if self.server.fs.status(path) is None:
+            return self.not_found(path)
+        return self.send_json(200, {'ContentSummary': self.server.fs.summary(path)})
+
+    def op_mkdirs(self, path, params, body):
+        return self.send_json(200, {'boolean': self.server.fs.mkdirs(path)})
+
+    def op_rename(self, path, params, body):
+        return self.send_json(200, {'boolean': self.server.fs.rename(path, params['destination'])})
+
+    def op_delete(self, path, params, body):
+        return self.send_json(200, {'boolean': self.server.fs.delete(path)})
+
+    def op_concat(self, path, params, body):
+        fs = self.server.fs
+        with fs.lock:
+            sources = params['sources'].split(',')
+            for source in [path] + sources:
+                if source not in fs.files:
+                    return self.not_found(source)
+            for source in sources:
+                fs.write(path, fs.files[source], append=True)
+                fs.delete(source)
+        return self.send_empty(200)
+
+    def op_create(self, path, params, body):
+        if self.server.fs.status(path) is not None and params.get('overwrite', 'false') != 'true':
+            return self.send_exception(403, 'FileAlreadyExistsException', '%s already exists' % path)
+        return self.redirect(path, params)
+
+    def op_append(self, path, params, body):
+        if path not in self.server.fs.files:
+            return self.not_found(path)
+        return self.redirect(path, params)
+
+    op_open = op_getfilechecksum = op_append
+
+    def redirect(self, path, params):
+        host, port = self.server.server_address[:2]
+        location = 'http://%s:%s/datanode%s?%s' % (host, port, urllib.quote(path), urllib.urlencode(params))
+        self.send_response(307)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def datanode(self, op, path, params):
+        server = self.server
+        fs = server.fs
+        if op in ('CREATE', 'APPEND'):
+            body = self.read_body()
+            server.throttle(len(body))
+            server.count('bytes_in', len(body))
+            block_size = int(params['blocksize']) if 'blocksize' in params else None
+            if not fs.write(path, body, append=op == 'APPEND', block_size=block_size):
+                return self.send_exception(403, 'ParentNotDirectoryException', 'Parent path is not a directory')
+            return self.send_empty(201 if op == 'CREATE' else 200)
+        if op == 'GETFILECHECKSUM':
+            algorithm, checksum = md5md5crc(fs.read(path), fs.meta[path][1], 512, server.checksum_type)
+            return self.send_json(200, {'FileChecksum': {'algorithm': algorithm, 'bytes': checksum, 'length': 28}})
+        if op == 'OPEN':
+            length = params.get('length')
+            data = fs.read(path, int(params.get('offset', 0)), None if length is None else int(length))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            # 注入故障时只发送部分数据后断开连接, 客户端读到IncompleteRead
+            fault = server.take_fault(path)
+            limit = len(data) if fault is None else int(len(data) * fault)
+            try:
+                for pos in xrange(0, limit, SEND_SIZE):
+                    piece = buffer(data, pos, min(SEND_SIZE, limit - pos))
+                    server.throttle(len(piece))
+                    self.wfile.write(piece)
+                    server.count('bytes_out', len(piece))
+                if fault is not None:
+                    self.wfile.flush()
+                    self.close_connection = 1
+                    self.connection.shutdown(2)
+            except Exception:
+                self.close_connection = 1
+            return
+        return self.send_exception(400, 'IllegalArgumentException', 'Invalid datanode op %s' % op)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def md5md5crc(data, block_size=DEFAULT_BLOCK_SIZE, bytes_per_crc=512, crc_type='CRC32'):
+    """按hdfs的MD5MD5CRC32FileChecksum规则独立计算校验和"""
+    if crc_type == 'CRC32C':
+        import crc32c
+        crc = getattr(crc32c, 'crc32c', None) or crc32c.crc32
+    else:
+        crc = zlib.crc32
+    if not data:
+        return 'MD5-of-0MD5-of-0CRC32', (struct.pack('>iq', 0, 0) + hashlib.md5('').digest()).encode('hex')
+    block_md5s = []
+    for start in xrange(0, len(data), block_size):
+        block = data[start:start + block_size]
+        crcs = ''.join(struct.pack('>I', crc(block[i:i + bytes_per_crc]) & 0xffffffff)
+                       for i in xrange(0, len(block), bytes_per_crc))
+        block_md5s.append(hashlib.md5(crcs).digest())
+    crc_per_block = block_size // bytes_per_crc if len(block_md5s) > 1 else 0
+    algorithm = 'MD5-of-%sMD5-of-%s%s' % (crc_per_block, bytes_per_crc, crc_type)
+    checksum = struct.pack('>iq', bytes_per_crc, crc_per_block) + hashlib.md5(''.join(block_md5s)).digest()
+    return algorithm, checksum.encode('hex')
+
+
+class FakeWebHdfs(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    latency为每个请求的延迟(秒), bandwidth为每个连接的带宽(字节/秒), 0为不限制;
+    unsupported中的操作返回UnsupportedOperationException, 用于测试降级路径
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, bandwidth=0, batch_size=1000, unsupported=()):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.fs = FakeFS()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.batch_size = batch_size
+        self.unsupported = set(unsupported)
+        self.checksum_type = 'CRC32'
+        self.faults = {}
+        self.namenode_errors = []
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+    def count(self, key, value=1):
+        with self.counts_lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def reset_counts(self):
+        with self.counts_lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def inject_incomplete_read(self, path, times=1, fraction=0.5):
+        """path接下来的times次OPEN只返回fraction比例的数据后断开, 多次注入按顺序生效"""
+        with self.counts_lock:
+            self.faults.setdefault(path, []).extend([fraction] * times)
+
+    def take_fault(self, path):
+        """返回这次OPEN返回数据的比例, 没有故障时返回None"""
+        with self.counts_lock:
+            faults = self.faults.get(path)
+            return faults.pop(0) if faults else None
+
+    def inject_namenode_error(self, kind='standby', times=1):
+        """接下来的times个NameNode请求返回StandbyException或RetriableException"""
+        with self.counts_lock:
+            self.namenode_errors += [kind] * times
+
+    def take_namenode_error(self):
+        with self.counts_lock:
+            return self.namenode_errors.pop(0) if self.namenode_errors else None
+
+    def throttle(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+    @property
+    def hosts(self):
+        return '%s:%s' % self.server_address[:2]
+
+    def start(self):
+        """在后台线程中运行"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 50070
+    FakeWebHdfs(('127.0.0.1', port)).serve_forever()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pyback基准测试: 启动进程内的模拟WebHDFS服务, 用真实的PyBack/HDFS代码执行各场景, 结果写为json便于比较
+
+    python benchmark/bench.py -o base.json
+    python benchmark/bench.py -o new.json --latency 2 --bandwidth 200M
+    python benchmark/bench.py --compare base.json new.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import optparse
+import platform
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from pyback import SysUtil
+from pyback import HdfsUtil
+from pyback import JournalUtil
+from pyback import PyBack
+
+import FakeWebHdfs
+
+RESULT_FORMAT = 'pyback-bench'
+CASES = ['put', 'put_parallel', 'get', 'get_parallel', 'cat', 'cat_parallel', 'small_files_put', 'small_files_get',
+         'du_summary', 'du_walk', 'list_large', 'list_recursive', 'resume_get', 'resume_put']
+CONFIG = """[hdfs]
+hosts = %s
+user_name = pyback
+timeout = 30
+max_tries = 1
+retry_delay = 0
+home_dir = /bench
+"""
+
+log = logging.getLogger(__name__)
+
+
+class Bench:
+    """一次基准测试的环境: 模拟服务、本地临时目录和测试数据"""
+    def __init__(self, option):
+        self.option = option
+        self.server = FakeWebHdfs.FakeWebHdfs(latency=option.latency / 1000.0,
+                                              bandwidth=SysUtil.parse_unit(option.bandwidth)).start()
+        self.work_dir = tempfile.mkdtemp(prefix='pyback-bench.')
+        self.config_file = os.path.join(self.work_dir, 'hdfs.cfg')
+        with open(self.config_file, 'w') as fh:
+            fh.write(CONFIG % self.server.hosts)
+        self.pyback = PyBack.PyBack(config_file=self.config_file)
+        self.size = SysUtil.parse_unit(option.size)
+        self.big_file = None
+        self.small_dir = None
+        self.tree_ready = False
+        self.list_ready = False
+
+    def close(self):
+        self.pyback.hdfs.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def local(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def remove_local(self, path):
+        """删除本地文件或目录及其断点记录"""
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.remove_journal(path)
+
+    def remove_journal(self, path):
+        if os.path.exists(path + JournalUtil.JOURNAL_SUFFIX):
+            os.remove(path + JournalUtil.JOURNAL_SUFFIX)
+
+    def get_big_file(self):
+        """本地与hdfs上各一份随机内容的大文件"""
+        if self.big_file is None:
+            self.big_file = self.local('big.bin')
+            with open(self.big_file, 'wb') as fh:
+                for i in xrange(0, self.size, 4*1024*1024):
+                    fh.write(os.urandom(min(4*1024*1024, self.size - i)))
+            with open(self.big_file, 'rb') as fh:
+                self.server.fs.write('/bench/big.bin', fh.read())
+        return self.big_file
+
+    def get_small_dir(self):
+        if self.small_dir is None:
+            self.small_dir = self.local('small')
+            for i in xrange(self.option.small_files):
+                sub_dir = os.path.join(self.small_dir, 'd%02d' % (i % 16))
+                if not os.path.isdir(sub_dir):
+                    os.makedirs(sub_dir)
+                with open(os.path.join(sub_dir, 'f%05d' % i), 'wb') as fh:
+                    fh.write(os.urandom(self.option.small_size))
+        return self.small_dir
+
+    def get_tree(self):
+        """hdfs上深度为tree_depth、每层tree_fanout个子目录、每个目录tree_files个文件的目录树"""
+        root = '/bench/tree'
+        if not self.tree_ready:
+            pending = [(root, 0)]
+            while pending:
+                path, depth = pending.pop()
+                self.server.fs.mkdirs(path)
+                for i in xrange(self.option.tree_files):
+                    self.server.fs.write('%s/f%d' % (path, i), 'x' * 1024)
+                if depth < self.option.tree_depth:
+                    pending += [('%s/d%d' % (path, i), depth + 1) for i in xrange(self.option.tree_fanout)]
+            self.tree_ready = True
+        return root
+
+    def get_list_dir(self):
+        path = '/bench/list'
+        if not self.list_ready:
+            for i in xrange(self.option.list_size):
+                self.server.fs.write('%s/file-%07d' % (path, i), '')
+            self.list_ready = True
+        return path
+
+
+def case_put(bench, parallel=1):
+    source = bench.get_big_file()
+    bench.server.fs.delete('/bench/put.bin')
+    bench.remove_journal(source)
+    assert bench.pyback.put(source, '/bench/put.bin', parallel=parallel)
+    return {'bytes': bench.size}
+
+
+def case_get(bench, parallel=1):
+    bench.get_big_file()
+    dest = bench.local('get.bin')
+    bench.remove_local(dest)
+    assert bench.pyback.get('/bench/big.bin', dest, parallel)
+    return {'bytes': bench.size}
+
+
+def case_cat(bench, parallel=1):
+    bench.get_big_file()
+    with open(os.devnull, 'w') as fh:
+        assert bench.pyback.hdfs.cat('/bench/big.bin', parallel=parallel, output_fd=fh.fileno())
+    return {'bytes': bench.size}
+
+
+def case_small_files_put(bench):
+    source = bench.get_small_dir()
+    bench.server.fs.delete('/bench/small')
+    assert bench.pyback.put_tree(source, '/bench/small', workers=bench.option.workers)
+    return {'items': bench.option.small_files, 'bytes': bench.option.small_files * bench.option.small_size}
+
+
+def case_small_files_get(bench):
+    if bench.server.fs.status('/bench/small') is None:
+        case_small_files_put(bench)
+    dest = bench.local('small-get')
+    bench.remove_local(dest)
+    os.makedirs(dest)
+    assert bench.pyback.get_tree('/bench/small', dest, workers=bench.option.workers)
+    return {'items': bench.option.small_files, 'bytes': bench.option.small_files * bench.option.small_size}
+
+
+def case_du(bench, walk=False):
+    root = bench.get_tree()
+    if walk:
+        bench.server.unsupported.add('GETCONTENTSUMMARY')
+    try:
+        summary = bench.pyback.du(root, summary=True)
+    finally:
+        bench.server.unsupported.discard('GETCONTENTSUMMARY')
+    assert summary is not None
+    return {'items': summary['fileCount'] + summary['directoryCount']}
+
+
+def case_list(bench, recursive=False):
+    path = bench.get_tree() if recursive else bench.get_list_dir()
+    count = 0
+    for item in bench.pyback.iter_list(path, recursive):
+        count += 1
+    assert not bench.pyback.err_msg and count
+    return {'items': count}
+
+
+def case_resume_get(bench):
+    """顺序下载到一半后连续中断超过重试次数而失败, 再按断点续传完成"""
+    bench.get_big_file()
+    dest = bench.local('resume.bin')
+    bench.remove_local(dest)
+    hdfs = bench.pyback.hdfs
+    bench.server.inject_incomplete_read('/bench/big.bin', 1, 0.5)
+    bench.server.inject_incomplete_read('/bench/big.bin', HdfsUtil.RANGE_RETRY + 1, 0)
+    assert not hdfs.get_to_local('/bench/big.bin', dest)
+    bench.server.faults.clear()
+    assert hdfs.get_to_local('/bench/big.bin', dest, resume=True)
+    return {'bytes': bench.size}
+
+
+def case_resume_put(bench):
+    """上传中途只完成一半时按断点续传, 只上传剩余部分"""
+    source = bench.get_big_file()
+    bench.remove_journal(source)
+    hdfs = bench.pyback.hdfs
+    half = bench.size // 2 // HdfsUtil.BLOCK_SIZE * HdfsUtil.BLOCK_SIZE
+    bench.server.fs.delete('/bench/resume.bin')
+    # hdfs上只有前一半时的断点状态
+    with open(source, 'rb') as fh:
+        bench.server.fs.write('/bench/resume.bin', fh.read(half))
+    journal = JournalUtil.Journal(source, 'put', '/bench/resume.bin', bench.size, int(os.path.getmtime(source)))
+    journal.update(offset=half)
+    assert hdfs.put_from_local(source, '/bench/resume.bin', resume=True)
+    return {'bytes': bench.size - half}
+
+
+CASE_FUNCS = {
+    'put': case_put,
+    'put_parallel': lambda bench: case_put(bench, bench.option.parallel),
+    'get': case_get,
+    'get_parallel': lambda bench: case_get(bench, bench.option.parallel),
+    'cat': case_cat,
+    'cat_parallel': lambda bench: case_cat(bench, bench.option.parallel),
+    'small_files_put': case_small_files_put,
+    'small_files_get': case_small_files_get,
+    'du_summary': case_du,
+    'du_walk': lambda bench: case_du(bench, True),
+    'list_large': case_list,
+    'list_recursive': lambda bench: case_list(bench, True),
+    'resume_get': case_resume_get,
+    'resume_put': case_resume_put,
+}
+
+
+def run_case(bench, name):
+    """执行repeat次, 记录每次耗时和最后一次的请求数"""
+    func = CASE_FUNCS[name]
+    runs = []
+    info = {}
+    for i in range(bench.option.repeat):
+        bench.pyback.hdfs.metadata_cache.clear()
+        bench.server.reset_counts()
+        start = time.time()
+        info = func(bench)
+        runs.append(round(time.time() - start, 4))
+    requests = bench.server.reset_counts()
+    runs_sorted = sorted(runs)
+    median = runs_sorted[len(runs) // 2]
+    result = {'runs': runs, 'median': median, 'min': runs_sorted[0], 'requests': requests}
+    if info.get('bytes'):
+        result['bytes'] = info['bytes']
+        result['mb_per_s'] = round(info['bytes'] / 1048576.0 / median, 2) if median else None
+    if info.get('items'):
+        result['items'] = info['items']
+        result['items_per_s'] = round(info['items'] / median, 1) if median else None
+    return result
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(option):
+    HdfsUtil.BLOCK_SIZE = SysUtil.parse_unit(option.block_size)
+    cases = option.cases.split(',') if option.cases else CASES
+    for name in cases:
+        if name not in CASE_FUNCS:
+            log.error("Unknown case: %s, choose from %s" % (name, ','.join(CASES)))
+            return False
+
+    bench = Bench(option)
+    results = {}
+    try:
+        for name in cases:
+            results[name] = run_case(bench, name)
+            SysUtil.put_stderr("%-16s %s\n" % (name, format_result(results[name])))
+    finally:
+        bench.close()
+
+    output = {
+        'format': RESULT_FORMAT,
+        'version': 1,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': get_git_revision(),
+        'python': platform.python_version(),
+        'params': {
+            'size': option.size, 'block_size': option.block_size, 'parallel': option.parallel,
+            'workers': option.workers, 'repeat': option.repeat, 'latency_ms': option.latency,
+            'bandwidth': option.bandwidth, 'small_files': option.small_files, 'small_size': option.small_size,
+            'tree_depth': option.tree_depth, 'tree_fanout': option.tree_fanout, 'tree_files': option.tree_files,
+            'list_size': option.list_size,
+        },
+        'cases': results,
+    }
+    if option.output:
+        with open(option.output, 'w') as fh:
+            json.dump(output, fh, indent=2, sort_keys=True)
+    else:
+        print json.dumps(output, indent=2, sort_keys=True)
+    return True
+
+
+def format_result(result):
+    line = 'median %.3fs' % result['median']
+    if 'mb_per_s' in result:
+        line += '  %s MB/s' % result['mb_per_s']
+    if 'items_per_s' in result:
+        line += '  %s items/s' % result['items_per_s']
+    line += '  %s requests' % sum(v for k, v in result['requests'].items() if '.' in k)
+    return line
+
+
+def compare(base_file, new_file, threshold):
+    """
+    比较两次结果的最短耗时和请求数, 变慢超过threshold百分比或请求数增加时返回False;
+    最短耗时受机器负载的影响比中位数小, 请求数不受影响
+    """
+    base, new = [json.load(open(f)) for f in (base_file, new_file)]
+    if base.get('params') != new.get('params'):
+        log.warning("The params of the two results are different, the comparison may be meaningless")
+    ok = True
+    print '%-16s %10s %10s %8s %10s %10s' % ('case', 'base(s)', 'new(s)', 'change', 'base_req', 'new_req')
+    for name in sorted(set(base['cases']) & set(new['cases'])):
+        b, n = base['cases'][name], new['cases'][name]
+        change = (n['min'] - b['min']) * 100.0 / b['min'] if b['min'] else 0
+        b_req = sum(v for k, v in b['requests'].items() if '.' in k)
+        n_req = sum(v for k, v in n['requests'].items() if '.' in k)
+        flag = ''
+        if change > threshold:
+            flag = 'SLOWER'
+        if n_req > b_req:
+            flag = (flag + ' MORE_REQUESTS').strip()
+        if flag:
+            ok = False
+        print '%-16s %10.3f %10.3f %+7.1f%% %10s %10s  %s' % (name, b['min'], n['min'], change, b_req, n_req, flag)
+    return ok
+
+
+def get_options():
+    parser = optparse.OptionParser(usage="%prog [options] | --compare <base.json> <new.json>")
+    parser.add_option('--output', '-o', help='Write the results to FILE as json, default to stdout', metavar='FILE')
+    parser.add_option('--cases', help='Comma separated cases to run [%s]' % ','.join(CASES), default='',
+                      metavar='STR')
+    parser.add_option('--repeat', '-n', help='Run each case N times and report the median', default=3, type='int',
+                      metavar='N')
+    parser.add_option('--size', help='The size of the big file', default='64M', metavar='SIZE')
+    parser.add_option('--block-size', help='HdfsUtil.BLOCK_SIZE used while benchmarking', default='4M',
+                      metavar='SIZE')
+    parser.add_option('--parallel', '-P', help='The parallel of the *_parallel cases', default=4, type='int',
+                      metavar='N')
+    parser.add_option('--workers', '-w', help='The workers of the small files cases', default=4, type='int',
+                      metavar='N')
+    parser.add_option('--latency', help='The latency of each request in milliseconds', default=0, type='float',
+                      metavar='MS')
+    parser.add_option('--bandwidth', help='The bandwidth of each connection, e.g. 100M, 0 for unlimited',
+                      default='0', metavar='RATE')
+    parser.add_option('--small-files', help='The number of small files', default=500, type='int', metavar='N')
+    parser.add_option('--small-size', help='The size of each small file in bytes', default=4096, type='int',
+                      metavar='N')
+    parser.add_option('--tree-depth', help='The depth of the tree for du and recursive list', default=5, type='int',
+                      metavar='N')
+    parser.add_option('--tree-fanout', help='The sub dirs of each dir in the tree', default=3, type='int',
+                      metavar='N')
+    parser.add_option('--tree-files', help='The files of each dir in the tree', default=5, type='int', metavar='N')
+    parser.add_option('--list-size', help='The number of entries in the large dir', default=20000, type='int',
+                      metavar='N')
+    parser.add_option('--compare', help='Compare two result files instead of running', default=False,
+                      action='store_true')
+    parser.add_option('--threshold', help='The slowdown in percent reported as a regression by --compare',
+                      default=15, type='float', metavar='PCT')
+    parser.add_option('--debug', default=False, action='store_true', help='debug model')
+    return parser
+
+
+def main():
+    parser = get_options()
+    option, args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if option.debug else logging.ERROR, format='%(message)s')
+    if option.compare:
+        if len(args) != 2:
+            parser.print_help()
+            sys.exit(1)
+        res = compare(args[0], args[1], option.threshold)
+    else:
+        res = run(option)
+    sys.exit(0 if res else 255)
+
+
+if __name__ == '__main__':
+    main()
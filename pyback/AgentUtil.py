@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import copy
+import json
+import stat
+import time
+import errno
+import signal
+import socket
+import struct
+import thread
+import hashlib
+import logging
+import tempfile
+import threading
+import ConfigParser
+
+import CacheUtil
+
+# 客户端与agent的协议版本, 不一致时客户端改为在本进程中执行
+PROTOCOL_VERSION = 1
+# 转发给agent执行的PyBack方法, 都是不读写本地文件的元数据操作
+METHODS = ('du', 'iter_list', 'mkdir', 'mkdir_paths', 'delete', 'delete_paths', 'move', 'move_paths')
+CONNECT_TIMEOUT = 1
+# agent检查停止请求与空闲超时的间隔
+POLL_INTERVAL = 1
+# Linux的SO_PEERCRED, python2的socket模块没有定义
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+log = logging.getLogger(__name__)
+
+
+class AgentError(Exception):
+    pass
+
+
+def get_socket_path(config_file):
+    """
+    配置文件中agent_socket指定的路径, 未指定时放在只有当前用户可以访问的目录下, 按配置文件区分,
+    不同的配置文件使用不同的agent; 目录为$XDG_RUNTIME_DIR, 没有时为临时目录下的pyback-agent-<uid>
+    """
+    config = ConfigParser.ConfigParser()
+    try:
+        config.read(config_file)
+        if config.has_option('hdfs', 'agent_socket') and config.get('hdfs', 'agent_socket'):
+            return config.get('hdfs', 'agent_socket')
+    except ConfigParser.Error:
+        pass
+    digest = hashlib.md5(os.path.abspath(config_file)).hexdigest()[:8]
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir or not is_private_dir(runtime_dir):
+        runtime_dir = get_private_dir()
+    return os.path.join(runtime_dir, 'pyback-agent-%s.sock' % digest)
+
+
+def get_private_dir():
+    """没有$XDG_RUNTIME_DIR时存放套接字的目录, 由agent以0700权限创建"""
+    return os.path.join(tempfile.gettempdir(), 'pyback-agent-%s' % os.getuid())
+
+
+def is_private_dir(path):
+    """是否是当前用户所有且其他用户无法访问的目录, 不跟随符号链接"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 077
+
+
+def is_own_socket(path):
+    """是否是当前用户创建的套接字, 其他用户在可写目录中预先创建的同名套接字不可信"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def check_peer(sock):
+    """Linux上按SO_PEERCRED确认对端进程属于当前用户, 其他平台依赖套接字文件的属主检查"""
+    if not sys.platform.startswith('linux'):
+        return
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+    if uid != os.getuid():
+        raise AgentError("Agent socket is served by uid %s, not %s" % (uid, os.getuid()))
+
+
+def connect(socket_path):
+    """
+    有可用的agent时返回AgentClient; 没有运行、无法连接、不属于当前用户或协议版本不同时返回None,
+    调用方改为在本进程中执行
+    """
+    if not os.path.exists(socket_path):
+        return None
+    if not is_own_socket(socket_path):
+        log.warning("Ignore agent socket %s not created by the current user" % socket_path)
+        return None
+    client = AgentClient(socket_path)
+    state = client.ping()
+    if state is None or state.get('version') != PROTOCOL_VERSION:
+        log.debug("Agent on %s is not available, run in process" % socket_path)
+        return None
+    return client
+
+
+class Status(dict):
+    """agent返回的文件状态, 与pyhdfs.FileStatus一样可以按属性访问"""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class AgentClient:
+    """
+    把PyBack的元数据方法转发给agent执行, 参数与返回值与PyBack相同; 每次调用使用一个新连接,
+    agent执行请求时输出的日志按原来的级别在本进程中输出
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.err_msg = ''
+        self.result = None
+
+    def ping(self):
+        """返回agent的状态, 连接不上时返回None"""
+        try:
+            return self.__call('ping')
+        except (socket.error, AgentError):
+            return None
+
+    def stop(self):
+        return self.__call('stop')
+
+    def du(self, path, summary=False):
+        return self.__call('du', path, summary=summary)
+
+    def iter_list(self, path, recursive=False):
+        for file_path, file_status in self.__request('iter_list', [path, recursive], {}):
+            yield file_path, Status(file_status)
+
+    def mkdir(self, path):
+        return self.__call('mkdir', path)
+
+    def mkdir_paths(self, paths, workers):
+        return self.__call('mkdir_paths', paths, workers)
+
+    def delete(self, path):
+        return self.__call('delete', path)
+
+    def delete_paths(self, paths, workers):
+        return self.__call('delete_paths', paths, workers)
+
+    def move(self, source, dest):
+        return self.__call('move', source, dest)
+
+    def move_paths(self, sources, dest, workers):
+        return self.__call('move_paths', sources, dest, workers)
+
+    def __call(self, method, *args, **kwargs):
+        for item in self.__request(method, args, kwargs):
+            pass
+        return self.result
+
+    def __request(self, method, args, kwargs):
+        """发送请求, 依次返回agent发来的数据项, 结束后结果记录在result与err_msg中"""
+        self.err_msg = ''
+        self.result = None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(self.socket_path)
+            check_peer(sock)
+            sock.settimeout(None)
+            request = {'version': PROTOCOL_VERSION, 'method': method, 'args': list(args), 'kwargs': kwargs}
+            sock.sendall(json.dumps(request) + '\n')
+            fh = sock.makefile('rb')
+            while True:
+                line = fh.readline()
+                if not line:
+                    raise AgentError("Agent closed the connection before %s finished" % method)
+                message = json.loads(line)
+                if 'log' in message:
+                    level, name, msg = message['log']
+                    logging.getLogger(name).log(level, msg)
+                elif 'item' in message:
+                    yield message['item']
+                elif 'error' in message:
+                    raise AgentError(message['error'])
+                else:
+                    self.result = message.get('result')
+                    self.err_msg = message.get('err_msg') or ''
+                    return
+        finally:
+            sock.close()
+
+
+class Session:
+    """agent与一个客户端的连接, 日志立即发送, 数据项缓冲后发送"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.out = conn.makefile('wb')
+        self.lock = threading.Lock()
+
+    def read_request(self):
+        return json.loads(self.conn.makefile('rb').readline())
+
+    def send(self, flush=False, **message):
+        with self.lock:
+            self.out.write(json.dumps(message) + '\n')
+            if flush:
+                self.out.flush()
+
+    def close(self):
+        try:
+            self.out.close()
+        except socket.error:
+            pass
+        self.conn.close()
+
+
+class LogRouter(logging.Handler):
+    """把请求线程中输出的日志发送给发起请求的客户端"""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.sessions = {}
+
+    def bind(self, session):
+        self.sessions[thread.get_ident()] = session
+
+    def unbind(self):
+        self.sessions.pop(thread.get_ident(), None)
+
+    def is_routed(self):
+        return thread.get_ident() in self.sessions
+
+    def emit(self, record):
+        session = self.sessions.get(thread.get_ident())
+        if session is None:
+            return
+        try:
+            session.send(flush=True, log=[record.levelno, record.name, record.getMessage()])
+        except socket.error:
+            pass
+
+
+class LocalFilter(logging.Filter):
+    """挂在agent自己的日志handler上, 已经发给客户端的日志不再在agent中输出"""
+    def __init__(self, router):
+        logging.Filter.__init__(self)
+        self.router = router
+
+    def filter(self, record):
+        return not self.router.is_routed()
+
+
+class Agent:
+    """
+    常驻进程, 在Unix域套接字上替pyback命令执行元数据操作, 复用已经建立的连接、元数据缓存与配置;
+    每个连接一个请求, 在单独的线程中用共享连接池的PyBack副本执行; 配置文件修改后在下一个请求前重新创建PyBack
+    """
+    def __init__(self, socket_path, new_pyback, config_file=None, idle_timeout=0):
+        self.socket_path = socket_path
+        self.new_pyback = new_pyback
+        self.config_file = config_file
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pyback = None
+        self.config_mtime = None
+        self.router = LogRouter()
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        self.last_active = time.time()
+        self.active = 0
+        self.requests = 0
+        self.err_msg = ''
+
+    def serve(self):
+        """在socket_path上处理请求, 直到stop、收到SIGTERM或空闲超过idle_timeout秒, 无法监听时返回False"""
+        socket_dir = os.path.dirname(self.socket_path)
+        if socket_dir and not os.path.isdir(socket_dir):
+            try:
+                os.makedirs(socket_dir, 0700)
+            except OSError, e:
+                self.err_msg = "Failed to create socket dir %s: %s" % (socket_dir, e)
+                return False
+        if socket_dir == get_private_dir() and not is_private_dir(socket_dir):
+            self.err_msg = "Socket dir %s is not private to the current user" % socket_dir
+            return False
+        if os.path.lexists(self.socket_path) and not is_own_socket(self.socket_path):
+            self.err_msg = "Socket %s is not created by the current user, remove it first" % self.socket_path
+            return False
+        if AgentClient(self.socket_path).ping() is not None:
+            self.err_msg = "Agent is already running on %s" % self.socket_path
+            return False
+        try:
+            os.unlink(self.socket_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                self.err_msg = "Failed to remove stale socket %s: %s" % (self.socket_path, e)
+                return False
+
+        # 启动时即创建PyBack并连接hdfs, 第一个请求不用等待
+        self.__fork_pyback()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # 只有启动agent的用户可以连接
+        umask = os.umask(0177)
+        try:
+            server.bind(self.socket_path)
+        except socket.error, e:
+            self.err_msg = "Failed to listen on %s: %s" % (self.socket_path, e)
+            return False
+        finally:
+            os.umask(umask)
+        server.listen(128)
+        server.settimeout(POLL_INTERVAL)
+
+        local_filter = LocalFilter(self.router)
+        root = logging.getLogger()
+        for handler in root.handlers:
+            handler.addFilter(local_filter)
+        root.addHandler(self.router)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        log.warning("Agent is listening on %s" % self.socket_path)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    conn, address = server.accept()
+                except socket.timeout:
+                    if self.__is_idle():
+                        log.warning("Agent is idle for %ss, exit" % self.idle_timeout)
+                        break
+                    continue
+                except socket.error, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                conn.settimeout(None)
+                worker = threading.Thread(target=self.__handle, args=(conn,))
+                worker.daemon = True
+                worker.start()
+        finally:
+            server.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            root.removeHandler(self.router)
+            for handler in root.handlers:
+                handler.removeFilter(local_filter)
+        log.warning("Agent stopped after %s requests" % self.requests)
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_state(self):
+        return {
+            'version': PROTOCOL_VERSION,
+            'pid': os.getpid(),
+            'uptime': int(time.time() - self.start_time),
+            'requests': self.requests,
+        }
+
+    def __is_idle(self):
+        with self.lock:
+            return self.idle_timeout and not self.active and time.time() - self.last_active > self.idle_timeout
+
+    def __handle(self, conn):
+        with self.lock:
+            self.active += 1
+        session = Session(conn)
+        try:
+            self.__dispatch(session.read_request(), session)
+            session.out.flush()
+        except (socket.error, IOError), e:
+            log.debug("Client disconnected: %s" % e)
+        except ValueError, e:
+            log.warning("Got invalid request: %s" % e)
+        finally:
+            session.close()
+            with self.lock:
+                self.active -= 1
+                self.last_active = time.time()
+
+    def __dispatch(self, request, session):
+        method = request.get('method')
+        if request.get('version') != PROTOCOL_VERSION:
+            session.send(error="Agent protocol version %s is not supported" % request.get('version'))
+        elif method == 'ping':
+            session.send(result=self.get_state())
+        elif method == 'stop':
+            self.stop()
+            session.send(result=True)
+        elif method in METHODS:
+            with self.lock:
+                self.requests += 1
+            pyback = self.__fork_pyback()
+            self.router.bind(session)
+            try:
+                res = getattr(pyback, method)(*request.get('args', []), **request.get('kwargs', {}))
+                if method == 'iter_list':
+                    for item in res:
+                        session.send(item=item)
+                    res = None
+                session.send(result=res, err_msg=pyback.err_msg)
+            except (socket.error, IOError):
+                raise
+            except Exception, e:
+                log.debug("Got error when run %s: %s" % (method, e))
+                session.send(error="Got error when run %s in agent: %s" % (method, e))
+            finally:
+                self.router.unbind()
+            pyback.report_stats()
+        else:
+            session.send(error="Unknown method %s" % method)
+
+    def __fork_pyback(self):
+        """
+        返回共享连接池的PyBack副本, 各请求单独记录err_msg; 配置文件修改后重新创建;
+        上传下载在其他进程中执行, agent看不到这些修改, 每个请求使用新的元数据缓存, 不沿用之前请求的结果
+        """
+        with self.lock:
+            mtime = self.__get_config_mtime()
+            if self.pyback is None or mtime != self.config_mtime:
+                if self.pyback is not None:
+                    log.warning("Config file %s is changed, reload it" % self.config_file)
+                self.pyback = self.new_pyback()
+                self.config_mtime = mtime
+            pyback = copy.copy(self.pyback)
+        pyback.hdfs = copy.copy(pyback.hdfs)
+        cache = pyback.hdfs.metadata_cache
+        pyback.hdfs.metadata_cache = CacheUtil.TTLCache(cache.ttl, cache.max_size)
+        pyback.err_msg = ''
+        return pyback
+
+    def __get_config_mtime(self):
+        try:
+            return os.path.getmtime(self.config_file) if self.config_file else None
+        except OSError:
+            return None
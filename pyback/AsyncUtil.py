@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import time
+import logging
+import threading
+import Queue
+
+import pyhdfs
+
+WATCH_INTERVAL = 0.1
+# 单次读取的上限, 未限速时下载循环一次读取一个BLOCK_SIZE, 取消要等到读完才生效
+CHECK_SIZE = 1024*1024
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+FINISHED = 'FINISHED'
+CANCELLED = 'CANCELLED'
+
+log = logging.getLogger(__name__)
+
+
+class HdfsError(Exception):
+    """操作失败, 消息为同步接口的err_msg"""
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future:
+    """
+    一个异步操作的结果, 接口与concurrent.futures.Future一致; result/exception可设置等待超时,
+    完成、失败、取消或超时后依次调用add_done_callback注册的回调, 回调在工作线程中执行, 应尽快返回
+    """
+    def __init__(self, name, deadline=None):
+        self.name = name
+        self.deadline = deadline
+        self.cond = threading.Condition()
+        self.state = PENDING
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """
+        取消操作: 还未开始的不再执行; 正在传输的在下一次读写数据时中止, 之后以CancelledError结束;
+        正在执行的元数据请求无法中断, 完成后保留其结果; 已结束的返回False
+        """
+        with self.cond:
+            if self.state == FINISHED:
+                return False
+            self.cancel_event.set()
+            if self.state == RUNNING:
+                return True
+        self.__finish(CANCELLED, error=CancelledError(self.name))
+        return True
+
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    def running(self):
+        return self.state == RUNNING
+
+    def done(self):
+        return self.state in (FINISHED, CANCELLED)
+
+    def result(self, timeout=None):
+        self.__wait(timeout)
+        if self.error:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        self.__wait(timeout)
+        return self.error
+
+    def add_done_callback(self, callback):
+        with self.cond:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        self.__call(callback)
+
+    def check(self):
+        """传输循环中调用, 已取消或超过期限时抛出异常中止传输"""
+        if self.cancel_event.is_set():
+            raise CancelledError(self.name)
+        if self.deadline and time.time() > self.deadline:
+            raise TimeoutError("%s timed out" % self.name)
+
+    def set_running(self):
+        """工作线程开始执行前调用, 已取消或已超时时返回False"""
+        with self.cond:
+            if self.state != PENDING:
+                return False
+            self.state = RUNNING
+            return True
+
+    def set_result(self, value):
+        return self.__finish(FINISHED, value=value)
+
+    def set_exception(self, error):
+        if isinstance(error, CancelledError):
+            return self.__finish(CANCELLED, error=error)
+        return self.__finish(FINISHED, error=error)
+
+    def expire(self):
+        """超过期限时由监视线程调用, 正在执行的操作随后的结果被丢弃"""
+        self.cancel_event.set()
+        return self.__finish(FINISHED, error=TimeoutError("%s timed out" % self.name))
+
+    def __finish(self, state, value=None, error=None):
+        with self.cond:
+            if self.done():
+                return False
+            self.state = state
+            self.value = value
+            self.error = error
+            callbacks, self.callbacks = self.callbacks, []
+            self.cond.notify_all()
+        for callback in callbacks:
+            self.__call(callback)
+        return True
+
+    def __call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            log.warning("Callback of %s raised: %s" % (self.name, e))
+
+    def __wait(self, timeout):
+        end = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while not self.done():
+                if end is None:
+                    # 无超时的wait不响应KeyboardInterrupt, 分段等待
+                    self.cond.wait(1)
+                    continue
+                remain = end - time.time()
+                if remain <= 0:
+                    raise TimeoutError("Waiting for %s timed out" % self.name)
+                self.cond.wait(remain)
+
+
+class CancelToken:
+    """
+    替换操作实例的限速器, 上传、下载与cat的拷贝循环每读写一段数据都会经过限速器,
+    借此检查取消与超时; 其余属性转给共享的限速器
+    """
+    def __init__(self, rate_limiter, future):
+        self.rate_limiter = rate_limiter
+        self.future = future
+
+    def get_read_size(self, size):
+        return min(self.rate_limiter.get_read_size(size), CHECK_SIZE)
+
+    def consume(self, size):
+        self.future.check()
+        self.rate_limiter.consume(size)
+
+    def __getattr__(self, name):
+        return getattr(self.rate_limiter, name)
+
+
+class AsyncHDFS:
+    """
+    HdfsUtil.HDFS的异步接口: 每个操作立即返回Future, 由最多max_workers个线程执行,
+    同时进行的hdfs请求数因此受限, 成千上万个排队的元数据操作只占用一个队列;
+    各操作在共享连接池、元数据缓存与限速器的实例副本上调用同步接口, 路径处理与错误信息与同步接口一致,
+    同步接口返回False或None时Future以HdfsError结束;
+    timeout为每个操作的默认期限(秒), 从提交时开始计算, 超时的Future以TimeoutError结束
+    """
+    def __init__(self, hdfs, max_workers=None, timeout=None):
+        self.hdfs = hdfs
+        self.max_workers = max_workers or hdfs.pool_maxsize
+        if self.max_workers > hdfs.pool_maxsize:
+            log.warning("max_workers %s is larger than pool_maxsize %s, extra connections will not be reused" %
+                        (self.max_workers, hdfs.pool_maxsize))
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.idle = 0
+        self.closed = False
+        self.deadlines = set()
+        self.watcher = None
+
+    def exists(self, path, timeout=None):
+        return self.__submit('exists', (path, ), timeout=timeout)
+
+    def is_dir(self, path, timeout=None):
+        return self.__submit('is_dir', (path, ), timeout=timeout)
+
+    def is_file(self, path, timeout=None):
+        return self.__submit('is_file', (path, ), timeout=timeout)
+
+    def get_file_status(self, path, timeout=None):
+        return self.__submit('get_file_status', (path, ), failed=(None, ), timeout=timeout)
+
+    def get_size(self, path, timeout=None):
+        return self.__submit('get_size', (path, ), failed=(None, ), timeout=timeout)
+
+    def get_content_summary(self, path, timeout=None):
+        return self.__submit('get_content_summary', (path, ), failed=(None, ), timeout=timeout)
+
+    def list(self, path, recursive=False, timeout=None):
+        """结果为(完整路径, 文件状态)的列表, 与PyBack.iter_list的条目一致"""
+        return self.__submit(self.__list, (path, recursive), timeout=timeout)
+
+    def mkdir(self, path, timeout=None):
+        return self.__submit('mkdir', (path, ), failed=(False, ), timeout=timeout)
+
+    def move(self, source, dest, timeout=None):
+        return self.__submit('move', (source, dest), failed=(False, ), timeout=timeout)
+
+    def delete(self, path, timeout=None):
+        return self.__submit('delete', (path, ), failed=(False, ), timeout=timeout)
+
+    def put_from_local(self, source_file, dest, timeout=None, **kwargs):
+        return self.__submit('put_from_local', (source_file, dest), kwargs, failed=(False, ), timeout=timeout)
+
+    def put_from_stream(self, dest_file, source, timeout=None, **kwargs):
+        """从source(有read方法的对象)流式上传"""
+        kwargs['source'] = source
+        return self.__submit('put_from_stream', (dest_file, ), kwargs, failed=(False, ), timeout=timeout)
+
+    def get_to_local(self, source_file, dest, timeout=None, **kwargs):
+        return self.__submit('get_to_local', (source_file, dest), kwargs, failed=(False, ), timeout=timeout)
+
+    def cat(self, path, output_fd, timeout=None, **kwargs):
+        """把文件内容写入output_fd(文件描述符)"""
+        kwargs['output_fd'] = output_fd
+        return self.__submit('cat', (path, ), kwargs, failed=(False, ), timeout=timeout)
+
+    def close(self, wait=True, cancel_pending=False):
+        """不再接受新操作, cancel_pending为True时取消排队中的操作, wait为True时等待工作线程退出"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            threads = list(self.threads)
+        if cancel_pending:
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                item[0].cancel()
+        for i in range(len(threads)):
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel_pending=exc_type is not None)
+
+    def __list(self, hdfs, path, recursive):
+        try:
+            items = list(hdfs.iter_path_status(path, recursive))
+        except pyhdfs.HdfsFileNotFoundException:
+            items = None
+        if not items and not hdfs.exists(path):
+            raise HdfsError("Destination file is not exists!")
+        return items
+
+    def __submit(self, method, args, kwargs=None, failed=(), timeout=None):
+        """提交一个操作, 同步接口返回failed中的值(False或None)时视为失败, failed为空时按原样返回结果"""
+        timeout = timeout if timeout is not None else self.timeout
+        name = method if isinstance(method, str) else method.__name__.lstrip('_')
+        future = Future('%s(%s)' % (name, ', '.join(repr(arg) for arg in args)),
+                        time.time() + timeout if timeout else None)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("AsyncHDFS is closed")
+            self.queue.put((future, method, args, kwargs or {}, failed))
+            if self.idle < self.queue.qsize() and len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self.__work, name='async-hdfs-%s' % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            if future.deadline:
+                self.deadlines.add(future)
+                if self.watcher is None:
+                    self.watcher = threading.Thread(target=self.__watch, name='async-hdfs-watch')
+                    self.watcher.daemon = True
+                    self.watcher.start()
+        return future
+
+    def __work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            item = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+            if item is None:
+                return
+            future, method, args, kwargs, failed = item
+            if future.set_running():
+                self.__run(future, method, args, kwargs, failed)
+
+    def __run(self, future, method, args, kwargs, failed):
+        # 与HDFS内部的并行实例相同, 共享连接池与缓存, 单独记录err_msg
+        hdfs = copy.copy(self.hdfs)
+        hdfs.rate_limiter = CancelToken(self.hdfs.rate_limiter, future)
+        try:
+            if isinstance(method, str):
+                res = getattr(hdfs, method)(*args, **kwargs)
+            else:
+                res = method(hdfs, *args, **kwargs)
+            if any(res is value for value in failed):
+                if future.cancel_event.is_set():
+                    raise CancelledError(future.name)
+                raise HdfsError(hdfs.err_msg or "%s failed" % future.name)
+            future.set_result(res)
+        except (CancelledError, TimeoutError), e:
+            future.set_exception(e)
+        except BaseException, e:
+            # 包括SystemExit, 保证future总能结束且工作线程继续处理后续操作
+            future.set_exception(CancelledError(future.name) if future.cancel_event.is_set() else e)
+
+    def __watch(self):
+        """监视线程, 使超过期限的操作按时结束, 不依赖工作线程何时返回"""
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            now = time.time()
+            with self.lock:
+                self.deadlines = set(f for f in self.deadlines if not f.done())
+                expired = [f for f in self.deadlines if f.deadline <= now]
+                if self.closed and not self.deadlines:
+                    self.watcher = None
+                    return
+            for future in expired:
+                if future.expire():
+                    log.warning("%s timed out" % future.name)
+
+
+def wait(futures, timeout=None):
+    """等待全部完成或超时, 返回(已完成, 未完成)两个集合"""
+    end = time.time() + timeout if timeout is not None else None
+    for future in futures:
+        try:
+            future.exception(max(0, end - time.time()) if end is not None else None)
+        except TimeoutError:
+            break
+    done = set(f for f in futures if f.done())
+    return done, set(futures) - done
+
+
+def as_completed(futures, timeout=None):
+    """按完成的先后顺序返回Future, timeout内未全部完成时抛出TimeoutError"""
+    end = time.time() + timeout if timeout is not None else None
+    finished = Queue.Queue()
+    futures = set(futures)
+    for future in futures:
+        future.add_done_callback(finished.put)
+    for i in range(len(futures)):
+        while True:
+            wait_time = 1 if end is None else min(1, end - time.time())
+            if wait_time <= 0:
+                raise TimeoutError("%s of %s futures are not done" % (len(futures) - i, len(futures)))
+            try:
+                yield finished.get(timeout=wait_time)
+                break
+            except Queue.Empty:
+                continue
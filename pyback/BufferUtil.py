@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import threading
+import Queue
+
+BUFFER_SIZE = 4*1024*1024
+MEMORY_LIMIT = 64*1024*1024
+
+
+class BufferPool:
+    """
+    有界的缓冲区池, 下载循环用readinto把数据读入缓冲区后直接写盘, 不为每次读取创建新的字符串;
+    缓冲区按需分配, 最多memory_limit // buffer_size个, 都在使用时get等待其他传输归还;
+    由fork出的并行实例共享, 进程内所有下载的缓冲区总量不超过memory_limit
+    """
+    def __init__(self, buffer_size=BUFFER_SIZE, memory_limit=MEMORY_LIMIT):
+        self.buffer_size = buffer_size
+        self.count = max(1, memory_limit // buffer_size)
+        # 后进先出, 优先复用刚归还的缓冲区
+        self.free = Queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.allocated = 0
+
+    def get(self):
+        try:
+            return self.free.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if self.allocated < self.count:
+                self.allocated += 1
+                return bytearray(self.buffer_size)
+        # 带超时等待, 保证主线程能响应Ctrl-C
+        while True:
+            try:
+                return self.free.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+    def put(self, buf):
+        self.free.put(buf)
+
+    def get_stats(self):
+        return {
+            'buffer_size': self.buffer_size,
+            'count': self.count,
+            'allocated': self.allocated,
+            'free': self.free.qsize(),
+        }
+
+
+class MappedFile:
+    """
+    按窗口mmap本地文件, slice返回映射内存上的buffer, 不复制数据; 映射下一个窗口时只丢弃对上一个窗口的引用,
+    仍被buffer引用的映射在buffer释放后才解除, 常驻内存约为一个窗口
+    """
+    def __init__(self, fh, window=BUFFER_SIZE):
+        self.fh = fh
+        self.window = max(mmap.ALLOCATIONGRANULARITY, window - window % mmap.ALLOCATIONGRANULARITY)
+        self.map = None
+        self.map_start = self.map_end = 0
+
+    def slice(self, offset, size, end):
+        """返回从offset开始最多size字节的buffer, 不超过当前窗口与end"""
+        if not (self.map_start <= offset < self.map_end):
+            self.__map(offset, end)
+        return buffer(self.map, offset - self.map_start, min(size, self.map_end - offset))
+
+    def __map(self, offset, end):
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        length = min(self.window, end - start)
+        # 映射超出文件末尾的部分被访问时进程会收到SIGBUS, 先确认文件没有被截断
+        if os.fstat(self.fh.fileno()).st_size < start + length:
+            raise IOError("File %s is truncated while reading" % self.fh.name)
+        self.map = mmap.mmap(self.fh.fileno(), length, access=mmap.ACCESS_READ, offset=start)
+        self.map_start, self.map_end = start, start + length
+
+    def close(self):
+        self.map = None
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import collections
+
+
+class TTLCache:
+    """线程安全的LRU缓存, 每个条目在ttl秒后过期, 超过max_size时淘汰最久未使用的条目"""
+    def __init__(self, ttl=5, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """返回(是否命中, 值)"""
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return False, None
+            # 重新插入, 移到最近使用的位置
+            self.items[key] = item
+            self.hits += 1
+            return True, item[1]
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl, value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        """删除以prefix开头的所有条目"""
+        with self.lock:
+            for key in [k for k in self.items if k.startswith(prefix)]:
+                del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses}
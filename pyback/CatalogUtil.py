@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import logging
+import sqlite3
+import ConfigParser
+
+# 其他进程写入时等待的秒数
+LOCK_TIMEOUT = 30
+INSERT_BATCH = 10000
+STORE_TYPES = ('online', 'archive')
+COLUMNS = ('path', 'store_type', 'date', 'host', 'sub_dir', 'size', 'mtime', 'checksum', 'recorded')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    path TEXT PRIMARY KEY,
+    store_type TEXT NOT NULL,
+    date TEXT NOT NULL,
+    host TEXT NOT NULL,
+    sub_dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    checksum TEXT,
+    recorded INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS backups_host_date ON backups (host, date);
+CREATE INDEX IF NOT EXISTS backups_date ON backups (date);
+CREATE INDEX IF NOT EXISTS backups_store_type_date ON backups (store_type, date);
+"""
+
+log = logging.getLogger(__name__)
+
+
+def from_config(config_file):
+    """按配置文件中的catalog_db与home_dir创建Catalog, 不连接hdfs; 没有配置catalog_db时返回None"""
+    config = ConfigParser.ConfigParser()
+    try:
+        config.read(config_file)
+        if not (config.has_option('hdfs', 'catalog_db') and config.get('hdfs', 'catalog_db')):
+            return None
+        return Catalog(config.get('hdfs', 'catalog_db'), config.get('hdfs', 'home_dir'))
+    except ConfigParser.Error, err:
+        log.error("Got error when read config file %s: %s " % (config_file, err.message))
+        return None
+
+
+def child_range(path):
+    """path下所有路径的范围[path/, path0), '0'是'/'之后的字符, 避免LIKE对路径中的%和_的特殊处理"""
+    path = path.rstrip('/')
+    return path + '/', path + '0'
+
+
+class Catalog:
+    """
+    备份文件的本地索引, 保存在sqlite数据库中, 按home_dir/<store_type>/<date>/<host>/<sub_dir>的目录结构
+    记录每个备份文件的路径、大小、修改时间与校验和, 只记录符合该结构的文件;
+    每次操作使用单独的连接与事务, 可以在多个线程与进程中同时使用, WAL模式下查询不会被写入阻塞
+    """
+    def __init__(self, db_file, home_dir):
+        self.db_file = db_file
+        self.home_dir = os.path.normpath(home_dir)
+        self.initialized = False
+
+    def parse(self, path):
+        """返回路径对应的(store_type, date, host, sub_dir), 不符合备份目录结构时返回None"""
+        path = os.path.normpath(path)
+        if not path.startswith(self.home_dir + '/'):
+            return None
+        parts = path[len(self.home_dir) + 1:].split('/')
+        store_type = parts.pop(0) if parts[0] in STORE_TYPES else ''
+        if len(parts) < 3 or not re.match(r'^\d{8}$', parts[0]):
+            return None
+        return store_type, parts[0], parts[1], '/'.join(parts[2:-1])
+
+    def add(self, entries):
+        """
+        在一个事务中记录(路径, 大小, 修改时间毫秒数, 校验和)列表, 已有的路径覆盖原记录;
+        不符合目录结构的路径忽略, 返回记录的文件数
+        """
+        now = int(time.time() * 1000)
+        rows = []
+        for path, size, mtime, checksum in entries:
+            fields = self.parse(path)
+            if fields:
+                rows.append((os.path.normpath(path),) + fields + (size, mtime, checksum, now))
+        if not rows:
+            return 0
+        with self.__connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def remove(self, paths):
+        """在一个事务中删除路径及其下所有文件的记录"""
+        with self.__connect() as conn:
+            for path in paths:
+                path = os.path.normpath(path)
+                conn.execute("DELETE FROM backups WHERE path = ? OR (path >= ? AND path < ?)",
+                             (path,) + child_range(path))
+
+    def move(self, moves):
+        """在一个事务中把(源路径, 目标路径)列表中源路径及其下文件的记录改到目标路径下, 返回改动的记录数"""
+        count = 0
+        now = int(time.time() * 1000)
+        with self.__connect() as conn:
+            for source, dest in moves:
+                source, dest = os.path.normpath(source), os.path.normpath(dest)
+                where = "path = ? OR (path >= ? AND path < ?)", (source,) + child_range(source)
+                rows = conn.execute("SELECT path, size, mtime, checksum FROM backups WHERE " + where[0],
+                                    where[1]).fetchall()
+                conn.execute("DELETE FROM backups WHERE " + where[0], where[1])
+                for path, size, mtime, checksum in rows:
+                    new_path = dest + path[len(source):]
+                    fields = self.parse(new_path)
+                    if fields:
+                        conn.execute("INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (new_path,) + fields + (size, mtime, checksum, now))
+                count += len(rows)
+        return count
+
+    def query(self, host=None, store_type=None, date_from=None, date_to=None, sub_dir=None, latest=False, limit=None):
+        """
+        按条件查询备份文件, 日期为%Y%m%d格式, date_from与date_to都包含在内; latest为True时每台主机只返回满足条件的
+        最新日期的文件; 返回按日期、主机、路径排序的字典列表
+        """
+        conditions = []
+        params = []
+        for column, op, value in (('host', '=', host), ('store_type', '=', store_type), ('date', '>=', date_from),
+                                  ('date', '<=', date_to), ('sub_dir', '=', sub_dir)):
+            if value is not None:
+                conditions.append("b.%s %s ?" % (column, op))
+                params.append(value)
+        where = ' AND '.join(conditions) or '1'
+        sql = "SELECT %s FROM backups b" % ', '.join('b.' + c for c in COLUMNS)
+        if latest:
+            sql += " JOIN (SELECT b.host AS host, MAX(b.date) AS date FROM backups b WHERE %s GROUP BY b.host) l " \
+                   "ON b.host = l.host AND b.date = l.date" % where
+            params = params * 2
+        sql += " WHERE %s ORDER BY b.date, b.host, b.path" % where
+        if limit:
+            sql += " LIMIT %d" % limit
+        with self.__connect() as conn:
+            return [dict(zip(COLUMNS, row)) for row in conn.execute(sql, params)]
+
+    def rebuild(self, entries):
+        """
+        用扫描得到的(路径, 大小, 修改时间毫秒数)替换全部记录: 先写入本连接的临时表, 不占用数据库的写锁,
+        扫描完成后在一个事务中替换, 期间的查询看到的是替换前的记录; 大小与修改时间未变的文件保留原校验和;
+        返回记录的文件数
+        """
+        now = int(time.time() * 1000)
+        conn = self.__open()
+        try:
+            conn.execute("CREATE TEMP TABLE scan (path TEXT PRIMARY KEY, store_type TEXT, date TEXT, host TEXT, "
+                         "sub_dir TEXT, size INTEGER, mtime INTEGER)")
+            rows = []
+            for path, size, mtime in entries:
+                fields = self.parse(path)
+                if not fields:
+                    continue
+                rows.append((os.path.normpath(path),) + fields + (size, mtime))
+                if len(rows) >= INSERT_BATCH:
+                    conn.executemany("INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                    rows = []
+            conn.executemany("INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            with conn:
+                conn.execute("DELETE FROM backups WHERE path NOT IN (SELECT path FROM scan)")
+                conn.execute("INSERT OR REPLACE INTO backups SELECT s.path, s.store_type, s.date, s.host, s.sub_dir, "
+                             "s.size, s.mtime, (SELECT b.checksum FROM backups b WHERE b.path = s.path "
+                             "AND b.size = s.size AND b.mtime = s.mtime), ? FROM scan s", (now,))
+            return conn.execute("SELECT COUNT(*) FROM scan").fetchone()[0]
+        finally:
+            conn.close()
+
+    def __connect(self):
+        """返回用作with语句的连接, 语句结束时提交或回滚事务"""
+        return _Transaction(self.__open())
+
+    def __open(self):
+        if not self.initialized:
+            db_dir = os.path.dirname(self.db_file)
+            if db_dir and not os.path.isdir(db_dir):
+                os.makedirs(db_dir)
+        conn = sqlite3.connect(self.db_file, timeout=LOCK_TIMEOUT)
+        conn.text_factory = str
+        if not self.initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self.initialized = True
+        return conn
+
+
+class _Transaction:
+    """with语句结束时提交或回滚, 并关闭连接"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import time
+import zlib
+import array
+import struct
+import hashlib
+import logging
+import threading
+from itertools import imap, repeat
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+BYTES_PER_CRC = 512
+CRC_TYPES = ['CRC32', 'CRC32C']
+MANIFEST_SUFFIX = '.pyback-checksum'
+READ_SIZE = 4*1024*1024
+
+log = logging.getLogger(__name__)
+
+
+def get_crc_func(crc_type):
+    """返回计算一个chunk校验值的函数, 结果为无符号32位整数"""
+    if crc_type == 'CRC32':
+        return lambda data: zlib.crc32(data) & 0xffffffff
+    elif crc_type == 'CRC32C':
+        if crc32c is None:
+            raise ValueError("CRC32C checksum needs the crc32c module")
+        # 不同版本的crc32c模块函数名不同
+        return getattr(crc32c, 'crc32c', None) or crc32c.crc32
+    raise ValueError("Unknown checksum type: %s" % crc_type)
+
+
+def get_chunk_crc_func(crc_type):
+    """
+    返回(array类型码, 函数), 函数的结果直接存入该类型码的array, 字节与无符号CRC相同;
+    zlib.crc32在python2中返回有符号整数, 用'i'保存可省去每个chunk一次python层的掩码运算
+    """
+    if crc_type == 'CRC32':
+        return 'i', zlib.crc32
+    return 'I', get_crc_func(crc_type)
+
+
+def parse_algorithm(algorithm):
+    """解析hdfs校验算法名, 如MD5-of-262144MD5-of-512CRC32C, 返回(bytes_per_crc, crc_type)"""
+    match = re.match(r'^MD5-of-\d+MD5-of-(\d+)(CRC32C?)$', algorithm)
+    if not match:
+        raise ValueError("Unsupported checksum algorithm: %s" % algorithm)
+    return int(match.group(1)), match.group(2)
+
+
+class FileChecksum:
+    """
+    本地计算hdfs的MD5MD5CRC32文件校验和: 每bytes_per_crc字节一个CRC, 每个block的CRC序列取MD5,
+    所有block的MD5再取MD5; 各区间可由不同线程并发计算, block的CRC收齐后立即折算为MD5
+    """
+    def __init__(self, block_size, bytes_per_crc=BYTES_PER_CRC, crc_type='CRC32C'):
+        if block_size % bytes_per_crc:
+            raise ValueError("Block size %s is not a multiple of %s" % (block_size, bytes_per_crc))
+        self.crc_typecode, self.crc_func = get_chunk_crc_func(crc_type)
+        self.block_size = block_size
+        self.bytes_per_crc = bytes_per_crc
+        self.crc_type = crc_type
+        self.lock = threading.Lock()
+        self.pieces = {}
+        self.block_md5s = {}
+
+    def range(self, offset):
+        """返回从offset开始顺序计算的区间, offset需按bytes_per_crc对齐"""
+        return RangeChecksum(self, offset)
+
+    def add(self, offset, crcs):
+        """加入一段连续的CRC, crcs为大端序的CRC串, 不跨越block"""
+        index = offset // self.block_size
+        with self.lock:
+            pieces = self.pieces.setdefault(index, {})
+            pieces[offset] = crcs
+            if sum(len(p) for p in pieces.values()) == self.block_size // self.bytes_per_crc * 4:
+                self.__finish_block(index)
+
+    def __finish_block(self, index):
+        pieces = self.pieces.pop(index)
+        self.block_md5s[index] = hashlib.md5(''.join(pieces[k] for k in sorted(pieces))).digest()
+
+    def get_checksum(self, size):
+        """返回(算法名, 校验和), 格式与WebHDFS GETFILECHECKSUM的algorithm和bytes相同"""
+        if size == 0:
+            return 'MD5-of-0MD5-of-0CRC32', (struct.pack('>iq', 0, 0) + hashlib.md5('').digest()).encode('hex')
+        blocks = (size + self.block_size - 1) // self.block_size
+        with self.lock:
+            # 最后一个block不满, 按已收到的CRC折算
+            if blocks - 1 in self.pieces:
+                self.__finish_block(blocks - 1)
+            missing = [i for i in range(blocks) if i not in self.block_md5s]
+            if missing:
+                raise ValueError("Checksum of block %s is not computed" % missing[0])
+            md5 = hashlib.md5(''.join(self.block_md5s[i] for i in range(blocks))).digest()
+        crc_per_block = self.block_size // self.bytes_per_crc if blocks > 1 else 0
+        algorithm = 'MD5-of-%sMD5-of-%s%s' % (crc_per_block, self.bytes_per_crc, self.crc_type)
+        return algorithm, (struct.pack('>iq', self.bytes_per_crc, crc_per_block) + md5).encode('hex')
+
+
+class RangeChecksum:
+    """顺序计算一个区间的CRC, 数据按块批量计算, 到达block边界时交给FileChecksum"""
+    def __init__(self, checksum, offset):
+        if offset % checksum.bytes_per_crc:
+            raise ValueError("Checksum range offset %s is not aligned" % offset)
+        self.checksum = checksum
+        self.offset = offset
+        self.pos = offset
+        self.tail = ''
+        self.crcs = array.array(checksum.crc_typecode)
+
+    def update(self, data, size=None):
+        """加入数据, data可以是str或bytearray, size为其中有效数据的长度"""
+        if size is None:
+            size = len(data)
+        bytes_per_crc = self.checksum.bytes_per_crc
+        crc_func = self.checksum.crc_func
+        start = 0
+        if self.tail:
+            need = min(bytes_per_crc - len(self.tail), size)
+            self.tail += str(buffer(data, 0, need))
+            start = need
+            if len(self.tail) < bytes_per_crc:
+                return
+            self.crcs.append(crc_func(self.tail))
+            self.tail = ''
+            self.__advance(bytes_per_crc)
+
+        while size - start >= bytes_per_crc:
+            block_end = (self.pos // self.checksum.block_size + 1) * self.checksum.block_size
+            end = start + min(size - start, block_end - self.pos) // bytes_per_crc * bytes_per_crc
+            # 切片与CRC都在C层迭代, 不为每个chunk执行python字节码; 纯python实现的上限见--verify的帮助
+            self.crcs.extend(imap(crc_func, imap(buffer, repeat(data), xrange(start, end, bytes_per_crc),
+                                                 repeat(bytes_per_crc))))
+            self.__advance(end - start)
+            start = end
+        if start < size:
+            self.tail = str(buffer(data, start, size - start))
+
+    def __advance(self, length):
+        self.pos += length
+        if self.pos % self.checksum.block_size == 0:
+            self.__flush()
+
+    def __flush(self):
+        if self.crcs:
+            if struct.pack('=I', 1) != struct.pack('>I', 1):
+                self.crcs.byteswap()
+            self.checksum.add(self.offset, self.crcs.tostring())
+        self.offset = self.pos
+        self.crcs = array.array(self.checksum.crc_typecode)
+
+    def close(self):
+        """区间结束, 不足bytes_per_crc的尾部数据单独计算一个CRC, 只应出现在文件末尾"""
+        if self.tail:
+            self.crcs.append(self.checksum.crc_func(self.tail))
+            self.pos += len(self.tail)
+            self.tail = ''
+        self.__flush()
+
+
+class ChecksumReader:
+    """包装上传数据源, 在数据被读取时计算校验和"""
+    def __init__(self, source, range_checksum):
+        self.source = source
+        self.range_checksum = range_checksum
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.range_checksum.update(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(READ_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def update_from_file(range_checksum, filename, offset, length):
+    """读取本地文件的一个区间计算校验和, 用于续传时已传输的部分"""
+    with open(filename, 'rb') as fh:
+        fh.seek(offset)
+        while length > 0:
+            data = fh.read(min(READ_SIZE, length))
+            if not data:
+                raise IOError("Unexpected end of file %s" % filename)
+            range_checksum.update(data)
+            length -= len(data)
+
+
+def is_match(local_checksum, remote_checksum):
+    """比较本地与hdfs的(算法名, 校验和)"""
+    return local_checksum[0] == remote_checksum[0] and local_checksum[1][-32:] == remote_checksum[1][-32:]
+
+
+def write_manifest(local_file, remote_file, size, local_checksum, remote_checksum, verified):
+    """把校验结果写入本地文件旁的清单"""
+    manifest_file = local_file + MANIFEST_SUFFIX
+    manifest = {
+        'local_file': os.path.abspath(local_file),
+        'remote_file': remote_file,
+        'size': size,
+        'algorithm': local_checksum[0],
+        'checksum': local_checksum[1],
+        'remote_algorithm': remote_checksum[0],
+        'remote_checksum': remote_checksum[1],
+        'verified': verified,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    try:
+        with open(manifest_file, 'w') as fh:
+            json.dump(manifest, fh, indent=2, sort_keys=True)
+    except (IOError, OSError), e:
+        log.warning("Failed to write checksum manifest %s: %s" % (manifest_file, e))
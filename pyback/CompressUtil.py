@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import zlib
+import time
+import struct
+import threading
+import Queue
+import multiprocessing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+COMPRESS_BLOCK_SIZE = 4*1024*1024
+COMPRESS_WORKERS = multiprocessing.cpu_count()
+COMPRESS_METHODS = ['gzip', 'zstd', 'lz4']
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+HEADER_SIZE = 64
+# 结果队列满时检查是否已关闭的间隔
+PUT_INTERVAL = 0.5
+
+# pyback写出的压缩数据带有标记, 只有带标记的文件才会透明解压, 避免误解压用户自己压缩的文件:
+# gzip在第一个member的FCOMMENT中写入标记, zstd/lz4在开头写入一个解压工具会跳过的skippable frame
+MARK = 'pyback'
+GZIP_FCOMMENT = 0x10
+SKIPPABLE_MAGIC = 0x184D2A50
+
+
+def check_method(method):
+    """检查压缩方式是否可用, 不可用时抛出ValueError"""
+    if method not in COMPRESS_METHODS:
+        raise ValueError("Unknown compress method: %s" % method)
+    if method == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard module")
+    if method == 'lz4' and lz4_frame is None:
+        raise ValueError("lz4 compression needs the lz4 module")
+
+
+def add_suffix(filename, method):
+    suffix = SUFFIXES[method]
+    return filename if filename.endswith(suffix) else filename + suffix
+
+
+def strip_suffix(filename, method):
+    suffix = SUFFIXES[method]
+    return filename[:-len(suffix)] if filename.endswith(suffix) and filename != suffix else filename
+
+
+def has_suffix(filename):
+    return any(filename.endswith(suffix) for suffix in SUFFIXES.values())
+
+
+def detect(header):
+    """根据文件头判断是否是pyback压缩的数据, 返回压缩方式, 不是时返回None"""
+    mark = MARK + '\0'
+    if header[:3] == '\x1f\x8b\x08' and len(header) >= 10 + len(mark) and ord(header[3]) == GZIP_FCOMMENT:
+        if header[10:10 + len(mark)] == mark:
+            return 'gzip'
+    elif len(header) >= 8 and struct.unpack('<I', header[:4])[0] == SKIPPABLE_MAGIC:
+        size = struct.unpack('<I', header[4:8])[0]
+        payload = header[8:8 + size]
+        if payload.startswith(MARK + ':') and payload[len(MARK) + 1:] in ('zstd', 'lz4'):
+            return payload[len(MARK) + 1:]
+    return None
+
+
+def skippable_frame(method):
+    payload = '%s:%s' % (MARK, method)
+    return struct.pack('<II', SKIPPABLE_MAGIC, len(payload)) + payload
+
+
+def gzip_member(data, mark=False):
+    """把一个数据块压缩为独立的gzip member, 多个member直接拼接仍是合法的gzip文件"""
+    header = '\x1f\x8b\x08' + chr(GZIP_FCOMMENT if mark else 0) + struct.pack('<I', int(time.time())) + '\x00\xff'
+    if mark:
+        header += MARK + '\0'
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(data) + deflate.flush()
+    return header + body + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+
+def compress_block(method, data, first=False):
+    """压缩一个独立的数据块, 第一个数据块带上pyback标记"""
+    if method == 'gzip':
+        return gzip_member(data, first)
+    elif method == 'lz4':
+        block = lz4_frame.compress(data)
+        return skippable_frame(method) + block if first else block
+    raise ValueError("Block compression is not supported for %s" % method)
+
+
+class CompressReader:
+    """
+    把源文件对象压缩后以文件对象的形式顺序返回, 可直接作为上传数据源;
+    gzip/lz4按块交给多个线程并发压缩, zstd使用libzstd自带的多线程压缩
+    """
+    def __init__(self, source, method, workers=COMPRESS_WORKERS, block_size=COMPRESS_BLOCK_SIZE):
+        check_method(method)
+        self.source = source
+        self.method = method
+        self.block_size = block_size
+        self.buffer = ''
+        self.eof = False
+        self.stop = threading.Event()
+
+        if method == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=3, threads=max(1, workers))
+            self.zstd_reader = compressor.stream_reader(source)
+            self.buffer = skippable_frame(method)
+            return
+
+        # 有界结果队列, 限制已读入但未被上传的数据量
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue(max(2, workers * 2))
+        self.threads = [threading.Thread(target=self.__feed, args=(workers, ))]
+        self.threads += [threading.Thread(target=self.__work) for i in range(max(1, workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __feed(self, workers):
+        """按块读取源数据, 按顺序为每块放入一个结果槽; 关闭后停止读取, 总是通知压缩线程退出"""
+        first = True
+        try:
+            while not self.stop.is_set():
+                data = self.source.read(self.block_size)
+                if not data:
+                    break
+                slot = [threading.Event(), None, None]
+                self.tasks.put((data, first, slot))
+                if not self.__put_result(slot):
+                    break
+                first = False
+            self.__put_result(None)
+        except Exception, e:
+            slot = [threading.Event(), None, e]
+            slot[0].set()
+            self.__put_result(slot)
+        finally:
+            for i in range(max(1, workers)):
+                self.tasks.put(None)
+
+    def __put_result(self, slot):
+        """放入有界结果队列, 队列满时定期检查是否已关闭, 关闭后放弃并返回False"""
+        while not self.stop.is_set():
+            try:
+                self.results.put(slot, timeout=PUT_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            data, first, slot = task
+            # 关闭后剩余的块不再压缩
+            if not self.stop.is_set():
+                try:
+                    slot[1] = compress_block(self.method, data, first)
+                except Exception, e:
+                    slot[2] = e
+            slot[0].set()
+
+    def __next_block(self):
+        if self.eof:
+            return ''
+        if self.method == 'zstd':
+            block = self.zstd_reader.read(self.block_size)
+        else:
+            slot = self.results.get()
+            if slot is None:
+                block = ''
+            else:
+                while not slot[0].wait(1):
+                    pass
+                if slot[2] is not None:
+                    raise slot[2]
+                block = slot[1]
+        if not block:
+            self.eof = True
+        return block
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.buffer += self.__next_block()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.buffer or self.__next_block()
+            self.buffer = ''
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        """停止读取与压缩; 上传中途失败时取出结果队列中的块, 使读取线程不再阻塞, 释放已压缩的数据"""
+        self.stop.set()
+        self.buffer = ''
+        if self.method == 'zstd':
+            self.zstd_reader.close()
+            return
+        while True:
+            try:
+                self.results.get_nowait()
+            except Queue.Empty:
+                break
+
+
+class Decompressor:
+    """流式解压pyback压缩的数据, 支持多个gzip member或lz4 frame拼接的数据"""
+    def __init__(self, method):
+        check_method(method)
+        self.method = method
+        self.skip = None if method == 'gzip' else ''
+        self.obj = self.__new()
+
+    def __new(self):
+        if self.method == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.method == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        else:
+            return lz4_frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        data = str(data)
+        # 跳过开头的标记frame
+        if self.skip is not None:
+            self.skip += data
+            if len(self.skip) < 8:
+                return ''
+            frame_size = 8 + struct.unpack('<I', self.skip[4:8])[0]
+            if len(self.skip) < frame_size:
+                return ''
+            data, self.skip = self.skip[frame_size:], None
+
+        output = []
+        while data:
+            # 一个member/frame结束后, 剩余数据属于下一个
+            if getattr(self.obj, 'eof', False):
+                self.obj = self.__new()
+            output.append(self.obj.decompress(data))
+            data = getattr(self.obj, 'unused_data', '')
+            if data:
+                self.obj = self.__new()
+        return ''.join(output)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import logging
+import binascii
+import threading
+
+CHUNK_MIN_SIZE = 1024*1024
+CHUNK_MAX_SIZE = 8*1024*1024
+# 切分点概率为2^-CHUNK_BITS, 平均chunk大小约为CHUNK_MIN_SIZE + 2^CHUNK_BITS
+CHUNK_BITS = 21
+SCAN_SIZE = 1024*1024
+READ_SIZE = 8*1024*1024
+UPLOAD_WORKERS = 4
+FETCH_WORKERS = 4
+
+MANIFEST_FORMAT = 'pyback-dedup'
+MANIFEST_SUFFIX = '.pyback-dedup'
+MANIFEST_MAX_SIZE = 64*1024*1024
+
+# 滚动哈希的混合移位(bit), 切分点只取决于其前WINDOW字节的内容
+MIX_SHIFTS = (7, 17, 31, 61, 107)
+WINDOW = (sum(MIX_SHIFTS) + CHUNK_BITS) // 8 + 2
+
+log = logging.getLogger(__name__)
+
+_masks = {}
+
+
+def _byte_mask(size):
+    """每个字节最低位为1的大整数, 按长度缓存"""
+    mask = _masks.get(size)
+    if mask is None:
+        mask = long('01' * size, 16)
+        if len(_masks) < 4:
+            _masks[size] = mask
+    return mask
+
+
+def find_boundary(data, start, end):
+    """
+    返回data[start:end]中第一个切分点, 即切分后第一个chunk的长度, 没有时返回-1;
+    把数据整体转为大整数, 用移位、异或、与运算同时计算所有位置的窗口哈希, 寻找连续CHUNK_BITS位为0的位置,
+    每一步都是对整段数据的C实现运算, 避免在python中逐字节循环
+    """
+    begin = max(0, start - WINDOW)
+    piece = data[begin:end]
+    size = len(piece)
+    if size == 0:
+        return -1
+    # 大端序, 越靠前的字节位越高, 右移即引入前面字节的内容
+    x = long(binascii.hexlify(piece), 16)
+    h = x ^ (x >> MIX_SHIFTS[0])
+    h ^= h >> MIX_SHIFTS[1]
+    h ^= (h >> MIX_SHIFTS[2]) & (h >> MIX_SHIFTS[3])
+    h ^= h >> MIX_SHIFTS[4]
+
+    # r的第p位为h第p位起连续CHUNK_BITS位的或
+    r = h
+    width = 1
+    while width * 2 <= CHUNK_BITS:
+        r |= r >> width
+        width *= 2
+    r |= r >> (CHUNK_BITS - width)
+
+    mask = _byte_mask(size)
+    hits = (r ^ mask) & mask
+    # 只取start之后的位置, 第j个字节对应第8*(size-1-j)位
+    hits &= (1 << (8 * (size - 1 - (start - begin)) + 1)) - 1
+    if not hits:
+        return -1
+    return begin + size - (hits.bit_length() - 1) // 8
+
+
+class Chunker:
+    """按内容切分数据流, 插入或删除数据只影响附近的chunk, 其余chunk与上次备份相同"""
+    def __init__(self, source, min_size=CHUNK_MIN_SIZE, max_size=CHUNK_MAX_SIZE):
+        self.source = source
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def __iter__(self):
+        buf = ''
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = self.source.read(READ_SIZE)
+                if not data:
+                    eof = True
+                buf += data
+            if not buf:
+                return
+            cut = self.__cut(buf)
+            yield buf[:cut]
+            buf = buf[cut:]
+
+    def __cut(self, buf):
+        """跳过min_size后分段查找切分点, 找不到时在max_size处切分"""
+        end = min(len(buf), self.max_size)
+        start = self.min_size
+        while start < end:
+            cut = find_boundary(buf, start, min(start + SCAN_SIZE, end))
+            if cut > 0:
+                return cut
+            start += SCAN_SIZE
+        return end
+
+
+def chunk_path(chunk_dir, digest):
+    """chunk在hdfs上的路径, 按哈希前缀分两级目录, 避免单个目录下文件过多"""
+    return os.path.join(chunk_dir, digest[:2], digest[2:4], digest)
+
+
+def get_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def add_suffix(filename):
+    return filename if filename.endswith(MANIFEST_SUFFIX) else filename + MANIFEST_SUFFIX
+
+
+def strip_suffix(filename):
+    return filename[:-len(MANIFEST_SUFFIX)] if filename.endswith(MANIFEST_SUFFIX) else filename
+
+
+def make_manifest(chunk_dir, chunks):
+    """生成manifest, chunks为按顺序的(哈希, 长度)列表"""
+    return json.dumps({
+        'format': MANIFEST_FORMAT,
+        'version': 1,
+        'algorithm': 'sha256',
+        'chunk_dir': chunk_dir,
+        'size': sum(size for digest, size in chunks),
+        'chunks': chunks,
+    })
+
+
+def parse_manifest(data):
+    """解析manifest, 不是pyback的manifest时返回None"""
+    try:
+        manifest = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get('format') != MANIFEST_FORMAT:
+        return None
+    return manifest
+
+
+class ChunkIndex:
+    """本地chunk索引, 记录已确认存在于hdfs的chunk, 命中时不再访问hdfs"""
+    def __init__(self, index_file, chunk_dir):
+        self.index_file = index_file
+        self.chunk_dir = chunk_dir
+        self.digests = set()
+        self.lock = threading.Lock()
+        self.fh = None
+
+    def load(self):
+        """读取索引, 索引属于其他chunk目录时不使用"""
+        header = '# %s\n' % self.chunk_dir
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r') as fh:
+                    if fh.readline() != header:
+                        log.warning("Chunk index %s is not for %s, ignore it" % (self.index_file, self.chunk_dir))
+                        return False
+                    self.digests = set(line.strip() for line in fh if line.strip())
+                self.fh = open(self.index_file, 'a')
+            else:
+                index_dir = os.path.dirname(self.index_file)
+                if index_dir and not os.path.isdir(index_dir):
+                    os.makedirs(index_dir)
+                self.fh = open(self.index_file, 'a')
+                self.fh.write(header)
+                self.fh.flush()
+        except (IOError, OSError), e:
+            log.warning("Failed to load chunk index %s: %s" % (self.index_file, e))
+            return False
+        return True
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def add(self, digest):
+        with self.lock:
+            if digest in self.digests:
+                return
+            self.digests.add(digest)
+            if self.fh:
+                self.fh.write(digest + '\n')
+                self.fh.flush()
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+
+class ChunkStore:
+    """去重存储的位置: hdfs上的chunk目录与可选的本地索引文件"""
+    def __init__(self, chunk_dir, index_file=None):
+        self.chunk_dir = chunk_dir
+        self.index_file = index_file
+
+    def open_index(self):
+        """返回已加载的本地索引, 未配置或无法使用时返回None"""
+        if not self.index_file:
+            return None
+        index = ChunkIndex(self.index_file, self.chunk_dir)
+        return index if index.load() else None
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import threading
+
+import pyhdfs
+
+STATE_TTL = 300
+
+log = logging.getLogger(__name__)
+
+
+class NameNodeState:
+    """
+    记录当前active NameNode的本地状态文件, 同一台机器上的pyback进程共享;
+    以排序后的hosts为键区分集群, 记录active节点与确认的时间; 读写失败时只记录日志, 不影响请求
+    """
+    def __init__(self, state_file, hosts, ttl=STATE_TTL):
+        self.state_file = state_file
+        self.key = ','.join(sorted(hosts))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.active = None
+
+    def load(self):
+        """返回(记录的active节点, 是否在有效期内), 没有记录时返回(None, False)"""
+        entry = self.__read().get(self.key)
+        if not isinstance(entry, dict) or not entry.get('active'):
+            return None, False
+        self.active = entry['active']
+        age = time.time() - entry.get('time', 0)
+        return self.active, 0 <= age < self.ttl
+
+    def save(self, host):
+        """记录host为active节点, 先写临时文件再改名, 其他进程不会读到写了一半的文件"""
+        with self.lock:
+            state = self.__read()
+            state[self.key] = {'active': host, 'time': int(time.time())}
+            tmp_file = '%s.%s.tmp' % (self.state_file, os.getpid())
+            try:
+                state_dir = os.path.dirname(self.state_file)
+                if state_dir and not os.path.isdir(state_dir):
+                    os.makedirs(state_dir)
+                with open(tmp_file, 'w') as fh:
+                    json.dump(state, fh)
+                os.rename(tmp_file, self.state_file)
+            except (IOError, OSError), e:
+                log.warning("Failed to write namenode state file %s: %s" % (self.state_file, e))
+            self.active = host
+
+    def __read(self):
+        try:
+            with open(self.state_file, 'r') as fh:
+                state = json.load(fh)
+            return state if isinstance(state, dict) else {}
+        except IOError:
+            return {}
+        except ValueError, e:
+            log.warning("Ignore broken namenode state file %s: %s" % (self.state_file, e))
+            return {}
+
+
+class HaHdfsClient(pyhdfs.HdfsClient):
+    """
+    请求在standby或连不上的NameNode上失败、改由其他节点完成时, pyhdfs把完成请求的节点调到hosts最前,
+    这里同时把它写入状态文件, 之后启动的进程直接先访问该节点
+    """
+    def __init__(self, **kwargs):
+        pyhdfs.HdfsClient.__init__(self, **kwargs)
+        self.state = None
+
+    def _record_last_active(self, host):
+        pyhdfs.HdfsClient._record_last_active(self, host)
+        state = self.state
+        if state is not None and host != state.active and host in self.hosts:
+            log.warning("NameNode %s is active now" % host)
+            state.save(host)
+
+
+def new_client(state_file, ttl=STATE_TTL, **kwargs):
+    """
+    创建按状态文件排序hosts的client, 记录的active节点排在最前, 其余保持配置中的顺序;
+    返回(client, 记录是否在有效期内), 在有效期内时调用方可以跳过连接测试
+    """
+    client = HaHdfsClient(randomize_hosts=False, **kwargs)
+    state = NameNodeState(state_file, client.hosts, ttl)
+    active, fresh = state.load()
+    if active in client.hosts:
+        client.hosts = [active] + [host for host in client.hosts if host != active]
+    else:
+        fresh = False
+    client.state = state
+    return client, fresh
@@ -4,17 +4,74 @@
 import pyhdfs
 import sys
 import os
-import shutil
+import re
+import copy
 import requests
 import logging
+import fnmatch
+import threading
+import Queue
+import socket
+import time
 
 import SysUtil
+import JournalUtil
+import CacheUtil
+import CompressUtil
+import ChecksumUtil
+import DedupUtil
+import RateUtil
+import StatsUtil
+import HaUtil
+import BufferUtil
+import TuneUtil
+import ProgressUtil
+import SyncUtil
+import ReaderUtil
 
 BLOCK_SIZE = 128*1024*1024
+RANGE_RETRY = 3
+WALK_WORKERS = 8
+LIST_QUEUE_SIZE = 1000
+CAT_BUFFER_SIZE = 4*1024*1024
+CAT_BUFFER_COUNT = 4
 
 log = logging.getLogger(__name__)
 
 
+class LocalFileRange:
+    """
+    本地文件的一个区间, 作为上传的数据源, range_checksum不为空时读取的同时计算校验和;
+    按window大小分段mmap, read返回映射内存的buffer, 由socket直接发送, 不复制为新的字符串
+    """
+    def __init__(self, filename, offset, length, range_checksum=None, window=BufferUtil.BUFFER_SIZE):
+        self.fh = open(filename, 'rb')
+        self.mapped = BufferUtil.MappedFile(self.fh, window)
+        self.pos = offset
+        self.end = offset + length
+        self.length = length
+        self.range_checksum = range_checksum
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        remain = self.end - self.pos
+        if remain <= 0:
+            return ''
+        if size < 0 or size > remain:
+            size = remain
+        data = self.mapped.slice(self.pos, size, self.end)
+        self.pos += len(data)
+        if self.range_checksum:
+            self.range_checksum.update(data)
+        return data
+
+    def close(self):
+        self.mapped.close()
+        self.fh.close()
+
+
 class HDFS:
     def __init__(self, **kwargs):
         self.hdfs_hosts = kwargs.get('hdfs_hosts')
@@ -22,18 +79,66 @@ class HDFS:
         self.connect_timeout = kwargs.get('connect_timeout', 5)
         self.connect_max_tries = kwargs.get('connect_max_tries', 1)
         self.connect_retry_delay = kwargs.get('connect_retry_delay', 3)
+        self.pool_size = kwargs.get('pool_size', 10)
+        self.pool_maxsize = kwargs.get('pool_maxsize', 32)
+        # 记录active NameNode的状态文件, 为空时每次连接都测试, hosts的顺序随机
+        self.namenode_state_file = kwargs.get('namenode_state_file')
+        self.namenode_state_ttl = kwargs.get('namenode_state_ttl', HaUtil.STATE_TTL)
+        self.metadata_cache = CacheUtil.TTLCache(kwargs.get('cache_ttl', 5), kwargs.get('cache_size', 10000))
+        self.checksum_type = kwargs.get('checksum_type', 'CRC32C')
+        self.bytes_per_checksum = kwargs.get('bytes_per_checksum', ChecksumUtil.BYTES_PER_CRC)
+        # 断点记录的目录, 为空时记录在本地文件旁边
+        self.journal_dir = kwargs.get('journal_dir')
+        # 限速器由fork出的并行实例共享, 所有传输流共用一个令牌桶
+        self.rate_limiter = RateUtil.RateLimiter(kwargs.get('limit_rate', 0), kwargs.get('limit_rate_file'))
+        # 传输进度, 设置后由拷贝循环计数, 同样由并行实例共享
+        self.progress = None
+        # 请求延迟与各阶段耗时统计, 为None时不统计
+        self.stats = None
+        # 下载缓冲区池, 同样由并行实例共享, 限制所有下载占用的内存
+        self.buffer_pool = BufferUtil.BufferPool(kwargs.get('io_buffer_size', BufferUtil.BUFFER_SIZE),
+                                                 kwargs.get('io_memory_limit', BufferUtil.MEMORY_LIMIT))
+        # 按实测吞吐调整读取大小与自动并行度, 同样由并行实例共享
+        self.tuner = TuneUtil.Tuner(self.buffer_pool.buffer_size,
+                                    kwargs.get('min_read_size', TuneUtil.MIN_READ_SIZE),
+                                    kwargs.get('max_parallel', TuneUtil.MAX_PARALLEL),
+                                    kwargs.get('adaptive_io', True))
 
         self.err_msg = None
+        # 最近一次校验通过的hdfs校验和, 格式为"算法名:校验和", 记录到备份索引中
+        self.last_checksum = None
         self.hdfs_client = None
+        self.session = None
+        self.list_batch_supported = True
 
     def connect(self):
-        """初始化hdfs client, 测试连接"""
+        """
+        初始化hdfs client, 测试连接; 配置了namenode_state_file时先访问记录的active NameNode,
+        记录在有效期内时跳过连接测试, 测试通过后更新记录
+        """
         self.__clear_err_msg()
         try:
-            self.hdfs_client = pyhdfs.HdfsClient(hosts=self.hdfs_hosts, user_name=self.hdfs_user,
-                                                 timeout=self.connect_timeout, max_tries=self.connect_max_tries,
-                                                 retry_delay=self.connect_retry_delay)
+            self.session = self.__create_session()
+            kwargs = {
+                'hosts': self.hdfs_hosts,
+                'user_name': self.hdfs_user,
+                'timeout': self.connect_timeout,
+                'max_tries': self.connect_max_tries,
+                'retry_delay': self.connect_retry_delay,
+                'requests_session': self.session,
+            }
+            if not self.namenode_state_file:
+                self.hdfs_client = pyhdfs.HdfsClient(**kwargs)
+                self.hdfs_client.list_status('/')
+                return True
+
+            self.hdfs_client, fresh = HaUtil.new_client(self.namenode_state_file, self.namenode_state_ttl, **kwargs)
+            if fresh:
+                log.debug("Use the active NameNode %s recorded in %s" % (self.hdfs_client.hosts[0],
+                                                                        self.namenode_state_file))
+                return True
             self.hdfs_client.list_status('/')
+            self.hdfs_client.state.save(self.hdfs_client.hosts[0])
             return True
         except pyhdfs.HdfsException, err:
             self.err_msg = "Init hdfs failed: %s" % err.message
@@ -42,13 +147,68 @@ class HDFS:
             self.err_msg = "Init hdfs failed: %s" % e
             return False
 
-    def __create_file(self, source, dest_file):
+    def __create_session(self):
+        """
+        创建带连接池的requests session, NameNode和重定向后的DataNode请求都复用keep-alive连接;
+        pool_size为缓存的主机连接池个数, pool_maxsize为每个主机最多保留的连接数
+        """
+        session = StatsUtil.StatsSession()
+        session.stats = self.stats
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_pool_stats(self):
+        """返回各主机连接池的统计信息"""
+        stats = []
+        if not self.session:
+            return stats
+
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                idle = len([conn for conn in list(pool.pool.queue) if conn is not None]) if pool.pool else 0
+                stats.append({
+                    'host': '%s:%s' % (pool.host, pool.port),
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': idle,
+                    'maxsize': self.pool_maxsize,
+                })
+        return stats
+
+    def enable_stats(self, stats=None):
+        """开启统计, 返回Stats; 之后fork出的并行实例共享同一个Stats"""
+        self.stats = stats or StatsUtil.Stats()
+        if self.session:
+            self.session.stats = self.stats
+        return self.stats
+
+    def get_stats(self):
+        """返回请求延迟直方图、各阶段耗时与计数, 未开启统计时返回None"""
+        return self.stats.to_dict() if self.stats else None
+
+    def close(self):
+        """关闭连接池"""
+        if self.session:
+            self.session.close()
+            self.session = None
+
+    def __create_file(self, source, dest_file, **kwargs):
         """ 创建文件 """
         hdfs_client = self.hdfs_client
         self.__clear_err_msg()
         try:
             if not self.exists(dest_file):
-                hdfs_client.create(dest_file, source, buffersize=BLOCK_SIZE)
+                try:
+                    hdfs_client.create(dest_file, self.__limit(source),
+                                       buffersize=self.buffer_pool.buffer_size, **kwargs)
+                finally:
+                    self.__invalidate(dest_file)
                 return True
             else:
                 self.err_msg = "File %s is exists" % dest_file
@@ -57,109 +217,1339 @@ class HDFS:
             self.err_msg = "Got hdfs error when put file: %s" % err.message
             return False
         except Exception, e:
-            SysUtil.croak(e)
+            # 数据源出错或被取消时返回False, 由调用方处理, 不退出进程
             self.err_msg = "Got error when put file: %s" % e
             return False
 
-    def put_from_stream(self, dest_file):
-        """从标准输入上传文件"""
-        return self.__create_file(sys.stdin, dest_file)
+    @StatsUtil.timed('put')
+    def put_from_stream(self, dest_file, compress=None, compress_threads=CompressUtil.COMPRESS_WORKERS,
+                        verify=False, chunk_store=None, source=None):
+        """
+        从标准输入上传文件, source不为空时从source(有read方法的对象)读取;
+        compress不为空时边读边压缩, verify为True时上传后比较校验和; chunk_store不为空时按内容切分去重上传
+        """
+        source = source or sys.stdin
+        if compress:
+            dest_file = CompressUtil.add_suffix(dest_file, compress)
+        if chunk_store:
+            return self.__create_file_dedup(source, dest_file, chunk_store)
+        if compress or verify:
+            return self.__create_file_checked(source, dest_file, compress, compress_threads, verify)
+        return self.__create_file(source, dest_file)
 
-    def put_from_local(self, source_file, dest):
-        """从本地文件上传"""
+    @StatsUtil.timed('put')
+    def put_from_local(self, source_file, dest, parallel=1, resume=False, compress=None,
+                       compress_threads=CompressUtil.COMPRESS_WORKERS, verify=False, chunk_store=None):
+        """
+        从本地文件上传, parallel大于1时分块并行上传后合并, resume为True时按断点记录续传;
+        compress不为空时多线程压缩后流式上传, 压缩上传不支持并行分片与断点续传;
+        verify为True时在上传的同时计算校验和, 完成后与hdfs的校验和比较;
+        chunk_store不为空时按内容切分去重上传, parallel为上传chunk的线程数
+        """
         self.__clear_err_msg()
         try:
             if self.exists(dest) and self.is_dir(dest):
                 dest_dir = dest
-                dest_file = os.path.join(dest_dir, os.path.basename(source_file))
+                dest_name = os.path.basename(source_file)
+                if compress:
+                    dest_name = CompressUtil.add_suffix(dest_name, compress)
+                if chunk_store:
+                    dest_name = DedupUtil.add_suffix(dest_name)
+                dest_file = os.path.join(dest_dir, dest_name)
+            elif compress:
+                dest_file = CompressUtil.add_suffix(dest, compress)
             else:
                 dest_file = dest
-            return self.__create_file(open(source_file, 'rb'), dest_file)
         except Exception, e:
             self.err_msg = "Got error when put file: %s" % e
             return False
+        if chunk_store:
+            try:
+                source = open(source_file, 'rb')
+            except IOError, e:
+                self.err_msg = "Got error when put file: %s" % e
+                return False
+            try:
+                return self.__create_file_dedup(source, dest_file, chunk_store,
+                                                parallel if parallel > 1 else DedupUtil.UPLOAD_WORKERS)
+            finally:
+                source.close()
+        if compress:
+            try:
+                source = open(source_file, 'rb')
+            except IOError, e:
+                self.err_msg = "Got error when put file: %s" % e
+                return False
+            try:
+                return self.__create_file_checked(source, dest_file, compress, compress_threads, verify, source_file)
+            finally:
+                source.close()
+        return self.__put_file(source_file, dest_file, parallel, resume, verify)
 
-    def get_to_local(self, source_file, dest, offset=0):
-        """下载文件到本地"""
+    def __create_file_checked(self, source, dest_file, compress, compress_threads, verify, local_file=None):
+        """把源数据按需压缩、计算校验和后流式上传"""
+        self.__clear_err_msg()
+        reader = None
+        try:
+            checksum = self.__new_checksum(BLOCK_SIZE) if verify else None
+            if compress:
+                source = reader = CompressUtil.CompressReader(source, compress, compress_threads)
+        except ValueError, e:
+            self.err_msg = "Got error when put file: %s" % e
+            return False
+        try:
+            if not verify:
+                return self.__create_file(source, dest_file)
+            range_checksum = checksum.range(0)
+            # 固定块大小, 使本地计算的校验和与hdfs按block计算的一致
+            if not self.__create_file(ChecksumUtil.ChecksumReader(source, range_checksum), dest_file,
+                                      blocksize=BLOCK_SIZE):
+                return False
+            range_checksum.close()
+            return self.__verify(dest_file, local_file, checksum)
+        finally:
+            if reader:
+                reader.close()
+
+    def __create_file_dedup(self, source, dest_file, chunk_store, workers=DedupUtil.UPLOAD_WORKERS):
+        """
+        按内容切分数据流, 多线程计算chunk哈希并只上传hdfs中不存在的chunk, 最后写入按顺序记录chunk的manifest;
+        manifest文件名总是带有去重后缀, 下载时据此识别
+        """
+        self.__clear_err_msg()
+        dest_file = DedupUtil.add_suffix(dest_file)
+        try:
+            if self.exists(dest_file):
+                self.err_msg = "File %s is exists" % dest_file
+                return False
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when put file: %s" % err.message
+            return False
+
+        index = chunk_store.open_index()
+        tasks = Queue.Queue(workers * 2)
+        slots = []
+        errors = []
+        stats = {'chunks': 0, 'uploaded': 0, 'uploaded_bytes': 0, 'bytes': 0}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                data, slot = task
+                try:
+                    if not errors:
+                        digest = DedupUtil.get_digest(data)
+                        uploaded = self.__put_chunk(chunk_store.chunk_dir, digest, data, index)
+                        slot.extend([digest, len(data)])
+                        with lock:
+                            stats['chunks'] += 1
+                            stats['bytes'] += len(data)
+                            if uploaded:
+                                stats['uploaded'] += 1
+                                stats['uploaded_bytes'] += len(data)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for data in DedupUtil.Chunker(source):
+                if errors:
+                    break
+                slot = []
+                slots.append(slot)
+                tasks.put((data, slot))
+        except Exception, e:
+            errors.append(e)
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+            if index:
+                index.close()
+
+        if errors:
+            err = errors[0]
+            if isinstance(err, pyhdfs.HdfsException):
+                self.err_msg = "Got hdfs error when put file: %s" % err.message
+            else:
+                self.err_msg = "Got error when put file: %s" % err
+            return False
+        log.warning("Dedup put %s: %s chunks, %s new, uploaded %s of %s bytes" %
+                    (dest_file, stats['chunks'], stats['uploaded'], stats['uploaded_bytes'], stats['bytes']))
+        return self.__create_file(DedupUtil.make_manifest(chunk_store.chunk_dir, slots), dest_file)
+
+    def __put_chunk(self, chunk_dir, digest, data, index=None):
+        """上传一个chunk, 已存在时跳过; 先写临时文件再rename, 保证chunk路径下的文件总是完整的; 返回是否上传"""
         hdfs_client = self.hdfs_client
+        if index is not None and digest in index:
+            return False
+        chunk_file = DedupUtil.chunk_path(chunk_dir, digest)
+        try:
+            hdfs_client.get_file_status(chunk_file)
+            exists = True
+        except pyhdfs.HdfsFileNotFoundException:
+            exists = False
+        if not exists:
+            tmp_file = '%s.%s.%s.%s._COPYING_' % (chunk_file, socket.gethostname(), os.getpid(),
+                                                  threading.current_thread().ident)
+            hdfs_client.create(tmp_file, self.__limit(data),
+                               buffersize=self.buffer_pool.buffer_size, overwrite=True)
+            if not hdfs_client.rename(tmp_file, chunk_file):
+                # 其他客户端同时上传了相同的chunk
+                hdfs_client.delete(tmp_file)
+                if not hdfs_client.exists(chunk_file):
+                    raise Exception("rename %s to %s failed" % (tmp_file, chunk_file))
+                exists = True
+        if index is not None:
+            index.add(digest)
+        return not exists
 
+    def __put_file(self, source_file, dest_file, parallel=1, resume=False, verify=False):
+        """上传本地文件到确定的hdfs路径"""
         self.__clear_err_msg()
+        try:
+            total_size = os.path.getsize(source_file)
+            journal = JournalUtil.Journal(source_file, 'put', dest_file, total_size, int(os.path.getmtime(source_file)),
+                                          self.journal_dir)
+            checksum = self.__new_checksum(BLOCK_SIZE) if verify else None
+            self.__progress_total(total_size)
+            if (parallel > 1 or parallel == TuneUtil.AUTO) and total_size > BLOCK_SIZE:
+                res = self.__create_file_parallel(source_file, dest_file, parallel, journal, resume, checksum)
+            else:
+                res = self.__create_file_resumable(source_file, dest_file, journal, resume, checksum)
+            if res:
+                journal.remove()
+            if res and verify:
+                res = self.__verify(dest_file, source_file, checksum, total_size)
+            return res
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when put file: %s" % err.message
+            return False
+        except Exception, e:
+            self.err_msg = "Got error when put file: %s" % e
+            return False
+        finally:
+            self.__invalidate(dest_file)
+
+    def __create_file_resumable(self, source_file, dest_file, journal, resume, checksum=None):
+        """按BLOCK_SIZE分段上传, 首段CREATE其余APPEND, 每段确认后记录断点"""
+        hdfs_client = self.hdfs_client
+        range_checksum = checksum.range(0) if checksum else None
+        total_size = journal.get('size')
+        offset = 0
+        created = self.exists(dest_file)
+        if created:
+            if not (resume and journal.load()):
+                self.err_msg = "File %s is exists" % dest_file
+                return False
+            # 以NameNode确认的文件长度作为续传位置
+            offset = self.__stat(dest_file).length
+            if offset > total_size:
+                self.err_msg = "File %s is larger than source, can not resume" % dest_file
+                return False
+            log.warning("Resume put file %s from offset %s" % (dest_file, offset))
+            self.__progress_total(total_size, offset)
+            if range_checksum:
+                ChecksumUtil.update_from_file(range_checksum, source_file, 0, offset)
+        else:
+            journal.update(offset=0)
+
+        # 校验时固定块大小, 使本地计算的校验和与hdfs按block计算的一致
+        create_kwargs = {'blocksize': BLOCK_SIZE} if checksum else {}
+        while not created or offset < total_size:
+            length = min(BLOCK_SIZE, total_size - offset)
+            source = LocalFileRange(source_file, offset, length, range_checksum, self.buffer_pool.buffer_size)
+            reader = self.__limit(source, length)
+            try:
+                if created:
+                    hdfs_client.append(dest_file, reader, buffersize=self.buffer_pool.buffer_size)
+                else:
+                    hdfs_client.create(dest_file, reader, buffersize=self.buffer_pool.buffer_size, **create_kwargs)
+                    created = True
+            finally:
+                source.close()
+            offset += length
+            journal.update(offset=offset)
+        if range_checksum:
+            range_checksum.close()
+        return True
+
+    def __create_file_parallel(self, source_file, dest_file, parallel, journal, resume, checksum=None):
+        """按BLOCK_SIZE切块并行上传为临时分片, 再用CONCAT合并为目标文件, 失败时清理未完成的分片"""
+        hdfs_client = self.hdfs_client
+        total_size = journal.get('size')
+        dest_dir, dest_name = os.path.split(dest_file)
+        parts = []
+        for index, offset in enumerate(xrange(0, total_size, BLOCK_SIZE)):
+            part_file = os.path.join(dest_dir, '.%s.%s._COPYING_' % (dest_name, index))
+            parts.append((part_file, offset, min(BLOCK_SIZE, total_size - offset)))
+
+        resumed = resume and journal.load()
+        concat_target = False
+        if self.exists(dest_file):
+            # 只有上次中断在rename与CONCAT之间时, 目标文件才是第一个分片
+            if not (resumed and journal.get('concat')):
+                self.err_msg = "File %s is exists" % dest_file
+                return False
+            if self.__stat(dest_file).length == total_size:
+                return True
+            concat_target = True
+
+        # 一次list确认记录中已完成的分片仍然完整
+        part_lengths = {}
+        if resumed:
+            try:
+                for file_status in hdfs_client.list_status(dest_dir):
+                    part_lengths[os.path.join(dest_dir, file_status.pathSuffix)] = file_status.length
+            except pyhdfs.HdfsFileNotFoundException:
+                pass
+        else:
+            journal.update(concat=False)
+        pending = [p for p in parts[1 if concat_target else 0:]
+                   if not (journal.is_done(p[1]) and part_lengths.get(p[0]) == p[2])]
+        if resumed:
+            log.warning("Resume put file %s, %s of %s parts left" % (dest_file, len(pending), len(parts)))
+            self.__progress_total(total_size, total_size - sum(p[2] for p in pending))
+
+        try:
+            if checksum:
+                for part_file, offset, length in parts:
+                    if (part_file, offset, length) not in pending:
+                        range_checksum = checksum.range(offset)
+                        ChecksumUtil.update_from_file(range_checksum, source_file, offset, length)
+                        range_checksum.close()
+            results = self.__run_parallel(lambda p: self.__create_part(source_file, journal, *p, checksum=checksum),
+                                          pending, parallel)
+            for res in results:
+                if isinstance(res, Exception):
+                    raise res
+                elif res is None:
+                    raise Exception("upload canceled after another part failed")
+
+            # 第一个分片作为合并目标, CONCAT会移除其余分片
+            if not concat_target:
+                journal.update(concat=True)
+                if not hdfs_client.rename(parts[0][0], dest_file):
+                    raise Exception("rename %s to %s failed" % (parts[0][0], dest_file))
+                concat_target = True
+            hdfs_client.concat(dest_file, [p[0] for p in parts[1:]])
+            return True
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when put file: %s" % err.message
+        except Exception, e:
+            self.err_msg = "Got error when put file: %s" % e
+
+        # 合并失败时把目标文件改回分片, 避免留下不完整的目标文件
+        if concat_target:
+            try:
+                if hdfs_client.rename(dest_file, parts[0][0]):
+                    journal.update(concat=False)
+            except Exception, e:
+                log.warning("Failed to rename %s back to %s: %s" % (dest_file, parts[0][0], e))
+        # 以--resume运行时已完成的分片保留给下次续传, 否则删除全部分片与断点记录
+        for part_file, offset, length in parts:
+            if resume and journal.is_done(offset):
+                continue
+            try:
+                hdfs_client.delete(part_file)
+            except Exception, e:
+                log.warning("Failed to clean up %s: %s" % (part_file, e))
+        if not resume:
+            journal.remove()
+        return False
+
+    def __create_part(self, source_file, journal, part_file, offset, length, checksum=None):
+        """上传一个分片, 块大小固定为BLOCK_SIZE以满足CONCAT要求"""
+        range_checksum = checksum.range(offset) if checksum else None
+        source = LocalFileRange(source_file, offset, length, range_checksum, self.buffer_pool.buffer_size)
+        try:
+            self.hdfs_client.create(part_file, self.__limit(source, length),
+                                    buffersize=self.buffer_pool.buffer_size, blocksize=BLOCK_SIZE,
+                                    overwrite=True)
+        finally:
+            source.close()
+        if range_checksum:
+            range_checksum.close()
+        journal.mark_done(offset)
+        return True
+
+    @StatsUtil.timed('get')
+    def get_to_local(self, source_file, dest, offset=0, parallel=1, resume=False, raw=False, verify=False):
+        """
+        下载文件到本地, parallel大于1时按区间并行下载, resume为True时按断点记录续传;
+        pyback压缩上传的文件默认解压后保存并去掉压缩后缀, raw为True时按原样下载;
+        verify为True时在下载的同时计算校验和, 完成后与hdfs的校验和比较
+        """
+        self.__clear_err_msg()
+        compress = manifest = None
+        if not raw and offset == 0:
+            try:
+                manifest = self.__read_dedup_manifest(source_file)
+                if manifest is None:
+                    compress = self.__detect_compress(source_file)
+            except pyhdfs.HdfsException, err:
+                self.err_msg = "Got hdfs error when get file: %s" % err.message
+                return False
+            except Exception, e:
+                self.err_msg = "Got error when get file: %s" % e
+                return False
+
         if os.path.isdir(dest):
             dest_dir = dest
-            dest_file = os.path.join(dest_dir, os.path.basename(source_file))
+            dest_name = os.path.basename(source_file)
+            if compress:
+                dest_name = CompressUtil.strip_suffix(dest_name, compress)
+            elif manifest:
+                dest_name = DedupUtil.strip_suffix(dest_name)
+            dest_file = os.path.join(dest_dir, dest_name)
         else:
             dest_file = dest
 
+        if manifest:
+            return self.__get_file_dedup(source_file, dest_file, manifest, parallel, resume)
+        if compress:
+            return self.__get_file_decompressed(source_file, dest_file, parallel, resume, verify)
+        return self.__get_file(source_file, dest_file, offset, parallel, resume, verify)
+
+    def __get_file_dedup(self, source_file, dest_file, manifest, parallel=1, resume=False):
+        """按manifest并行下载chunk, 按顺序写入本地文件, 失败时删除不完整的本地文件"""
+        self.__clear_err_msg()
+        if resume:
+            log.warning("Resume is not supported for dedup file %s, download it again" % source_file)
         try:
-            if os.path.exists(dest_file) and offset == 0:
-                self.err_msg = "Destination file is exists!"
-                return False
+            fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            self.err_msg = "Destination file is exists!" if os.path.exists(dest_file) else \
+                "Got error when get file: %s" % e
+            return False
+        res = False
+        self.__progress_total(manifest['size'])
+        try:
+            for data in self.__iter_dedup_chunks(manifest, parallel):
+                self.__write_all(fd, data, len(data))
+            os.fsync(fd)
+            res = True
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when get file: %s" % err.message
+        except Exception, e:
+            self.err_msg = "Got error when get file: %s" % e
+        finally:
+            os.close(fd)
+        if not res:
+            os.remove(dest_file)
+        return res
 
-            fsrc = hdfs_client.open(source_file, buffersize=BLOCK_SIZE, offset=offset)
-            fdst = open(dest_file, 'ab', buffering=BLOCK_SIZE)
-            shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
-            fdst.close()
-            return True
+    def __get_file_decompressed(self, source_file, dest_file, parallel=1, resume=False, verify=False):
+        """边下载边解压到本地文件, 解压后的数据无法按区间续传, 失败时删除不完整的本地文件"""
+        self.__clear_err_msg()
+        if resume:
+            log.warning("Resume is not supported for compressed file %s, download it again" % source_file)
+        try:
+            checksum = remote_checksum = None
+            if verify:
+                checksum, remote_checksum = self.__new_remote_checksum(source_file)
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got hdfs error when get file: %s" % err.message
             return False
-        except requests.packages.urllib3.exceptions.ProtocolError, e:
-            if "IncompleteRead" in str(e):
-                fdst.close()
-                local_size = SysUtil.get_file_size(dest_file, 'local')
-                log.warning("Got IncompleteRead when get file: %s, retry from offset %s" % (source_file, local_size))
-                return self.get_to_local(source_file, dest, local_size)
+        except Exception, e:
             self.err_msg = "Got error when get file: %s" % e
             return False
+        try:
+            fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            self.err_msg = "Destination file is exists!" if os.path.exists(dest_file) else \
+                "Got error when get file: %s" % e
+            return False
+        try:
+            res = self.cat(source_file, parallel=parallel, output_fd=fd, checksum=checksum)
+            if res:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        if not res:
+            self.err_msg = self.err_msg.replace("when cat file", "when get file")
+            os.remove(dest_file)
+        elif verify:
+            res = self.__verify(source_file, dest_file, checksum, remote_checksum=remote_checksum)
+        return res
+
+    def __get_file(self, source_file, dest_file, offset=0, parallel=1, resume=False, verify=False):
+        """下载hdfs文件到确定的本地路径"""
+        hdfs_client = self.hdfs_client
+        self.__clear_err_msg()
+        try:
+            file_status = self.__stat(source_file)
+            if file_status is None:
+                self.err_msg = "Source file is not exists: %s" % source_file
+                return False
+            total_size = file_status.length
+            journal = JournalUtil.Journal(dest_file, 'get', source_file, total_size, file_status.modificationTime,
+                                          self.journal_dir)
+            checksum = remote_checksum = None
+            if verify:
+                if offset:
+                    self.err_msg = "Can not verify a download starting from offset %s" % offset
+                    return False
+                checksum, remote_checksum = self.__new_remote_checksum(source_file, file_status)
+
+            self.__progress_total(total_size - offset)
+            resumed = False
+            if os.path.exists(dest_file) and offset == 0:
+                if not (resume and journal.load()):
+                    self.err_msg = "Destination file is exists!"
+                    return False
+                resumed = True
+
+            auto_parallel = parallel == TuneUtil.AUTO and total_size > BLOCK_SIZE
+            if resumed and journal.get('parallel') or not resumed and (parallel > 1 or auto_parallel) and offset == 0:
+                res = self.__get_to_local_parallel(source_file, dest_file, parallel, journal, resumed, checksum)
+            else:
+                if resumed:
+                    offset = journal.get('offset')
+                    log.warning("Resume get file %s from offset %s" % (source_file, offset))
+                    self.__progress_total(total_size, offset)
+                else:
+                    journal.update(parallel=False, offset=offset)
+                # 丢弃断点之后未确认的数据
+                fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT, 0644)
+                try:
+                    os.ftruncate(fd, offset)
+                finally:
+                    os.close(fd)
+                range_checksum = None
+                if checksum:
+                    range_checksum = checksum.range(0)
+                    ChecksumUtil.update_from_file(range_checksum, dest_file, 0, offset)
+                res = self.__get_range(source_file, dest_file, offset, total_size - offset, journal, True,
+                                       range_checksum)
+                if range_checksum:
+                    range_checksum.close()
+
+            if res:
+                journal.remove()
+            if res and verify:
+                res = self.__verify(source_file, dest_file, checksum, total_size, remote_checksum)
+            return res
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when get file: %s" % err.message
+            return False
         except Exception, e:
             self.err_msg = "Got error when get file: %s" % e
             return False
 
-    def cat(self, path, offset=0):
-        """返回文件句柄"""
+    def __get_to_local_parallel(self, source_file, dest_file, parallel, journal, resumed, checksum=None):
+        """按BLOCK_SIZE切分区间, 多线程各自写入预分配本地文件的对应位置"""
+        total_size = journal.get('size')
+        if not resumed:
+            # 预分配本地文件, 各区间直接写入自己的位置
+            fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            try:
+                os.ftruncate(fd, total_size)
+            finally:
+                os.close(fd)
+            journal.update(parallel=True)
+
+        ranges = []
+        for offset in xrange(0, total_size, BLOCK_SIZE):
+            length = min(BLOCK_SIZE, total_size - offset)
+            if not journal.is_done(offset):
+                ranges.append((offset, length))
+            elif checksum:
+                # 已完成的区间从本地文件计算校验和
+                range_checksum = checksum.range(offset)
+                ChecksumUtil.update_from_file(range_checksum, dest_file, offset, length)
+                range_checksum.close()
+        if resumed:
+            log.warning("Resume get file %s, %s ranges left" % (source_file, len(ranges)))
+            self.__progress_total(total_size, total_size - sum(r[1] for r in ranges))
+
+        def get_range(r):
+            range_checksum = checksum.range(r[0]) if checksum else None
+            res = self.__get_range(source_file, dest_file, r[0], r[1], journal, range_checksum=range_checksum)
+            if range_checksum:
+                range_checksum.close()
+            return res
+
+        results = self.__run_parallel(get_range, ranges, parallel)
+        for res in results:
+            if isinstance(res, Exception):
+                raise res
+        return True
+
+    def __run_parallel(self, func, items, parallel):
+        """并行执行分片或区间, parallel为TuneUtil.AUTO时按实测的总吞吐逐步增加线程数, 并报告选择的并行度"""
+        if parallel != TuneUtil.AUTO:
+            return SysUtil.run_in_threads(func, items, max(parallel, 1), stop_on_failure=True)
+        rate_limiter = self.rate_limiter
+        results, workers = TuneUtil.run_adaptive(func, items, lambda: rate_limiter.transferred,
+                                                 self.tuner.max_parallel, stop_on_failure=True)
+        self.tuner.parallel = workers
+        log.warning("Auto parallel: %s streams, %s/s per stream" %
+                    (workers, ProgressUtil.format_size(self.tuner.get_report()['stream_rate'])))
+        return results
+
+    def __get_range(self, source_file, dest_file, offset, length, journal, sequential=False, range_checksum=None):
+        """
+        下载文件的一个区间, 读取中断时从已写入位置单独重试; 数据读入缓冲区池中的缓冲区后直接写盘;
+        数据落盘后再记录断点, 顺序下载每个BLOCK_SIZE记录一次, 并行下载每个区间完成后记录
+        """
+        fd = os.open(dest_file, os.O_WRONLY)
+        buf = self.buffer_pool.get()
+        view = memoryview(buf)
+        sizer = self.tuner.new_sizer()
+        try:
+            done = 0
+            retry = 0
+            while done < length:
+                try:
+                    open_start = time.time()
+                    fsrc = self.hdfs_client.open(source_file, buffersize=len(buf),
+                                                 offset=offset + done, length=length - done)
+                    self.tuner.observe_latency(time.time() - open_start)
+                    while done < length:
+                        read_start = time.time()
+                        read_size = self.rate_limiter.get_read_size(sizer.next(min(len(buf), length - done)))
+                        size = fsrc.readinto(view[:read_size])
+                        if not size:
+                            break
+                        self.__transferred(size, read_start)
+                        write_start = time.time()
+                        SysUtil.pwrite(fd, view[:size], offset + done)
+                        self.__add_time('write_disk', write_start)
+                        if range_checksum:
+                            range_checksum.update(buf, size)
+                        block_index = (offset + done) // BLOCK_SIZE
+                        done += size
+                        retry = 0
+                        # 单次读取不超过一个缓冲区, 仍按BLOCK_SIZE记录断点
+                        if sequential and ((offset + done) // BLOCK_SIZE != block_index or done == length):
+                            sync_start = time.time()
+                            os.fsync(fd)
+                            self.__add_time('fsync', sync_start)
+                            journal.update(offset=offset + done)
+                    if done < length:
+                        raise requests.packages.urllib3.exceptions.ProtocolError("IncompleteRead")
+                except requests.packages.urllib3.exceptions.ProtocolError, e:
+                    retry += 1
+                    self.__count_retry()
+                    if retry > RANGE_RETRY:
+                        raise
+                    log.warning("Got %s when get file: %s, retry range from offset %s" % (e, source_file, offset + done))
+            if not sequential:
+                sync_start = time.time()
+                os.fsync(fd)
+                self.__add_time('fsync', sync_start)
+                journal.mark_done(offset)
+            return True
+        finally:
+            os.close(fd)
+            self.buffer_pool.put(buf)
+
+    @StatsUtil.timed('put_tree')
+    def put_tree(self, source_dir, dest_dir, workers=4, resume=False, verify=False):
+        """
+        递归上传本地目录, 只遍历一次目录树, 小文件优先交给线程池并发上传;
+        返回每个文件的(源文件, 目标文件, 是否成功, 错误信息)列表, 失败时返回None
+        """
+        self.__clear_err_msg()
+        try:
+            if self.exists(dest_dir) and self.is_dir(dest_dir):
+                dest_dir = os.path.join(dest_dir, os.path.basename(source_dir.rstrip('/')))
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when put dir: %s" % err.message
+            return None
+
+        files = []
+        empty_dirs = []
+        for root, dir_names, file_names in os.walk(source_dir):
+            remote_root = os.path.normpath(os.path.join(dest_dir, os.path.relpath(root, source_dir)))
+            if not dir_names and not file_names:
+                empty_dirs.append((root, remote_root))
+            for name in file_names:
+                if self.__is_state_file(name):
+                    continue
+                local_file = os.path.join(root, name)
+                try:
+                    size = os.path.getsize(local_file)
+                except OSError:
+                    size = 0
+                files.append((size, local_file, os.path.join(remote_root, name)))
+        files.sort()
+        self.__progress_total(sum(f[0] for f in files))
+
+        def put_one(item):
+            hdfs = self.__fork()
+            res = hdfs.__put_file(item[1], item[2], resume=resume, verify=verify)
+            return item[1], item[2], res, hdfs.err_msg
+
+        results = SysUtil.run_in_threads(put_one, files, workers)
+        # CREATE会自动创建父目录, 只需单独创建空目录
+        for local_dir, remote_dir in empty_dirs:
+            hdfs = self.__fork()
+            results.append((local_dir, remote_dir, hdfs.mkdir(remote_dir), hdfs.err_msg))
+        return results
+
+    @StatsUtil.timed('get_tree')
+    def get_tree(self, source_dir, dest_dir, workers=4, resume=False, verify=False):
+        """
+        递归下载hdfs目录, 只遍历一次目录树, 小文件优先交给线程池并发下载;
+        返回每个文件的(源文件, 目标文件, 是否成功, 错误信息)列表, 失败时返回None
+        """
+        self.__clear_err_msg()
+        if os.path.isdir(dest_dir):
+            dest_dir = os.path.join(dest_dir, os.path.basename(source_dir.rstrip('/')))
+
+        try:
+            files, empty_dirs = self.__walk(source_dir)
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when get dir: %s" % err.message
+            return None
+        files.sort()
+        self.__progress_total(sum(f[0] for f in files))
+
+        for rel_dir in set([os.path.dirname(f[1]) for f in files] + empty_dirs):
+            local_dir = os.path.join(dest_dir, rel_dir)
+            if not os.path.isdir(local_dir):
+                os.makedirs(local_dir)
+
+        def get_one(item):
+            hdfs = self.__fork()
+            source_file, dest_file = os.path.join(source_dir, item[1]), os.path.join(dest_dir, item[1])
+            res = hdfs.__get_file(source_file, dest_file, resume=resume, verify=verify)
+            return source_file, dest_file, res, hdfs.err_msg
+
+        return SysUtil.run_in_threads(get_one, files, workers)
+
+    def __walk(self, path):
+        """遍历hdfs目录, 返回所有文件的(大小, 相对路径)列表和空目录的相对路径列表"""
+        files = []
+        empty_dirs = []
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            list_status = self.hdfs_client.list_status(os.path.join(path, rel_dir))
+            self.__cache_list_status(os.path.join(path, rel_dir), list_status)
+            if not list_status:
+                empty_dirs.append(rel_dir)
+            for file_status in list_status:
+                rel_path = os.path.join(rel_dir, file_status.pathSuffix)
+                if file_status.type.upper() == "DIRECTORY":
+                    pending.append(rel_path)
+                else:
+                    files.append((file_status.length, rel_path))
+        return files, empty_dirs
+
+    @StatsUtil.timed('sync_tree')
+    def sync_tree(self, source_dir, dest_dir, index, workers=4):
+        """
+        增量同步本地目录的内容到hdfs目录: 只流式list一次hdfs目录树, 与本地索引记录的大小、mtime比较,
+        未变化的文件既不传输也不访问NameNode; 新文件与修改过的文件并发上传, 只在末尾增长的文件(如binlog)只追加新增部分;
+        返回传输的每个文件的(源文件, 目标文件, 是否成功, 错误信息)列表, 失败时返回None
+        """
+        self.__clear_err_msg()
+        if not os.path.isdir(source_dir):
+            self.err_msg = "Source dir %s is not exists" % source_dir
+            return None
+        index.load()
+        remote = {}
+        try:
+            for file_path, file_status in self.iter_path_status(dest_dir, recursive=True):
+                remote[os.path.relpath(file_path, dest_dir)] = file_status
+        except pyhdfs.HdfsFileNotFoundException:
+            pass
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when sync dir: %s" % err.message
+            return None
+        except Exception, e:
+            self.err_msg = "Got error when sync dir: %s" % e
+            return None
+
+        tasks = []
+        empty_dirs = []
+        seen = set()
+        counts = dict((action, 0) for action in (SyncUtil.SKIP, SyncUtil.PUT, SyncUtil.REPLACE, SyncUtil.APPEND))
+        for root, dir_names, file_names in os.walk(source_dir):
+            rel_root = os.path.normpath(os.path.relpath(root, source_dir))
+            if not dir_names and not file_names and rel_root != '.' and rel_root not in remote:
+                empty_dirs.append((root, os.path.join(dest_dir, rel_root)))
+            for name in file_names:
+                if self.__is_state_file(name):
+                    continue
+                rel_path = os.path.normpath(os.path.join(rel_root, name))
+                local_file = os.path.join(root, name)
+                try:
+                    st = os.stat(local_file)
+                except OSError:
+                    continue
+                seen.add(rel_path)
+                mtime = int(st.st_mtime)
+                action, offset = SyncUtil.plan(index.get(rel_path), st.st_size, mtime, remote.get(rel_path))
+                counts[action] += 1
+                if action == SyncUtil.SKIP:
+                    if index.get(rel_path) is None:
+                        index.update(rel_path, st.st_size, mtime)
+                    continue
+                tasks.append((st.st_size - offset, action, offset, st.st_size, mtime, rel_path, local_file))
+        log.warning("Sync %s -> %s: %s unchanged, %s new, %s changed, %s appended" % (
+            source_dir, dest_dir, counts[SyncUtil.SKIP], counts[SyncUtil.PUT], counts[SyncUtil.REPLACE],
+            counts[SyncUtil.APPEND]))
+        tasks.sort()
+        self.__progress_total(sum(t[0] for t in tasks))
+
+        def sync_one(task):
+            length, action, offset, size, mtime, rel_path, local_file = task
+            hdfs = self.__fork()
+            dest_file = os.path.join(dest_dir, rel_path)
+            hash_value = hdfs.__sync_file(local_file, dest_file, action, offset, size, index.get(rel_path))
+            if hash_value is not None:
+                index.update(rel_path, size, mtime, hash_value)
+            return local_file, dest_file, hash_value is not None, hdfs.err_msg
+
+        try:
+            results = SysUtil.run_in_threads(sync_one, tasks, workers)
+            for local_dir, remote_dir in empty_dirs:
+                hdfs = self.__fork()
+                results.append((local_dir, remote_dir, hdfs.mkdir(remote_dir), hdfs.err_msg))
+        finally:
+            index.retain(seen)
+            index.save()
+        return results
+
+    def __sync_file(self, local_file, dest_file, action, offset, size, entry):
+        """
+        按plan给出的动作同步一个文件的前size字节, 成功时返回已同步部分的抽样哈希, 失败时返回None;
+        追加前确认已同步部分的抽样哈希未变, 否则改为整个文件重新上传; 重新上传先写临时文件, 完成后替换原文件
+        """
+        self.__clear_err_msg()
+        hdfs_client = self.hdfs_client
+        try:
+            hash_value = SyncUtil.sample_hash(local_file, size)
+            if hash_value is None:
+                self.err_msg = "File %s is truncated while syncing" % local_file
+                return None
+            if action == SyncUtil.APPEND and SyncUtil.sample_hash(local_file, offset) != entry[2]:
+                log.warning("%s is changed before offset %s, upload the whole file" % (local_file, offset))
+                action, offset = SyncUtil.REPLACE, 0
+            if action == SyncUtil.REPLACE:
+                tmp_file = dest_file + SyncUtil.TMP_SUFFIX
+                self.__upload_range(local_file, tmp_file, 0, size, overwrite=True)
+                hdfs_client.delete(dest_file)
+                if not hdfs_client.rename(tmp_file, dest_file):
+                    self.err_msg = "Failed to move %s to %s" % (tmp_file, dest_file)
+                    return None
+            elif action == SyncUtil.APPEND:
+                self.__upload_range(local_file, dest_file, offset, size - offset)
+            else:
+                self.__upload_range(local_file, dest_file, 0, size, overwrite=True)
+            return hash_value
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when sync file: %s" % err.message
+            return None
+        except Exception, e:
+            self.err_msg = "Got error when sync file: %s" % e
+            return None
+        finally:
+            self.__invalidate(dest_file)
+
+    def __upload_range(self, local_file, dest_file, offset, length, overwrite=False):
+        """
+        上传本地文件[offset, offset + length)的数据, offset为0时CREATE文件, 否则APPEND到已有文件末尾;
+        按BLOCK_SIZE分段, 每段一次请求
+        """
         hdfs_client = self.hdfs_client
+        end = offset + length
+        created = offset > 0
+        while not created or offset < end:
+            size = min(BLOCK_SIZE, end - offset)
+            source = LocalFileRange(local_file, offset, size, window=self.buffer_pool.buffer_size)
+            reader = self.__limit(source, size)
+            try:
+                if created:
+                    hdfs_client.append(dest_file, reader, buffersize=self.buffer_pool.buffer_size)
+                else:
+                    hdfs_client.create(dest_file, reader, overwrite=overwrite, buffersize=self.buffer_pool.buffer_size)
+                    created = True
+            finally:
+                source.close()
+            offset += size
 
+    def open_reader(self, path, block_size=ReaderUtil.READ_BLOCK_SIZE, cache_blocks=ReaderUtil.CACHE_BLOCKS,
+                    read_ahead=ReaderUtil.READ_AHEAD_BLOCKS):
+        """
+        返回hdfs文件的随机读取对象ReaderUtil.HdfsReader, 只按需读取访问到的块, 读取的是原始数据, 不解压;
+        路径不存在或不是文件时返回None, 读取失败时读取方法抛出IOError
+        """
         self.__clear_err_msg()
-        total_size = 0
-        push_size = offset if offset else 0
         try:
-            if self.is_file(path):
-                total_size = self.get_size(path)
+            file_status = self.__stat(path)
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when open file: %s" % err.message
+            return None
+        if file_status is None or file_status.type.upper() != "FILE":
+            self.err_msg = "Destination path is not a file: %s" % path
+            return None
+        hdfs = self.__fork()
+
+        def fetch(offset, length):
+            return hdfs.__read_exact(path, offset, length)
+
+        return ReaderUtil.HdfsReader(path, file_status.length, fetch, block_size, cache_blocks, read_ahead)
+
+    def __read_exact(self, path, offset, length):
+        """用带长度的OPEN读取[offset, offset + length)的数据, 读取中断时从已读出的位置重新打开"""
+        buf = bytearray(length)
+        view = memoryview(buf)
+        done = 0
+        retry = 0
+        fsrc = None
+        while done < length:
+            error = None
+            try:
+                if fsrc is None:
+                    open_start = time.time()
+                    fsrc = self.hdfs_client.open(path, buffersize=self.buffer_pool.buffer_size, offset=offset + done,
+                                                 length=length - done)
+                    self.tuner.observe_latency(time.time() - open_start)
+                read_start = time.time()
+                size = fsrc.readinto(view[done:done + self.rate_limiter.get_read_size(length - done)])
+            except requests.packages.urllib3.exceptions.ProtocolError, e:
+                size = 0
+                error = e
+            if size:
+                self.__transferred(size, read_start)
+                done += size
+                retry = 0
+                continue
+            fsrc = None
+            retry += 1
+            self.__count_retry()
+            if retry > RANGE_RETRY:
+                raise error or requests.packages.urllib3.exceptions.ProtocolError("IncompleteRead")
+            log.warning("Got %s when read file: %s, retry from offset %s" % (error or "IncompleteRead", path,
+                                                                             offset + done))
+        return buf
+
+    @StatsUtil.timed('cat')
+    def cat(self, path, offset=0, parallel=1, output_fd=None, raw=False, checksum=None, length=None):
+        """
+        输出文件内容到标准输出; 读线程把数据读入复用的缓冲区放入有界队列, 主线程同时写出,
+        网络读取与管道写入重叠; parallel大于1时多个区间读线程预读后续区间;
+        pyback压缩上传的文件默认解压后输出, raw为True时输出原始数据; checksum不为空时计算读出的原始数据的校验和;
+        offset为负数时从文件末尾倒数, length不为空时只输出length字节; 指定了区间时输出原始数据
+        """
+        self.__clear_err_msg()
+        if output_fd is None:
+            sys.stdout.flush()
+            output_fd = sys.stdout.fileno()
 
-            fsrc = hdfs_client.open(path, buffersize=BLOCK_SIZE, offset=offset)
-            while push_size < total_size:
-                read_data = fsrc.read(BLOCK_SIZE)
-                sys.stdout.write(read_data)
-                push_size += len(read_data)
+        stop = threading.Event()
+        try:
+            file_status = self.__stat(path)
+            if file_status is None or file_status.type.upper() != "FILE":
+                self.err_msg = "Destination path is not a file: %s" % path
+                return False
+            total_size = file_status.length
+            partial = offset != 0 or length is not None
+            if offset < 0:
+                offset = max(0, total_size + offset)
+            end = total_size if length is None else min(total_size, offset + length)
+            decompressor = None
+            if not raw and not partial:
+                manifest = self.__read_dedup_manifest(path)
+                if manifest:
+                    self.__progress_total(manifest['size'])
+                    for data in self.__iter_dedup_chunks(manifest, parallel):
+                        self.__write_all(output_fd, data, len(data))
+                    return True
+                compress = self.__detect_compress(path)
+                if compress:
+                    decompressor = CompressUtil.Decompressor(compress)
+
+            self.__progress_total(max(0, end - offset))
+            # 按BLOCK_SIZE切分区间, 第i个区间由第i % parallel个读线程负责, 主线程按顺序消费
+            ranges = [(start, min(BLOCK_SIZE, end - start)) for start in xrange(offset, end, BLOCK_SIZE)]
+            readers = []
+            readers_num = max(1, min(parallel, len(ranges)))
+            for index in range(readers_num):
+                free = Queue.Queue()
+                for i in range(CAT_BUFFER_COUNT):
+                    free.put(bytearray(CAT_BUFFER_SIZE))
+                filled = Queue.Queue()
+                thread = threading.Thread(target=self.__read_ranges,
+                                          args=(path, ranges[index::readers_num], free, filled, stop, checksum))
+                thread.daemon = True
+                thread.start()
+                readers.append((free, filled))
+
+            for index in range(len(ranges)):
+                free, filled = readers[index % readers_num]
+                while True:
+                    item = filled.get()
+                    if item is None:
+                        break
+                    elif isinstance(item, Exception):
+                        raise item
+                    buf, size = item
+                    if decompressor:
+                        data = decompressor.decompress(buffer(buf, 0, size))
+                        free.put(buf)
+                        self.__write_all(output_fd, data, len(data))
+                    else:
+                        self.__write_all(output_fd, buf, size)
+                        free.put(buf)
             return True
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got hdfs error when cat file: %s" % err.message
             return False
-        except requests.packages.urllib3.exceptions.ProtocolError, e:
-            if "IncompleteRead" in str(e):
-                log.warning("Got IncompleteRead when get file: %s, retry from offset %s" % (path, push_size))
-                return self.get_to_local(path, push_size)
+        except Exception, e:
             self.err_msg = "Got error when cat file: %s" % e
             return False
+        finally:
+            stop.set()
+
+    def __write_all(self, fd, data, size):
+        write_start = time.time()
+        view = memoryview(data)
+        written = 0
+        while written < size:
+            written += os.write(fd, view[written:size])
+        self.__add_time('write_output', write_start)
+
+    def __read_dedup_manifest(self, path):
+        """带去重后缀的文件读取并解析manifest, 不是pyback的manifest时返回None"""
+        if not path.endswith(DedupUtil.MANIFEST_SUFFIX):
+            return None
+        file_status = self.__stat(path)
+        if file_status is None or file_status.type.upper() != "FILE" or file_status.length > DedupUtil.MANIFEST_MAX_SIZE:
+            return None
+        return DedupUtil.parse_manifest(self.hdfs_client.open(path).read())
+
+    def __iter_dedup_chunks(self, manifest, parallel=1):
+        """按顺序返回manifest中每个chunk的数据, 多个线程预取后续chunk, 预取数量有界"""
+        chunks = manifest['chunks']
+        workers = parallel if parallel > 1 else DedupUtil.FETCH_WORKERS
+        tasks = Queue.Queue()
+        slots = [[threading.Event(), None, None] for i in range(len(chunks))]
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                index = tasks.get()
+                if index is None:
+                    return
+                slot = slots[index]
+                try:
+                    slot[1] = self.__fetch_chunk(manifest['chunk_dir'], *chunks[index])
+                except Exception, e:
+                    slot[2] = e
+                slot[0].set()
+
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        window = workers * 2
+        try:
+            for index in range(min(window, len(chunks))):
+                tasks.put(index)
+            for index in range(len(chunks)):
+                slot = slots[index]
+                while not slot[0].wait(1):
+                    pass
+                if slot[2] is not None:
+                    raise slot[2]
+                data, slot[1] = slot[1], None
+                if index + window < len(chunks):
+                    tasks.put(index + window)
+                yield data
+        finally:
+            stop.set()
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+
+    def __fetch_chunk(self, chunk_dir, digest, size):
+        """下载一个chunk并校验长度和哈希, 读取中断时重试"""
+        chunk_file = DedupUtil.chunk_path(chunk_dir, digest)
+        retry = 0
+        while True:
+            try:
+                fsrc = self.hdfs_client.open(chunk_file, buffersize=CAT_BUFFER_SIZE)
+                pieces = []
+                while True:
+                    read_start = time.time()
+                    piece = fsrc.read(self.rate_limiter.get_read_size(CAT_BUFFER_SIZE))
+                    if not piece:
+                        break
+                    self.__transferred(len(piece), read_start)
+                    pieces.append(piece)
+                data = ''.join(pieces)
+                if len(data) != size:
+                    raise requests.packages.urllib3.exceptions.ProtocolError("IncompleteRead")
+                break
+            except requests.packages.urllib3.exceptions.ProtocolError, e:
+                retry += 1
+                self.__count_retry()
+                if retry > RANGE_RETRY:
+                    raise
+                log.warning("Got %s when get chunk: %s, retry" % (e, chunk_file))
+        if DedupUtil.get_digest(data) != digest:
+            raise Exception("Chunk %s is corrupted" % chunk_file)
+        return data
+
+    def __detect_compress(self, path):
+        """
+        带压缩后缀的文件读取文件头, 按pyback写入的标记判断是否是pyback压缩上传的, 返回压缩方式;
+        压缩上传总是补上压缩后缀, 其他文件不读取文件头, 不增加一次OPEN请求
+        """
+        if not CompressUtil.has_suffix(path):
+            return None
+        file_status = self.__stat(path)
+        if file_status is None or file_status.type.upper() != "FILE" or file_status.length == 0:
+            return None
+        length = min(CompressUtil.HEADER_SIZE, file_status.length)
+        retry = 0
+        while True:
+            try:
+                header = self.hdfs_client.open(path, offset=0, length=length).read()
+                if len(header) != length:
+                    raise requests.packages.urllib3.exceptions.ProtocolError("IncompleteRead")
+                break
+            except requests.packages.urllib3.exceptions.ProtocolError, e:
+                retry += 1
+                self.__count_retry()
+                if retry > RANGE_RETRY:
+                    raise
+                log.warning("Got %s when read header: %s, retry" % (e, path))
+        compress = CompressUtil.detect(header)
+        if compress:
+            # 确认本机可以解压
+            CompressUtil.check_method(compress)
+        return compress
+
+    def __read_ranges(self, path, ranges, free, filled, stop, checksum=None):
+        """读线程, 依次读取分配的区间, 每个区间结束时放入None, 出错时放入异常"""
+        try:
+            for offset, length in ranges:
+                range_checksum = checksum.range(offset) if checksum else None
+                self.__read_range(path, offset, length, free, filled, stop, range_checksum)
+                if range_checksum:
+                    range_checksum.close()
+                filled.put(None)
         except Exception, e:
-            self.err_msg = "Got error when cat file: %s" % e
+            filled.put(e)
+
+    def __read_range(self, path, offset, length, free, filled, stop, range_checksum=None):
+        """
+        把一个区间读入空闲缓冲区, 读取中断时从已读出的准确偏移处重新打开;
+        每个缓冲区填充的数据量从小到大增加, 第一段数据尽快交给输出
+        """
+        sizer = self.tuner.new_sizer()
+        done = 0
+        retry = 0
+        fsrc = None
+        while done < length:
+            buf = None
+            while buf is None:
+                if stop.is_set():
+                    return
+                try:
+                    buf = free.get(timeout=1)
+                except Queue.Empty:
+                    continue
+
+            want = sizer.next(min(len(buf), length - done))
+            view = memoryview(buf)
+            size = 0
+            error = None
+            try:
+                if fsrc is None:
+                    open_start = time.time()
+                    fsrc = self.hdfs_client.open(path, buffersize=CAT_BUFFER_SIZE, offset=offset + done,
+                                                 length=length - done)
+                    self.tuner.observe_latency(time.time() - open_start)
+                while size < want:
+                    read_start = time.time()
+                    read_size = fsrc.readinto(view[size:size + self.rate_limiter.get_read_size(want - size)])
+                    if not read_size:
+                        break
+                    self.__transferred(read_size, read_start)
+                    size += read_size
+            except requests.packages.urllib3.exceptions.ProtocolError, e:
+                error = e
+            except Exception:
+                free.put(buf)
+                raise
+
+            if size:
+                if range_checksum:
+                    range_checksum.update(buf, size)
+                filled.put((buf, size))
+                done += size
+                retry = 0
+            else:
+                free.put(buf)
+            if size < want:
+                fsrc = None
+                retry += 1
+                self.__count_retry()
+                if retry > RANGE_RETRY:
+                    raise error or requests.packages.urllib3.exceptions.ProtocolError("IncompleteRead")
+                log.warning("Got %s when cat file: %s, retry from offset %s" %
+                            (error or "IncompleteRead", path, offset + done))
+
+    def __limit(self, source, length=None):
+        """包装上传数据源, 数据被读取时限速并计入进度, 开启统计时记录读取源数据的耗时"""
+        if self.stats:
+            if isinstance(source, str):
+                length = len(source)
+            source = StatsUtil.TimedReader(source, self.stats)
+        return RateUtil.LimitedReader(source, self.rate_limiter, length, self.progress)
+
+    def __transferred(self, size, read_start=None):
+        """下载循环每读到一段数据调用一次, 限速并计入进度, read_start为这次读取开始的时间"""
+        stats = self.stats
+        now = time.time()
+        if read_start:
+            self.tuner.observe_read(size, now - read_start)
+        if stats:
+            if read_start:
+                stats.add_time('read_network', now - read_start)
+            stats.incr('bytes_received', size)
+        self.rate_limiter.consume(size)
+        if stats and self.rate_limiter.rate:
+            stats.add_time('throttle', time.time() - now)
+        if self.progress:
+            self.progress.add(size)
+
+    def __add_time(self, phase, start):
+        if self.stats:
+            self.stats.add_time(phase, time.time() - start)
+
+    def __count_retry(self):
+        if self.stats:
+            self.stats.incr('range_retries')
+
+    def __progress_total(self, size, skipped=0):
+        """设置进度的总字节数, skipped为续传时已完成的字节数"""
+        if self.progress:
+            self.progress.set_total(size)
+            if skipped:
+                self.progress.skip(skipped)
+
+    def __new_checksum(self, block_size):
+        """按配置的hdfs校验参数创建本地校验和"""
+        return ChecksumUtil.FileChecksum(block_size, self.bytes_per_checksum, self.checksum_type)
+
+    def __new_remote_checksum(self, path, file_status=None):
+        """先取得hdfs文件的校验和, 按其算法参数创建本地校验和, 返回(本地校验和, hdfs校验和)"""
+        if file_status is None:
+            file_status = self.__stat(path)
+        remote = self.hdfs_client.get_file_checksum(path)
+        remote_checksum = (remote.algorithm, remote.bytes)
+        if file_status.length == 0:
+            return ChecksumUtil.FileChecksum(file_status.blockSize or BLOCK_SIZE), remote_checksum
+        bytes_per_crc, crc_type = ChecksumUtil.parse_algorithm(remote.algorithm)
+        return ChecksumUtil.FileChecksum(file_status.blockSize, bytes_per_crc, crc_type), remote_checksum
+
+    def __verify(self, remote_file, local_file, checksum, size=None, remote_checksum=None):
+        """比较本地计算的校验和与hdfs的校验和, 有本地文件时把结果写入其旁边的清单"""
+        hdfs_client = self.hdfs_client
+        try:
+            file_status = hdfs_client.get_file_status(remote_file)
+            if size is not None and file_status.length != size:
+                self.err_msg = "Verify failed for %s: length %s, expect %s" % (remote_file, file_status.length, size)
+                return False
+            if file_status.length and file_status.blockSize != checksum.block_size:
+                self.err_msg = "Can not verify %s: block size %s differs from %s" % \
+                               (remote_file, file_status.blockSize, checksum.block_size)
+                return False
+            if remote_checksum is None:
+                remote = hdfs_client.get_file_checksum(remote_file)
+                remote_checksum = (remote.algorithm, remote.bytes)
+            local_checksum = checksum.get_checksum(file_status.length)
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when verify file: %s" % err.message
+            return False
+        except Exception, e:
+            self.err_msg = "Got error when verify file: %s" % e
+            return False
+
+        verified = ChecksumUtil.is_match(local_checksum, remote_checksum)
+        if local_file:
+            ChecksumUtil.write_manifest(local_file, remote_file, file_status.length, local_checksum, remote_checksum,
+                                        verified)
+        if not verified:
+            self.err_msg = "Checksum mismatch for %s: local %s %s, hdfs %s %s" % \
+                           ((remote_file, ) + local_checksum + remote_checksum)
             return False
+        log.warning("Verified %s: %s %s" % (remote_file, local_checksum[0], local_checksum[1][-32:]))
+        self.last_checksum = '%s:%s' % remote_checksum
+        return True
 
     def move(self, source, dest):
         """移动文件"""
-        hdfs_client = self.hdfs_client
-        if self.exists(dest) and self.is_dir(dest):
-            dest = os.path.join(dest, os.path.basename(source))
+        self.__clear_err_msg()
+        try:
+            if self.exists(dest) and self.is_dir(dest):
+                dest = os.path.join(dest, os.path.basename(source))
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when move file : %s" % err.message
+            return False
+        return self.__rename(source, dest)
+
+    def move_paths(self, sources, dest_dir, workers=WALK_WORKERS):
+        """
+        批量移动到已存在的目录下, 支持通配符; 目标目录只查询一次, rename由线程池并发执行;
+        返回每个路径的(源路径, 目标路径, 是否成功, 错误信息)列表, 目标不是目录时返回None
+        """
+        self.__clear_err_msg()
+        try:
+            if not self.is_dir(dest_dir):
+                self.err_msg = "Destination path is not a directory: %s" % dest_dir
+                return None
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when move file : %s" % err.message
+            return None
+        sources, results = self.__expand_paths(sources)
+
+        def move_one(source):
+            hdfs = self.__fork()
+            dest = os.path.join(dest_dir, os.path.basename(source))
+            return source, dest, hdfs.__rename(source, dest), hdfs.err_msg
+
+        return results + SysUtil.run_in_threads(move_one, sources, workers)
 
+    def __rename(self, source, dest):
+        """rename返回false时再查询源路径, 区分源路径不存在与其他原因"""
         self.__clear_err_msg()
         try:
-            return hdfs_client.rename(source, dest)
+            if self.hdfs_client.rename(source, dest):
+                return True
+            if self.__stat(source) is None:
+                self.err_msg = "Destination path is not exist: %s" % source
+            else:
+                self.err_msg = "Failed to move %s to %s" % (source, dest)
+            return False
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got hdfs error when move file : %s" % err.message
             return False
         except Exception, e:
-            self.err_msg = "Got error when get file: %s" % e
+            self.err_msg = "Got error when move file: %s" % e
             return False
+        finally:
+            self.__invalidate(source, recursive=True)
+            self.__invalidate(dest, recursive=True)
 
     def mkdir(self, path):
         """创建目录"""
@@ -173,10 +1563,10 @@ class HDFS:
                 elif self.is_file(path):
                     self.err_msg = "Destination path is file: %s" % path
                     return False
-                else:
-                    return hdfs_client.mkdirs(path)
-            else:
+            try:
                 return hdfs_client.mkdirs(path)
+            finally:
+                self.__invalidate(path)
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got hdfs error when mkdir dir: %s" % err.message
             return False
@@ -184,6 +1574,35 @@ class HDFS:
             self.err_msg = "Got error when mkdir dir: %s" % e
             return False
 
+    def mkdir_paths(self, paths, workers=WALK_WORKERS):
+        """
+        批量创建目录, 由线程池并发执行; 不预先查询路径状态, MKDIRS对已存在的目录同样返回成功;
+        返回每个路径的(路径, 路径, 是否成功, 错误信息)列表
+        """
+        self.__clear_err_msg()
+
+        def mkdir_one(path):
+            hdfs = self.__fork()
+            return path, path, hdfs.__mkdirs(path), hdfs.err_msg
+
+        return SysUtil.run_in_threads(mkdir_one, self.__unique_paths(paths), workers)
+
+    def __mkdirs(self, path):
+        self.__clear_err_msg()
+        try:
+            if self.hdfs_client.mkdirs(path):
+                return True
+            self.err_msg = "Failed to mkdir dir: %s" % path
+            return False
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when mkdir dir: %s" % err.message
+            return False
+        except Exception, e:
+            self.err_msg = "Got error when mkdir dir: %s" % e
+            return False
+        finally:
+            self.__invalidate(path)
+
     def delete(self, path):
         """删除文件"""
         self.__clear_err_msg()
@@ -192,48 +1611,182 @@ class HDFS:
             if not self.exists(path):
                 self.err_msg = "Destination path is not exist: %s" % path
                 return False
-
-            trash_dir = os.path.join('/user', self.hdfs_user, '.Trash/Current') + os.path.dirname(path)
-            trash_file = os.path.join(trash_dir, os.path.basename(path))
-            self.mkdir(trash_dir)
-            if self.exists(trash_file):
-                suffix = 1
-                while True:
-                    tmp_file = "%s.%s" % (trash_file, suffix)
-                    if self.exists(tmp_file):
-                        suffix += 1
-                        continue
-                    else:
-                        trash_file = tmp_file
-                        break
-            return self.move(path, trash_file)
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got hdfs error when delete path: %s" % err.message
             return False
-        except Exception, e:
-            self.err_msg = "Got error when delete path: %s" % e
-            return False
+        path, trash_file, res, err_msg = self.__move_to_trash([os.path.normpath(path)], 1)[0]
+        self.err_msg = err_msg
+        return res
+
+    def delete_paths(self, paths, workers=WALK_WORKERS):
+        """
+        批量删除(移动到回收站), 支持通配符; 每个回收站目录只创建一次, 同一目录下的多个路径按一次list的结果
+        选择不重名的后缀, rename由线程池并发执行; 返回每个路径的(路径, 回收站路径, 是否成功, 错误信息)列表
+        """
+        self.__clear_err_msg()
+        paths, results = self.__expand_paths(paths)
+        return results + self.__move_to_trash(paths, workers)
+
+    def __move_to_trash(self, paths, workers):
+        """按回收站目录分组准备目标路径, 再并发rename"""
+        trash_root = os.path.join('/user', self.hdfs_user, '.Trash/Current')
+        groups = {}
+        for path in paths:
+            groups.setdefault(trash_root + os.path.dirname(path), []).append(path)
+
+        def prepare(item):
+            hdfs = self.__fork()
+            trash_dir, group = item
+            try:
+                return hdfs.__trash_files(trash_dir, group), []
+            except pyhdfs.HdfsException, err:
+                err_msg = "Got hdfs error when delete path: %s" % err.message
+            except Exception, e:
+                err_msg = "Got error when delete path: %s" % e
+            return [], [(path, None, False, err_msg) for path in group]
+
+        def rename_one(item):
+            hdfs = self.__fork()
+            path, trash_file = item
+            return path, trash_file, hdfs.__rename(path, trash_file), hdfs.err_msg
+
+        renames = []
+        results = []
+        for group_renames, group_results in SysUtil.run_in_threads(prepare, groups.items(), workers):
+            renames += group_renames
+            results += group_results
+        return results + SysUtil.run_in_threads(rename_one, renames, workers)
+
+    def __trash_files(self, trash_dir, paths):
+        """
+        创建回收站目录并为每个路径选择回收站中的路径, 重名时依次加后缀.1 .2 ...;
+        只有一个路径时逐个查询候选路径, 多个路径时list一次回收站目录, 避免逐个查询
+        """
+        try:
+            if not self.hdfs_client.mkdirs(trash_dir):
+                raise Exception("Failed to mkdir trash dir: %s" % trash_dir)
+        finally:
+            self.__invalidate(trash_dir)
+        if len(paths) > 1:
+            names = set(file_status.pathSuffix for file_status in self.__iter_list_status(trash_dir))
+            taken = lambda trash_file: os.path.basename(trash_file) in names
+        else:
+            names = set()
+            taken = self.exists
+
+        renames = []
+        for path in paths:
+            trash_file = os.path.join(trash_dir, os.path.basename(path))
+            suffix = 1
+            while taken(trash_file):
+                trash_file = "%s.%s" % (os.path.join(trash_dir, os.path.basename(path)), suffix)
+                suffix += 1
+            names.add(os.path.basename(trash_file))
+            renames.append((path, trash_file))
+        return renames
+
+    def __expand_paths(self, paths):
+        """
+        展开批量操作的路径中的通配符并去掉重复的路径, 返回(路径列表, 没有匹配的通配符的结果列表);
+        不含通配符的路径原样保留, 是否存在由之后的操作判断
+        """
+        expanded = []
+        results = []
+        for path in paths:
+            if not self.__has_magic(path):
+                expanded.append(path)
+                continue
+            try:
+                matches = [match_path for match_path, file_status in self.__iter_glob(path)]
+            except pyhdfs.HdfsException, err:
+                results.append((path, None, False, "Got hdfs error when expand path: %s" % err.message))
+                continue
+            if not matches:
+                results.append((path, None, False, "Destination path is not exist: %s" % path))
+            expanded += matches
+        return self.__unique_paths(expanded), results
+
+    def __unique_paths(self, paths):
+        unique = []
+        seen = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            if path not in seen:
+                seen.add(path)
+                unique.append(path)
+        return unique
 
     def get_size(self, path):
         """获取文件或目录大小"""
+        summary = self.get_content_summary(path)
+        if summary is None:
+            return None
+
+        return summary['length']
+
+    def get_content_summary(self, path, workers=WALK_WORKERS):
+        """
+        获取文件或目录的汇总信息(length, fileCount, directoryCount, spaceConsumed),
+        优先用GETCONTENTSUMMARY一次取得, 不支持该操作时并发逐层遍历目录, 其他错误直接返回
+        """
         self.__clear_err_msg()
 
-        size = 0
-        if not self.exists(path):
+        try:
+            summary = self.hdfs_client.get_content_summary(path)
+            return {
+                'length': summary.length,
+                'fileCount': summary.fileCount,
+                'directoryCount': summary.directoryCount,
+                'spaceConsumed': summary.spaceConsumed,
+            }
+        except pyhdfs.HdfsFileNotFoundException:
             self.err_msg = "Destination file is not exists!"
             return None
+        except (pyhdfs.HdfsIllegalArgumentException, pyhdfs.HdfsUnsupportedOperationException), err:
+            log.debug("GETCONTENTSUMMARY is not supported on %s, walk the tree instead: %s" % (path, err.message))
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got error when get content summary: %s" % err.message
+            return None
 
-        list_status = self.__get_list_status(path)
-        if list_status is not None:
-            for file_status in list_status:
-                if file_status.type.upper() == "FILE":
-                    size += file_status.length
-                elif file_status.type.upper() == "DIRECTORY":
-                    size += self.get_size(os.path.join(path, file_status.pathSuffix))
-            return size
-        else:
+        try:
+            return self.__walk_summary(path, workers)
+        except pyhdfs.HdfsFileNotFoundException:
+            self.err_msg = "Destination file is not exists!"
+            return None
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got error when get file status: %s" % err.message
             return None
 
+    def __walk_summary(self, path, workers):
+        """按层并发list目录, 统计汇总信息"""
+        summary = {'length': 0, 'fileCount': 0, 'directoryCount': 0, 'spaceConsumed': 0}
+        level = [path]
+        while level:
+            results = SysUtil.run_in_threads(self.hdfs_client.list_status, level, workers)
+            next_level = []
+            for dir_path, list_status in zip(level, results):
+                if isinstance(list_status, Exception):
+                    raise list_status
+                # 对文件list_status返回它自己, pathSuffix为空
+                if len(list_status) == 1 and not list_status[0].pathSuffix and \
+                        list_status[0].type.upper() == "FILE":
+                    file_status = list_status[0]
+                    summary['fileCount'] += 1
+                    summary['length'] += file_status.length
+                    summary['spaceConsumed'] += file_status.length * file_status.replication
+                    continue
+
+                summary['directoryCount'] += 1
+                for file_status in list_status:
+                    if file_status.type.upper() == "DIRECTORY":
+                        next_level.append(os.path.join(dir_path, file_status.pathSuffix))
+                    elif file_status.type.upper() == "FILE":
+                        summary['fileCount'] += 1
+                        summary['length'] += file_status.length
+                        summary['spaceConsumed'] += file_status.length * file_status.replication
+            level = next_level
+        return summary
+
     def get_path_status(self, path):
         """获取hdfs状态, list格式, 如果path是目录返回目录内文件状态"""
         self.__clear_err_msg()
@@ -243,12 +1796,166 @@ class HDFS:
             self.err_msg = "Destination file is not exists!"
             return None
 
-    def __get_file_status(self, path):
-        """获取单个hdfs文件状态"""
+    def iter_path_status(self, path, recursive=False, workers=WALK_WORKERS):
+        """
+        流式获取hdfs状态, 逐条返回(完整路径, 文件状态); path是目录时返回目录内文件状态,
+        支持通配符, recursive为True时并发展开子目录
+        """
+        if self.__has_magic(path):
+            paths = [p for p, file_status in self.__iter_glob(path)]
+        else:
+            paths = [path]
+
+        for match_path in paths:
+            if recursive:
+                status_iter = self.__iter_tree_status(match_path, workers)
+            else:
+                status_iter = ((self.__join_suffix(match_path, file_status), file_status)
+                               for file_status in self.__iter_list_status(match_path))
+            for item in status_iter:
+                yield item
+
+    def __iter_list_status(self, path):
+        """用LISTSTATUS_BATCH分页list目录, 逐条返回文件状态; 集群不支持分页时退回LISTSTATUS"""
+        if not self.list_batch_supported:
+            for file_status in self.hdfs_client.list_status(path):
+                yield file_status
+            return
+
+        start_after = None
+        while True:
+            kwargs = {'startAfter': start_after} if start_after else {}
+            try:
+                response = self.hdfs_client._get(path, 'LISTSTATUS_BATCH', **kwargs)
+            except (pyhdfs.HdfsIllegalArgumentException, pyhdfs.HdfsUnsupportedOperationException), err:
+                if start_after:
+                    raise
+                log.debug("LISTSTATUS_BATCH is not supported, use LISTSTATUS instead: %s" % err.message)
+                self.list_batch_supported = False
+                for file_status in self.hdfs_client.list_status(path):
+                    yield file_status
+                return
+
+            listing = response.json()['DirectoryListing']
+            entries = listing['partialListing']['FileStatuses']['FileStatus']
+            for entry in entries:
+                yield pyhdfs.FileStatus(**entry)
+            if not listing.get('remainingEntries') or not entries:
+                return
+            start_after = entries[-1]['pathSuffix']
+
+    def __iter_tree_status(self, path, workers):
+        """多线程并发展开子目录, 通过有界队列逐条返回, 内存占用与目录规模无关"""
+        output = Queue.Queue(LIST_QUEUE_SIZE)
+        dirs = Queue.Queue()
+        dirs.put(path)
+        pending = [1]
+        lock = threading.Lock()
+        stop = threading.Event()
+        done = object()
+
+        def put_output(item):
+            while not stop.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    continue
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    dir_path = dirs.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                try:
+                    for file_status in self.__iter_list_status(dir_path):
+                        file_path = self.__join_suffix(dir_path, file_status)
+                        if file_status.type.upper() == "DIRECTORY" and file_status.pathSuffix:
+                            with lock:
+                                pending[0] += 1
+                            dirs.put(file_path)
+                        put_output((file_path, file_status))
+                except pyhdfs.HdfsFileNotFoundException, err:
+                    # 遍历过程中被删除的子目录跳过
+                    if dir_path == path:
+                        put_output(err)
+                    else:
+                        log.warning("Directory disappeared while listing: %s" % dir_path)
+                except Exception, e:
+                    put_output(e)
+                finally:
+                    with lock:
+                        pending[0] -= 1
+                        if pending[0] == 0:
+                            put_output(done)
+
+        threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while True:
+                item = output.get()
+                if item is done:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def __iter_glob(self, pattern):
+        """按路径逐级展开通配符, 返回匹配的(路径, 文件状态)"""
+        matches = [('/', None)]
+        for part in [p for p in pattern.split('/') if p]:
+            next_matches = []
+            for parent, parent_status in matches:
+                if parent_status is not None and parent_status.type.upper() != "DIRECTORY":
+                    continue
+                if not self.__has_magic(part):
+                    next_matches.append((os.path.join(parent, part), None))
+                    continue
+                try:
+                    for file_status in self.__iter_list_status(parent):
+                        if fnmatch.fnmatchcase(file_status.pathSuffix, part):
+                            next_matches.append((os.path.join(parent, file_status.pathSuffix), file_status))
+                except pyhdfs.HdfsFileNotFoundException:
+                    continue
+            matches = next_matches
+
+        # 不含通配符的最后一级还需要确认存在
+        for match_path, file_status in matches:
+            if file_status is None:
+                file_status = self.__stat(match_path)
+            if file_status is not None:
+                yield match_path, file_status
+
+    def __is_state_file(self, name):
+        """pyback写在本地文件旁边的断点记录与校验清单, 上传目录时不作为备份内容"""
+        return JournalUtil.is_journal_file(name) or name.endswith(ChecksumUtil.MANIFEST_SUFFIX)
+
+    def __has_magic(self, path):
+        return re.search(r'[*?\[]', path) is not None
+
+    def __join_suffix(self, path, file_status):
+        if file_status.pathSuffix:
+            return os.path.join(path, file_status.pathSuffix)
+        return path
+
+    def get_file_status(self, path):
+        """获取单个hdfs文件状态, 优先使用缓存, 不存在时返回None"""
         self.__clear_err_msg()
 
         try:
-            file_status = self.hdfs_client.get_file_status(path)
+            file_status = self.__stat(path)
+            if file_status is None:
+                self.err_msg = "Destination file is not exists!"
             return file_status
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got error when get file status: %s" % err.message
@@ -260,15 +1967,54 @@ class HDFS:
 
         try:
             file_status = self.hdfs_client.list_status(path)
+            self.__cache_list_status(path, file_status)
             return file_status
         except pyhdfs.HdfsException, err:
             self.err_msg = "Got error when get file status: %s" % err.message
             return None
 
+    def __stat(self, path):
+        """带缓存的文件状态查询, 不存在时返回None, 不存在的结果同样缓存"""
+        path = self.__cache_key(path)
+        hit, file_status = self.metadata_cache.get(path)
+        if hit:
+            return file_status
+
+        try:
+            file_status = self.hdfs_client.get_file_status(path)
+        except pyhdfs.HdfsFileNotFoundException:
+            file_status = None
+        self.metadata_cache.set(path, file_status)
+        return file_status
+
+    def __cache_list_status(self, path, list_status):
+        """用list结果预先填充子路径的状态缓存"""
+        path = self.__cache_key(path)
+        for file_status in list_status:
+            if file_status.pathSuffix:
+                self.metadata_cache.set(os.path.join(path, file_status.pathSuffix), file_status)
+            else:
+                self.metadata_cache.set(path, file_status)
+
+    def __invalidate(self, path, recursive=False):
+        """修改路径后清除缓存, 上级目录可能被缓存为不存在也一并清除, recursive时清除所有子路径"""
+        path = self.__cache_key(path)
+        if recursive:
+            self.metadata_cache.invalidate_prefix(path.rstrip('/') + '/')
+        while True:
+            self.metadata_cache.invalidate(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def __cache_key(self, path):
+        return os.path.normpath(path) if path else path
+
     def __get_file_type(self, path):
         """获取文件类型"""
         file_type = 'unknown'
-        file_status = self.hdfs_client.get_file_status(path)
+        file_status = self.__stat(path)
         if file_status:
             file_type = file_status.type
 
@@ -290,7 +2036,15 @@ class HDFS:
 
     def exists(self, path):
         """判断path是否存在"""
-        return self.hdfs_client.exists(path)
+        return self.__stat(path) is not None
+
+    def get_cache_stats(self):
+        """返回元数据缓存的统计信息"""
+        return self.metadata_cache.get_stats()
+
+    def __fork(self):
+        """复制一个共享hdfs client的实例, 供线程池中各线程单独记录err_msg"""
+        return copy.copy(self)
 
     def __clear_err_msg(self):
         """清空错误信息"""
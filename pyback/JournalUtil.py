@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+JOURNAL_SUFFIX = '.pyback-journal'
+
+log = logging.getLogger(__name__)
+
+
+def get_journal_file(local_file, journal_dir=None):
+    """journal_dir为空时记录在本地文件旁边, 否则按本地文件的绝对路径存放在journal_dir下, 不写入备份的目录"""
+    if not journal_dir:
+        return local_file + JOURNAL_SUFFIX
+    digest = hashlib.md5(os.path.abspath(local_file)).hexdigest()
+    return os.path.join(journal_dir, digest + JOURNAL_SUFFIX)
+
+
+def is_journal_file(filename):
+    """是否是断点记录或其临时文件, 上传目录时跳过"""
+    return filename.endswith(JOURNAL_SUFFIX) or filename.endswith(JOURNAL_SUFFIX + '.tmp')
+
+
+class Journal:
+    """传输断点记录, 以json格式保存在本地文件旁边或journal_dir下, 用于进程退出后断点续传"""
+    def __init__(self, local_file, action, remote_file, size, mtime, journal_dir=None):
+        self.journal_file = get_journal_file(local_file, journal_dir)
+        self.lock = threading.Lock()
+        self.state = {
+            'action': action,
+            'local_file': os.path.abspath(local_file),
+            'remote_file': remote_file,
+            'size': size,
+            'mtime': mtime,
+            'offset': 0,
+            'done': [],
+        }
+
+    def load(self):
+        """读取已有的断点记录, 只有传输对象和源文件都未变化时才返回True"""
+        try:
+            with open(self.journal_file, 'r') as fh:
+                state = json.load(fh)
+        except (IOError, ValueError):
+            return False
+
+        for key in ('action', 'local_file', 'remote_file', 'size', 'mtime'):
+            if state.get(key) != self.state[key]:
+                log.warning("Journal %s does not match current transfer: %s changed" % (self.journal_file, key))
+                return False
+        self.state = state
+        return True
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **kwargs):
+        """更新记录并落盘"""
+        with self.lock:
+            self.state.update(kwargs)
+            self.__save()
+
+    def mark_done(self, offset):
+        """记录已完成的分块"""
+        with self.lock:
+            if offset not in self.state['done']:
+                self.state['done'].append(offset)
+            self.__save()
+
+    def is_done(self, offset):
+        return offset in self.state['done']
+
+    def remove(self):
+        """传输成功后删除记录"""
+        try:
+            os.remove(self.journal_file)
+        except OSError:
+            pass
+
+    def __save(self):
+        """先写临时文件再rename, 保证记录文件完整; 数据已先于记录落盘, 记录丢失只会退回更早的断点"""
+        tmp_file = self.journal_file + '.tmp'
+        try:
+            journal_dir = os.path.dirname(self.journal_file)
+            if journal_dir and not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+            with open(tmp_file, 'w') as fh:
+                json.dump(self.state, fh)
+            os.rename(tmp_file, self.journal_file)
+        except (IOError, OSError), e:
+            log.warning("Failed to save journal %s: %s" % (self.journal_file, e))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import threading
+
+REPORT_INTERVAL = 3
+
+
+class Progress:
+    """
+    传输进度计数, 各传输流在拷贝循环中累加读写的字节数, 按线程区分传输流;
+    只在内存中计数, 不访问hdfs
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = None
+        self.done = 0
+        self.skipped = 0
+        self.start_time = time.time()
+        self.streams = {}
+
+    def set_total(self, total):
+        """设置总字节数, 已设置时不覆盖, 目录传输时由调用方预先设置所有文件的总量"""
+        with self.lock:
+            if self.total is None:
+                self.total = total
+
+    def skip(self, size):
+        """续传时已完成的部分计入进度, 不计入速度"""
+        with self.lock:
+            self.done += size
+            self.skipped += size
+
+    def add(self, size):
+        name = threading.current_thread().name
+        with self.lock:
+            self.done += size
+            self.streams[name] = self.streams.get(name, 0) + size
+
+    def snapshot(self):
+        with self.lock:
+            return time.time(), self.done, dict(self.streams)
+
+
+class Reporter:
+    """
+    后台线程定期输出进度: 已完成量、瞬时速度、平均速度、预计剩余时间与各传输流的速度;
+    json_format为True时每次输出一行json, 供其他程序解析
+    """
+    def __init__(self, progress, interval=REPORT_INTERVAL, json_format=False, output=None):
+        self.progress = progress
+        self.interval = interval
+        self.json_format = json_format
+        self.output = output or sys.stderr
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last = progress.snapshot()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """停止后台线程并输出最终结果"""
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.__report(True)
+
+    def __run(self):
+        while not self.stop_event.wait(self.interval):
+            self.__report()
+
+    def get_stats(self, finished=False):
+        """与上次统计比较, 返回本次的统计结果"""
+        progress = self.progress
+        now, done, streams = progress.snapshot()
+        last_time, last_done, last_streams = self.last
+        self.last = (now, done, streams)
+        interval = max(now - last_time, 0.001)
+        elapsed = max(now - progress.start_time, 0.001)
+
+        rate = (done - last_done) / interval
+        avg_rate = (done - progress.skipped) / elapsed
+        total = progress.total
+        eta = None
+        if total is not None and not finished:
+            speed = rate or avg_rate
+            eta = int(max(0, total - done) / speed) if speed else None
+        return {
+            'time': int(now),
+            'elapsed': round(elapsed, 3),
+            'done': done,
+            'total': total,
+            'percent': round(done * 100.0 / total, 2) if total else None,
+            'rate': int(rate),
+            'avg_rate': int(avg_rate),
+            'eta': eta,
+            'streams': [{'name': name, 'bytes': size, 'rate': int((size - last_streams.get(name, 0)) / interval)}
+                        for name, size in sorted(streams.items())],
+            'finished': finished,
+        }
+
+    def __report(self, finished=False):
+        stats = self.get_stats(finished)
+        if self.json_format:
+            self.output.write(json.dumps(stats, sort_keys=True) + '\n')
+        else:
+            self.output.write('\r' + format_stats(stats) + ('\n' if finished else ''))
+        self.output.flush()
+
+
+def format_size(value):
+    """带单位的字节数, 保留一位小数"""
+    value = float(value)
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if value < 1024:
+            break
+        value /= 1024
+    else:
+        unit = 'P'
+    return '%.1f%sB' % (value, unit)
+
+
+def format_time(seconds):
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def format_stats(stats):
+    """把统计结果格式化为一行进度"""
+    done = format_size(stats['done'])
+    if stats['total'] is not None:
+        done += '/%s(%s%%)' % (format_size(stats['total']), stats['percent'] or 0)
+    if stats['finished']:
+        return ('done: %s  avg: %s/s  time: %s' % (done, format_size(stats['avg_rate']),
+                                                  format_time(stats['elapsed']))).ljust(100)
+    line = 'done: %s  speed: %s/s  avg: %s/s' % (done, format_size(stats['rate']), format_size(stats['avg_rate']))
+    if stats['eta'] is not None:
+        line += '  eta: %s' % format_time(stats['eta'])
+    rates = [s['rate'] for s in stats['streams'] if s['rate']]
+    if len(rates) > 1:
+        line += '  streams: %s (%s/s-%s/s)' % (len(rates), format_size(min(rates)), format_size(max(rates)))
+    # 覆盖上一行残留的字符
+    return line.ljust(100)
@@ -2,32 +2,53 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import logging
+import sqlite3
 import ConfigParser
 
+import pyhdfs
+
 import SysUtil
 import HdfsUtil
+import CompressUtil
+import DedupUtil
+import ProgressUtil
+import StatsUtil
+import AsyncUtil
+import SyncUtil
+import CatalogUtil
 
 log = logging.getLogger(__name__)
 
 
 class PyBack:
-    def __init__(self, config_file=None):
+    def __init__(self, config_file=None, stats=False, stats_file=None):
         self.config_file = config_file
+        self.print_stats = stats
 
         self.hdfs_conf = None
         self.home_dir = None
         self.address = None
+        self.dedup_index = None
+        self.sync_index_dir = None
+        self.stats_file = None
+        self.catalog = None
 
         self.address = SysUtil.get_local_address()
         self.read_config()
+        if stats_file:
+            self.stats_file = stats_file
         self.hdfs = self.get_hdfs()
 
         self.err_msg = ''
         self.last_put_file = ''
 
-    def du(self, path):
-        size = self.hdfs.get_size(path)
+    def du(self, path, summary=False):
+        if summary:
+            size = self.hdfs.get_content_summary(path)
+        else:
+            size = self.hdfs.get_size(path)
         if size is None:
             log.error(self.hdfs.err_msg)
 
@@ -40,16 +61,38 @@ class PyBack:
 
         return info
 
-    def get(self, source, dest=None):
+    def iter_list(self, path, recursive=False):
+        """流式返回(完整路径, 文件状态), 出错时记录err_msg并结束"""
+        self.err_msg = ''
+        count = 0
+        try:
+            for item in self.hdfs.iter_path_status(path, recursive):
+                count += 1
+                yield item
+        except pyhdfs.HdfsFileNotFoundException:
+            self.err_msg = "Destination file is not exists!"
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when list path: %s" % err.message
+        except Exception, e:
+            self.err_msg = "Got error when list path: %s" % e
+        else:
+            if not count and not self.hdfs.exists(path):
+                self.err_msg = "Destination file is not exists!"
+
+        if self.err_msg:
+            log.error(self.err_msg)
+
+    def get(self, source, dest=None, parallel=1, resume=False, raw=False, verify=False):
         if not dest:
             dest = os.getcwd()
-        res = self.hdfs.get_to_local(source, dest)
+        res = self.hdfs.get_to_local(source, dest, parallel=parallel, resume=resume, raw=raw, verify=verify)
         if not res:
             log.error(self.hdfs.err_msg)
 
         return res
 
-    def put(self, source, dest=None, date=None, sub_dir=None, store_type='online', stream=False):
+    def put(self, source, dest=None, date=None, sub_dir=None, store_type='online', stream=False, parallel=1,
+            resume=False, compress=None, compress_threads=CompressUtil.COMPRESS_WORKERS, verify=False, dedup=False):
         if source == '-':
             stream = True
 
@@ -57,20 +100,135 @@ class PyBack:
             log.error("A destination file should be given when using streaming mode")
             return False
 
-        dest = self.get_format_dest_file(source, dest, date, sub_dir, store_type)
+        dest = self.get_format_dest_file(source, dest, date, sub_dir, store_type, compress, dedup)
+        chunk_store = self.get_chunk_store() if dedup else None
+        self.hdfs.last_checksum = None
         if stream:
-            res = self.hdfs.put_from_stream(dest)
+            res = self.hdfs.put_from_stream(dest, compress, compress_threads, verify, chunk_store)
         else:
-            res = self.hdfs.put_from_local(source, dest)
+            res = self.hdfs.put_from_local(source, dest, parallel, resume, compress, compress_threads, verify,
+                                           chunk_store)
         if not res:
             log.error(self.hdfs.err_msg)
+        elif self.catalog:
+            self.__catalog_put(source, dest, compress, dedup)
 
         return res
 
+    def put_tree(self, source, dest=None, date=None, sub_dir=None, store_type='online', workers=4, resume=False,
+                 verify=False):
+        dest = self.get_format_dest_file(source.rstrip('/'), dest, date, sub_dir, store_type)
+        results = self.hdfs.put_tree(source, dest, workers, resume, verify)
+        self.__catalog_update(results, 'add')
+        return self.report_results(results)
+
+    def get_tree(self, source, dest=None, workers=4, resume=False, verify=False):
+        if not dest:
+            dest = os.getcwd()
+        results = self.hdfs.get_tree(source, dest, workers, resume, verify)
+        return self.report_results(results)
+
+    def sync(self, source, dest, workers=4, index_file=None):
+        """增量同步本地目录的内容到hdfs目录, 相对路径的目标目录位于home_dir下; index_file为空时按配置的目录存放索引"""
+        if not dest.startswith('/'):
+            dest = os.path.join(self.home_dir, dest)
+        dest = os.path.normpath(dest)
+        index_file = index_file or SyncUtil.get_index_file(self.sync_index_dir, source, dest)
+        index = SyncUtil.SyncIndex(index_file, source, dest)
+        results = self.hdfs.sync_tree(source, dest, index, workers)
+        self.__catalog_update(results, 'add')
+        return self.report_results(results, 'files synced')
+
+    def report_results(self, results, action='files transferred'):
+        """输出批量传输或批量操作中每个路径的结果"""
+        if results is None:
+            log.error(self.hdfs.err_msg)
+            return False
+
+        failed = 0
+        for source, dest, res, err_msg in results:
+            if res is True:
+                log.warning("OK\t%s -> %s" % (source, dest))
+            else:
+                failed += 1
+                log.error("FAILED\t%s -> %s: %s" % (source, dest, err_msg))
+        log.warning("%s %s, %s failed" % (len(results) - failed, action, failed))
+
+        return failed == 0
+
+    def rebuild_catalog(self, workers=HdfsUtil.WALK_WORKERS):
+        """并行递归扫描一次home_dir, 用其中的备份文件替换备份索引, 返回记录的文件数, 出错时返回None"""
+        self.err_msg = ''
+        if not self.catalog:
+            self.err_msg = "Catalog is not enabled, set catalog_db in %s" % self.config_file
+            log.error(self.err_msg)
+            return None
+        entries = ((path, file_status.length, file_status.modificationTime)
+                   for path, file_status in self.hdfs.iter_path_status(self.home_dir, True, workers)
+                   if file_status.type.upper() == 'FILE')
+        try:
+            return self.catalog.rebuild(entries)
+        except pyhdfs.HdfsException, err:
+            self.err_msg = "Got hdfs error when scan %s: %s" % (self.home_dir, err.message)
+        except (sqlite3.Error, OSError), e:
+            self.err_msg = "Got error when rebuild catalog %s: %s" % (self.catalog.db_file, e)
+        log.error(self.err_msg)
+        return None
+
+    def __catalog_put(self, source, dest, compress, dedup):
+        """记录上传的文件的hdfs路径、大小与修改时间, 上传时校验通过则同时记录hdfs的校验和; 索引出错不影响上传结果"""
+        try:
+            if self.hdfs.is_dir(dest):
+                # 与HDFS.put_from_local相同, 上传到已存在的目录下
+                name = os.path.basename(source)
+                if compress:
+                    name = CompressUtil.add_suffix(name, compress)
+                dest = os.path.join(dest, name)
+            if dedup:
+                dest = DedupUtil.add_suffix(dest)
+            if not self.catalog.parse(dest):
+                return
+            file_status = self.hdfs.get_file_status(dest)
+            if file_status is None:
+                return
+            self.catalog.add([(dest, file_status.length, file_status.modificationTime, self.hdfs.last_checksum)])
+        except pyhdfs.HdfsException, err:
+            log.warning("Failed to update catalog for %s: %s" % (dest, err.message))
+        except (sqlite3.Error, OSError), e:
+            log.warning("Failed to update catalog %s: %s" % (self.catalog.db_file, e))
+
+    def __catalog_update(self, results, action):
+        """
+        把批量操作中成功的路径更新到备份索引, action为add、move或remove; 上传的文件按本地文件的大小记录,
+        不再查询hdfs; 索引出错只记录日志, 不影响操作结果
+        """
+        if not self.catalog or not results:
+            return
+        done = [(source, dest) for source, dest, res, err_msg in results if res is True]
+        try:
+            if action == 'add':
+                now = int(time.time() * 1000)
+                self.catalog.add([(dest, os.path.getsize(source), now, None) for source, dest in done
+                                  if os.path.isfile(source)])
+            elif action == 'move':
+                self.catalog.move(done)
+            else:
+                self.catalog.remove([source for source, dest in done])
+        except (sqlite3.Error, OSError), e:
+            log.warning("Failed to update catalog %s: %s" % (self.catalog.db_file, e))
+
     def move(self, source, dest):
+        try:
+            if self.catalog and self.hdfs.is_dir(dest):
+                # 与HDFS.move相同, 移动到已存在的目录下, 索引中记录最终路径
+                dest = os.path.join(dest, os.path.basename(source))
+        except pyhdfs.HdfsException:
+            pass
         res = self.hdfs.move(source, dest)
         if not res:
             log.error(self.hdfs.err_msg)
+        else:
+            self.__catalog_update([(source, dest, res, '')], 'move')
 
         return res
 
@@ -85,22 +243,46 @@ class PyBack:
         res = self.hdfs.delete(path)
         if not res:
             log.error(self.hdfs.err_msg)
+        else:
+            self.__catalog_update([(path, None, res, '')], 'remove')
 
         return res
 
-    def cat(self, path):
-        res = self.hdfs.cat(path)
+    def move_paths(self, sources, dest, workers=HdfsUtil.WALK_WORKERS):
+        results = self.hdfs.move_paths(sources, dest, workers)
+        self.__catalog_update(results, 'move')
+        return self.report_results(results, 'paths moved')
+
+    def mkdir_paths(self, paths, workers=HdfsUtil.WALK_WORKERS):
+        results = self.hdfs.mkdir_paths(paths, workers)
+        return self.report_results(results, 'dirs created')
+
+    def delete_paths(self, paths, workers=HdfsUtil.WALK_WORKERS):
+        results = self.hdfs.delete_paths(paths, workers)
+        self.__catalog_update(results, 'remove')
+        return self.report_results(results, 'paths deleted')
+
+    def cat(self, path, parallel=1, raw=False, offset=0, length=None):
+        res = self.hdfs.cat(path, offset=offset, parallel=parallel, raw=raw, length=length)
         if not res:
             log.error(self.hdfs.err_msg)
 
         return res
 
-    def get_format_dest_file(self, source, dest='', date=None, sub_dir=None, store_type='online'):
+    def get_format_dest_file(self, source, dest='', date=None, sub_dir=None, store_type='online', compress=None,
+                             dedup=False):
         """
-        返回hdfs上传目录(不加参数时会自动补全)
+        返回hdfs上传目录(不加参数时会自动补全, 压缩上传时补上压缩后缀, 去重上传时补上manifest后缀)
         """
         if not dest:
             dest = os.path.basename(source)
+            if compress:
+                dest = CompressUtil.add_suffix(dest, compress)
+            if dedup:
+                dest = DedupUtil.add_suffix(dest)
+        elif compress and not (dest.startswith('/') and self.hdfs.is_dir(dest)):
+            # 指定的目标文件同样补上压缩后缀, 目标是已存在的目录时上传时按源文件名补全
+            dest = CompressUtil.add_suffix(dest, compress)
 
         # 绝对路径不补全目录
         if dest.startswith('/'):
@@ -128,9 +310,55 @@ class PyBack:
         dest_file = os.path.join(base_dir, os.path.basename(dest))
         return dest_file
 
+    def get_chunk_store(self):
+        """去重存储, chunk统一存放在home_dir/chunks下, 所有备份共享"""
+        return DedupUtil.ChunkStore(os.path.join(self.home_dir, 'chunks'), self.dedup_index)
+
+    def start_progress(self, interval=ProgressUtil.REPORT_INTERVAL, json_format=False):
+        """开始统计传输进度并定期输出, 返回Reporter, 传输结束后调用其stop输出最终结果"""
+        self.hdfs.progress = ProgressUtil.Progress()
+        reporter = ProgressUtil.Reporter(self.hdfs.progress, interval, json_format)
+        reporter.start()
+        return reporter
+
+    def set_limit_rate(self, rate):
+        """设置传输限速(字节/秒), 0为不限速; 控制文件存在时仍以控制文件为准"""
+        rate_limiter = self.hdfs.rate_limiter
+        rate_limiter.set_rate(rate)
+        rate_limiter.reload(force=True)
+
+    def report_stats(self):
+        """输出统计汇总到标准错误, 并按配置写入prometheus textfile; 自动调整选择的参数作为gauge输出"""
+        tuning = self.hdfs.tuner.get_report()
+        log.debug("Tuning: %s" % tuning)
+        stats = self.hdfs.stats
+        if stats is None:
+            return
+        for name, value in tuning.items():
+            if value is not None:
+                stats.set_gauge('tuned_' + name, int(value) if isinstance(value, bool) else value)
+        if self.print_stats:
+            StatsUtil.print_stats(stats)
+        if self.stats_file:
+            stats.write_prometheus(self.stats_file)
+
+    def open_reader(self, path):
+        """返回hdfs文件的随机读取对象, 路径不是文件时返回None"""
+        reader = self.hdfs.open_reader(path)
+        if reader is None:
+            log.error(self.hdfs.err_msg)
+
+        return reader
+
+    def get_async_hdfs(self, max_workers=None, timeout=None):
+        """返回与本实例共享连接池的AsyncHDFS, 供在一个进程中并发执行大量操作的调用方使用"""
+        return AsyncUtil.AsyncHDFS(self.hdfs, max_workers, timeout)
+
     def get_hdfs(self):
         conf = self.hdfs_conf
         h = HdfsUtil.HDFS(**conf)
+        if self.print_stats or self.stats_file:
+            h.enable_stats()
         h.connect()
         return h
 
@@ -146,7 +374,49 @@ class PyBack:
                 'connect_max_tries': config.getint('hdfs', 'max_tries'),
                 'connect_retry_delay': config.getint('hdfs', 'retry_delay'),
             }
+            if config.has_option('hdfs', 'pool_size'):
+                self.hdfs_conf['pool_size'] = config.getint('hdfs', 'pool_size')
+            if config.has_option('hdfs', 'pool_maxsize'):
+                self.hdfs_conf['pool_maxsize'] = config.getint('hdfs', 'pool_maxsize')
+            if config.has_option('hdfs', 'cache_ttl'):
+                self.hdfs_conf['cache_ttl'] = config.getfloat('hdfs', 'cache_ttl')
+            if config.has_option('hdfs', 'cache_size'):
+                self.hdfs_conf['cache_size'] = config.getint('hdfs', 'cache_size')
+            if config.has_option('hdfs', 'checksum_type'):
+                self.hdfs_conf['checksum_type'] = config.get('hdfs', 'checksum_type').upper()
+            if config.has_option('hdfs', 'bytes_per_checksum'):
+                self.hdfs_conf['bytes_per_checksum'] = config.getint('hdfs', 'bytes_per_checksum')
+            if config.has_option('hdfs', 'io_buffer_size'):
+                self.hdfs_conf['io_buffer_size'] = SysUtil.parse_unit(config.get('hdfs', 'io_buffer_size'))
+            if config.has_option('hdfs', 'io_memory_limit'):
+                self.hdfs_conf['io_memory_limit'] = SysUtil.parse_unit(config.get('hdfs', 'io_memory_limit'))
+            if config.has_option('hdfs', 'adaptive_io'):
+                self.hdfs_conf['adaptive_io'] = config.getboolean('hdfs', 'adaptive_io')
+            if config.has_option('hdfs', 'min_read_size'):
+                self.hdfs_conf['min_read_size'] = SysUtil.parse_unit(config.get('hdfs', 'min_read_size'))
+            if config.has_option('hdfs', 'max_parallel'):
+                self.hdfs_conf['max_parallel'] = config.getint('hdfs', 'max_parallel')
+            if config.has_option('hdfs', 'limit_rate'):
+                self.hdfs_conf['limit_rate'] = SysUtil.parse_unit(config.get('hdfs', 'limit_rate'))
+            if config.has_option('hdfs', 'namenode_state_file'):
+                self.hdfs_conf['namenode_state_file'] = config.get('hdfs', 'namenode_state_file') or None
+            if config.has_option('hdfs', 'namenode_state_ttl'):
+                self.hdfs_conf['namenode_state_ttl'] = config.getint('hdfs', 'namenode_state_ttl')
+            if config.has_option('hdfs', 'limit_rate_file'):
+                self.hdfs_conf['limit_rate_file'] = config.get('hdfs', 'limit_rate_file')
+            if config.has_option('hdfs', 'journal_dir'):
+                self.hdfs_conf['journal_dir'] = config.get('hdfs', 'journal_dir') or None
             self.home_dir = config.get('hdfs', 'home_dir')
+            if config.has_option('hdfs', 'dedup_index'):
+                self.dedup_index = config.get('hdfs', 'dedup_index')
+            if config.has_option('hdfs', 'sync_index_dir'):
+                self.sync_index_dir = config.get('hdfs', 'sync_index_dir') or None
+            if config.has_option('hdfs', 'stats_file'):
+                self.stats_file = config.get('hdfs', 'stats_file') or None
+            if config.has_option('hdfs', 'catalog_db') and config.get('hdfs', 'catalog_db'):
+                self.catalog = CatalogUtil.Catalog(config.get('hdfs', 'catalog_db'), self.home_dir)
 
         except ConfigParser.Error, err:
             log.error("Got error when read config file %s: %s " % (config_file, err.message))
+        except ValueError, err:
+            log.error("Got error when read config file %s: %s " % (config_file, err))
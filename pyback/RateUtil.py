@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import logging
+import threading
+import StringIO
+
+import SysUtil
+
+QUANTUM = 64*1024
+CONTROL_INTERVAL = 1
+ITER_SIZE = 256*1024
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    令牌桶限速, 进程内所有传输流共享同一个桶; 每次最多取一个quantum的令牌, 按先来后到排队,
+    多个并行流轮流取得令牌, 平均分配带宽; rate为0时不限速;
+    control_file存在时以其内容为准, 每CONTROL_INTERVAL秒检查一次, 可在运行中修改限速
+    """
+    def __init__(self, rate=0, control_file=None):
+        self.rate = 0
+        self.quantum = QUANTUM
+        self.burst = QUANTUM
+        self.tokens = 0
+        self.last_time = time.time()
+        self.cond = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+        self.control_file = control_file
+        self.control_mtime = None
+        self.control_checked = 0
+        # 累计传输的字节数, 自动并行据此计算总吞吐
+        self.transferred = 0
+        self.set_rate(rate)
+        self.reload()
+
+    def set_rate(self, rate):
+        """设置每秒字节数, 0为不限速"""
+        rate = max(0, int(rate))
+        if rate != self.rate:
+            log.warning("Limit rate set to %s" % ("%sB/s" % SysUtil.add_unit(rate, 'bytes') if rate else "unlimited"))
+        # quantum与突发量随限速调整, 限速较高时减少排队次数
+        self.quantum = max(QUANTUM, rate // 50)
+        self.burst = max(self.quantum, rate // 20)
+        self.tokens = min(self.tokens, self.burst)
+        self.rate = rate
+
+    def reload(self, force=False):
+        """读取控制文件, 文件修改过或force为True时生效"""
+        self.control_checked = time.time()
+        if not self.control_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.control_file)
+            if not force and mtime == self.control_mtime:
+                return
+            self.control_mtime = mtime
+            with open(self.control_file, 'r') as fh:
+                self.set_rate(SysUtil.parse_unit(fh.read().strip() or 0))
+        except OSError:
+            self.control_mtime = None
+        except (IOError, ValueError), e:
+            log.warning("Failed to read limit rate from %s: %s" % (self.control_file, e))
+
+    def get_read_size(self, size):
+        """限速时缩小单次读取的大小, 使流量平稳"""
+        if not self.rate:
+            return size
+        return min(size, max(QUANTUM, self.rate // 10))
+
+    def consume(self, size):
+        """取得size字节的令牌, 不足时等待"""
+        self.transferred += size
+        while size > 0:
+            if time.time() - self.control_checked >= CONTROL_INTERVAL:
+                self.reload()
+            if not self.rate:
+                return
+            n = min(size, self.quantum)
+            self.__acquire(n)
+            size -= n
+
+    def __acquire(self, size):
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.serving != ticket:
+                self.cond.wait(0.1)
+        try:
+            # 只有轮到的流会执行到这里, 令牌不足时先扣为负数再按欠额等待
+            rate = self.rate
+            if not rate:
+                return
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * rate)
+            self.last_time = now
+            self.tokens -= size
+            if self.tokens < 0:
+                time.sleep(-self.tokens / float(rate))
+        finally:
+            with self.cond:
+                self.serving += 1
+                self.cond.notify_all()
+
+
+class LimitedReader:
+    """
+    包装上传数据源, 数据被读取时按限速取令牌, progress不为空时计入传输进度;
+    已知长度时设置len, 使requests仍发送Content-Length
+    """
+    def __init__(self, source, rate_limiter, length=None, progress=None):
+        if isinstance(source, str):
+            length = len(source)
+            source = StringIO.StringIO(source)
+        self.source = source
+        self.rate_limiter = rate_limiter
+        self.progress = progress
+        if length is not None:
+            self.len = length
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.source.read()
+        else:
+            data = self.source.read(self.rate_limiter.get_read_size(size))
+        self.rate_limiter.consume(len(data))
+        if self.progress:
+            self.progress.add(len(data))
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(ITER_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def install_signal_handler(rate_limiter, signum=signal.SIGUSR1):
+    """收到信号时立即重新读取控制文件"""
+    signal.signal(signum, lambda signum, frame: rate_limiter.reload(force=True))
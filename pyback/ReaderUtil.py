@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import collections
+
+READ_BLOCK_SIZE = 128*1024
+CACHE_BLOCKS = 64
+# 顺序读取时一次请求最多读取的块数, 每次在上一块之后未命中时加倍
+READ_AHEAD_BLOCKS = 32
+
+
+class BlockCache:
+    """按块号缓存文件数据的LRU缓存, 最多保留max_blocks块, 超过时淘汰最久未使用的块"""
+    def __init__(self, max_blocks=CACHE_BLOCKS):
+        self.max_blocks = max_blocks
+        self.blocks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index):
+        block = self.blocks.pop(index, None)
+        if block is None:
+            self.misses += 1
+            return None
+        # 重新插入, 移到最近使用的位置
+        self.blocks[index] = block
+        self.hits += 1
+        return block
+
+    def contains(self, index):
+        """只检查是否已缓存, 不计入命中统计, 也不改变淘汰顺序"""
+        return index in self.blocks
+
+    def set(self, index, block):
+        self.blocks.pop(index, None)
+        self.blocks[index] = block
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+    def clear(self):
+        self.blocks.clear()
+
+    def get_stats(self):
+        return {'blocks': len(self.blocks), 'hits': self.hits, 'misses': self.misses}
+
+
+class HdfsReader:
+    """
+    hdfs文件的只读随机访问对象, 支持seek/tell/read/readinto/pread; 按block_size对齐发起带长度的区间读取,
+    读过的块保存在LRU缓存中, 随机读取只传输访问到的块; 在上一次访问的块之后未命中时视为顺序读取,
+    一次请求读取的块数逐次加倍, 最多read_ahead块; 文件大小在打开时确定, pread可以在多个线程中同时调用,
+    锁只保护缓存与读取状态, 网络读取在锁外进行, 正在读取的块由其他线程等待而不重复读取
+    """
+    def __init__(self, path, size, fetch, block_size=READ_BLOCK_SIZE, cache_blocks=CACHE_BLOCKS,
+                 read_ahead=READ_AHEAD_BLOCKS):
+        self.name = path
+        self.size = size
+        # fetch(offset, length)返回文件[offset, offset + length)的数据
+        self.fetch = fetch
+        self.block_size = block_size
+        self.read_ahead = max(1, read_ahead)
+        self.cache = BlockCache(max(cache_blocks, self.read_ahead))
+        self.lock = threading.Lock()
+        # 正在读取的块号 -> 读取结束时set的Event
+        self.pending = {}
+        self.pos = 0
+        self.closed = False
+        self.last_block = None
+        self.window = 1
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.__check_open()
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence: %s" % whence)
+        if offset < 0:
+            raise IOError("Negative seek position %s" % offset)
+        self.pos = offset
+        return self.pos
+
+    def read(self, size=-1):
+        """从当前位置读取最多size字节, size小于0时读到文件末尾"""
+        remain = max(0, self.size - self.pos)
+        if size < 0 or size > remain:
+            size = remain
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        """读入buf, 返回读取的字节数, 到达文件末尾时返回0"""
+        size = self.__read_at(buf, self.pos)
+        self.pos += size
+        return size
+
+    def pread(self, size, offset):
+        """从offset读取最多size字节, 不改变当前位置"""
+        buf = bytearray(max(0, min(size, self.size - offset)))
+        size = self.__read_at(buf, offset)
+        return str(buf[:size]) if size < len(buf) else str(buf)
+
+    def close(self):
+        self.closed = True
+        self.cache.clear()
+
+    def get_stats(self):
+        stats = self.cache.get_stats()
+        stats.update({'requests': self.requests, 'bytes_fetched': self.bytes_fetched})
+        return stats
+
+    def __check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def __read_at(self, buf, offset):
+        self.__check_open()
+        view = memoryview(buf)
+        length = min(len(view), max(0, self.size - offset))
+        done = 0
+        last_index = (offset + length - 1) // self.block_size
+        while done < length:
+            index, start = divmod(offset + done, self.block_size)
+            block = self.__get_block(index, last_index - index + 1)
+            size = min(len(block) - start, length - done)
+            view[done:done + size] = memoryview(block)[start:start + size]
+            done += size
+        return done
+
+    def __get_block(self, index, needed=1):
+        while True:
+            with self.lock:
+                block = self.cache.get(index)
+                if block is not None:
+                    self.last_block = index
+                    return block
+                event = self.pending.get(index)
+                if event is None:
+                    count, event = self.__plan_fetch(index, needed)
+                    self.last_block = index
+                    break
+            # 其他线程正在读取这一块, 等待后重新查缓存; 对方读取失败时由本线程重新读取
+            event.wait()
+        return self.__fetch_blocks(index, count, event)
+
+    def __plan_fetch(self, index, needed):
+        """
+        在锁内决定从index开始读取的块数: window个块与本次读取需要的needed个块中较多者,
+        遇到已缓存或正在读取的块时截止; 把这些块登记为正在读取, 返回(块数, Event)
+        """
+        if self.last_block is not None and index == self.last_block + 1:
+            self.window = min(self.window * 2, self.read_ahead)
+        else:
+            self.window = 1
+        block_count = (self.size + self.block_size - 1) // self.block_size
+        # 一次读取的块数不超过缓存容量, 否则本次读取后面用到的块会先被淘汰
+        limit = min(index + max(self.window, min(needed, self.cache.max_blocks)), block_count)
+        count = 1
+        while index + count < limit and not self.cache.contains(index + count) and \
+                index + count not in self.pending:
+            count += 1
+        event = threading.Event()
+        for i in xrange(index, index + count):
+            self.pending[i] = event
+        return count, event
+
+    def __fetch_blocks(self, index, count, event):
+        """在锁外一次请求读取从index开始的count个块放入缓存, 返回第index块; 结束时唤醒等待这些块的线程"""
+        start = index * self.block_size
+        end = min((index + count) * self.block_size, self.size)
+        try:
+            try:
+                data = self.fetch(start, end - start)
+            except Exception, e:
+                raise IOError("Got error when read %s at offset %s: %s" % (self.name, start, e))
+            if len(data) != end - start:
+                raise IOError("Got %s bytes when read %s at offset %s, expect %s" % (len(data), self.name, start,
+                                                                                    end - start))
+            # 每块复制为单独的字符串, 淘汰一块即释放其内存, 缓存占用不超过cache_blocks块
+            view = memoryview(data)
+            blocks = [view[offset:offset + self.block_size].tobytes() for offset in xrange(0, len(data), self.block_size)]
+            with self.lock:
+                self.requests += 1
+                self.bytes_fetched += len(data)
+                for i, block in enumerate(blocks):
+                    self.cache.set(index + i, block)
+            return blocks[0]
+        finally:
+            with self.lock:
+                for i in xrange(index, index + count):
+                    self.pending.pop(i, None)
+            event.set()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import time
+import bisect
+import logging
+import StringIO
+import functools
+import threading
+
+import requests
+
+# 延迟直方图的桶上界(秒), 与prometheus的le一致
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_PREFIX = 'pyback'
+RETRY_STATUS = ('StandbyException', 'RetriableException')
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    """固定桶的延迟直方图, 记录次数、总和与最大值, 分位数按桶估算"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """与prometheus的histogram_quantile相同, 在所在的桶内线性插值"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': round(self.max, 6),
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], self.counts)),
+        }
+
+
+class Stats:
+    """
+    一次运行的统计: 按(类型, 操作)分组的请求延迟直方图, 各阶段累计耗时, 传输字节数、重试次数等计数,
+    以及自动调整选择的参数等当前值;
+    所有方法线程安全, 未开启统计时调用方持有None, 不产生开销
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.histograms = {}
+        self.phases = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, kind, op, seconds):
+        """记录一次请求或一次传输的耗时, kind为namenode/datanode/transfer"""
+        with self.lock:
+            histogram = self.histograms.get((kind, op))
+            if histogram is None:
+                histogram = self.histograms[(kind, op)] = Histogram()
+            histogram.observe(seconds)
+
+    def add_time(self, phase, seconds):
+        """累计一个阶段的耗时, 如读网络、写磁盘、写标准输出"""
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'elapsed': round(time.time() - self.start_time, 6),
+                'requests': dict(('%s.%s' % key, h.to_dict()) for key, h in self.histograms.items()),
+                'phases': dict((k, round(v, 6)) for k, v in self.phases.items()),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def format_text(self):
+        """可读的统计汇总"""
+        stats = self.to_dict()
+        lines = ['%-28s %8s %10s %10s %10s %10s %10s' % ('request', 'count', 'avg(ms)', 'p50(ms)', 'p95(ms)',
+                                                           'p99(ms)', 'max(ms)')]
+        for name in sorted(stats['requests']):
+            h = stats['requests'][name]
+            lines.append('%-28s %8s %10.1f %10.1f %10.1f %10.1f %10.1f' % (
+                name, h['count'], h['avg'] * 1000, h['p50'] * 1000, h['p95'] * 1000, h['p99'] * 1000, h['max'] * 1000))
+        for phase in sorted(stats['phases']):
+            lines.append('phase %-22s %.3fs' % (phase, stats['phases'][phase]))
+        for name in sorted(stats['counters']):
+            lines.append('counter %-20s %s' % (name, stats['counters'][name]))
+        for name in sorted(stats['gauges']):
+            lines.append('gauge %-22s %s' % (name, stats['gauges'][name]))
+        lines.append('elapsed %.3fs' % stats['elapsed'])
+        return '\n'.join(lines)
+
+    def format_prometheus(self):
+        """prometheus文本格式, 供node_exporter的textfile collector采集"""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            phases = sorted(self.phases.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        name = METRIC_PREFIX + '_request_duration_seconds'
+        lines = ['# HELP %s Latency of WebHDFS requests and transfers.' % name, '# TYPE %s histogram' % name]
+        for (kind, op), h in histograms:
+            labels = 'kind="%s",op="%s"' % (kind, op)
+            seen = 0
+            for bound, count in zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts):
+                seen += count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, seen))
+            lines.append('%s_sum{%s} %s' % (name, labels, repr(h.sum)))
+            lines.append('%s_count{%s} %s' % (name, labels, h.count))
+        name = METRIC_PREFIX + '_phase_seconds_total'
+        lines += ['# HELP %s Time spent in each transfer phase.' % name, '# TYPE %s counter' % name]
+        lines += ['%s{phase="%s"} %s' % (name, phase, repr(seconds)) for phase, seconds in phases]
+        for counter, value in counters:
+            name = '%s_%s_total' % (METRIC_PREFIX, re.sub(r'[^a-zA-Z0-9_]', '_', counter))
+            lines += ['# TYPE %s counter' % name, '%s %s' % (name, value)]
+        for gauge, value in gauges:
+            name = '%s_%s' % (METRIC_PREFIX, re.sub(r'[^a-zA-Z0-9_]', '_', gauge))
+            lines += ['# TYPE %s gauge' % name, '%s %s' % (name, value)]
+        name = METRIC_PREFIX + '_last_run_timestamp_seconds'
+        lines += ['# TYPE %s gauge' % name, '%s %s' % (name, int(time.time()))]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """先写临时文件再改名, 避免采集到写了一半的文件"""
+        tmp_file = '%s.%s.tmp' % (filename, os.getpid())
+        try:
+            with open(tmp_file, 'w') as fh:
+                fh.write(self.format_prometheus())
+            os.rename(tmp_file, filename)
+            return True
+        except (IOError, OSError), e:
+            log.warning("Failed to write stats file %s: %s" % (filename, e))
+            return False
+
+
+class StatsSession(requests.Session):
+    """
+    记录每个http请求延迟的requests session: 带op参数的是NameNode请求, 重定向后的是DataNode请求;
+    stats为None时直接调用父类, 可以始终使用
+    """
+    stats = None
+
+    def request(self, method, url, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            return requests.Session.request(self, method, url, *args, **kwargs)
+        params = kwargs.get('params')
+        if isinstance(params, dict) and 'op' in params:
+            kind, op = 'namenode', params['op']
+        else:
+            match = re.search(r'[?&]op=(\w+)', url)
+            kind, op = 'datanode', match.group(1) if match else method.upper()
+        start = time.time()
+        try:
+            response = requests.Session.request(self, method, url, *args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            stats.incr('%s_failures' % kind)
+            raise
+        finally:
+            stats.observe(kind, op, time.time() - start)
+        # pyhdfs会对standby或启动中的NameNode重试其他节点
+        if kind == 'namenode' and response.status_code == 403 and any(s in response.text for s in RETRY_STATUS):
+            stats.incr('namenode_retries')
+        return response
+
+
+class TimedReader:
+    """包装上传数据源, 统计读取源数据的耗时与字节数"""
+    def __init__(self, source, stats):
+        if isinstance(source, str):
+            source = StringIO.StringIO(source)
+        self.source = source
+        self.stats = stats
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self.source.read(size)
+        self.stats.add_time('read_source', time.time() - start)
+        self.stats.incr('bytes_sent', len(data))
+        return data
+
+
+def timed(op):
+    """统计HDFS方法整体耗时的装饰器, 实例的stats为None时不计时"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            stats = self.stats
+            if stats is None:
+                return func(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                stats.observe('transfer', op, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def print_stats(stats, output=None):
+    output = output or sys.stderr
+    output.write(stats.format_text() + '\n')
+    output.flush()
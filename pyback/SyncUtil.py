@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+INDEX_DIR = '/export/servers/pyback/sync'
+# 记录已同步部分开头与末尾各SAMPLE_SIZE字节的哈希, 追加前用来确认文件只在末尾增长
+SAMPLE_SIZE = 64*1024
+TMP_SUFFIX = '.pyback-sync-tmp'
+
+# 同步动作: 跳过、新文件上传、修改过的文件重新上传后替换、只追加新增的末尾部分
+SKIP = 'skip'
+PUT = 'put'
+REPLACE = 'replace'
+APPEND = 'append'
+
+log = logging.getLogger(__name__)
+
+
+def get_index_file(index_dir, source_dir, dest_dir):
+    """按本地目录与hdfs目录区分的索引文件, 同一个本地目录同步到不同位置时互不影响"""
+    digest = hashlib.md5('%s\0%s' % (os.path.abspath(source_dir), dest_dir)).hexdigest()
+    return os.path.join(index_dir or INDEX_DIR, digest + '.json')
+
+
+def sample_hash(local_file, size):
+    """文件前size字节中开头与末尾各SAMPLE_SIZE字节的哈希, 文件短于size时返回None"""
+    head_size = min(SAMPLE_SIZE, size)
+    tail_start = max(head_size, size - SAMPLE_SIZE)
+    with open(local_file, 'rb') as fh:
+        head = fh.read(head_size)
+        fh.seek(tail_start)
+        tail = fh.read(size - tail_start)
+    if len(head) != head_size or len(tail) != size - tail_start:
+        return None
+    return hashlib.md5(head + tail).hexdigest()
+
+
+def plan(entry, size, mtime, file_status):
+    """
+    根据索引记录[大小, mtime, 抽样哈希]、本地文件的大小与mtime和list得到的hdfs文件状态决定同步动作, 只比较元数据;
+    返回(动作, 开始上传的偏移); 没有索引记录时, hdfs上大小相同且不早于本地mtime的文件视为已同步
+    """
+    if file_status is None or file_status.type.upper() != 'FILE':
+        return PUT, 0
+    if entry is None:
+        if file_status.length == size and file_status.modificationTime // 1000 >= mtime:
+            return SKIP, size
+        return REPLACE, 0
+    synced_size, synced_mtime, synced_hash = entry
+    if file_status.length != synced_size:
+        return REPLACE, 0
+    if size == synced_size and mtime == synced_mtime:
+        return SKIP, size
+    if size > synced_size and synced_hash:
+        return APPEND, synced_size
+    return REPLACE, 0
+
+
+class SyncIndex:
+    """
+    记录上次同步时各文件的大小、mtime与已同步部分的抽样哈希, 以json格式保存在本地;
+    记录的本地目录或hdfs目录与本次同步不同时忽略已有记录, 保存失败只记录日志, 下次同步退回比较hdfs的文件状态
+    """
+    def __init__(self, index_file, source_dir, dest_dir):
+        self.index_file = index_file
+        self.source_dir = os.path.abspath(source_dir)
+        self.dest_dir = dest_dir
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as fh:
+                state = json.load(fh)
+        except IOError:
+            return False
+        except ValueError, e:
+            log.warning("Ignore broken sync index %s: %s" % (self.index_file, e))
+            return False
+        if state.get('source_dir') != self.source_dir or state.get('dest_dir') != self.dest_dir:
+            log.warning("Sync index %s is not for %s -> %s, ignore it" % (self.index_file, self.source_dir,
+                                                                        self.dest_dir))
+            return False
+        self.files = state.get('files') or {}
+        return True
+
+    def get(self, rel_path):
+        return self.files.get(rel_path)
+
+    def update(self, rel_path, size, mtime, hash_value=None):
+        with self.lock:
+            self.files[rel_path] = [size, mtime, hash_value]
+
+    def retain(self, rel_paths):
+        """只保留本次同步时仍存在的文件"""
+        with self.lock:
+            self.files = dict((p, e) for p, e in self.files.items() if p in rel_paths)
+
+    def save(self):
+        """先写临时文件再rename, 保证索引文件完整"""
+        with self.lock:
+            state = {'source_dir': self.source_dir, 'dest_dir': self.dest_dir, 'files': self.files}
+            tmp_file = self.index_file + '.tmp'
+            try:
+                index_dir = os.path.dirname(self.index_file)
+                if index_dir and not os.path.isdir(index_dir):
+                    os.makedirs(index_dir)
+                with open(tmp_file, 'w') as fh:
+                    json.dump(state, fh)
+                os.rename(tmp_file, self.index_file)
+                return True
+            except (IOError, OSError), e:
+                log.warning("Failed to save sync index %s: %s" % (self.index_file, e))
+                return False
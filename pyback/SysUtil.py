@@ -7,6 +7,8 @@ import logging
 import sys
 import os
 import multiprocessing
+import threading
+import Queue
 import datetime
 import re
 import traceback
@@ -131,6 +133,15 @@ def add_unit(value, value_type='decimal'):
     return res_value
 
 
+def parse_unit(value):
+    """把带单位的大小转为字节数, 如10M, 512k, 1.5G, 单位按1024计算, 无法解析时抛出ValueError"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGTP]?)B?\s*$', str(value), re.I)
+    if not match:
+        raise ValueError("Invalid size: %s" % value)
+    unit = ['', 'K', 'M', 'G', 'T', 'P'].index(match.group(2).upper())
+    return int(float(match.group(1)) * 1024 ** unit)
+
+
 def tv_interval(start_time, end_time=None):
     if not end_time:
         end_time = datetime.datetime.now()
@@ -158,6 +169,55 @@ def start_child_process(func, args):
     return process
 
 
+def run_in_threads(func, items, workers, stop_on_failure=False):
+    """用有限数量的线程并发执行func, 按items顺序返回结果, 抛出的异常作为结果返回"""
+    items = list(items)
+    results = [None] * len(items)
+    tasks = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+    failed = threading.Event()
+
+    def worker():
+        while not failed.is_set():
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception, e:
+                results[index] = e
+            if stop_on_failure and (results[index] is False or isinstance(results[index], Exception)):
+                failed.set()
+
+    threads = []
+    for i in range(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # join带超时, 保证主线程能响应Ctrl-C
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    return results
+
+
+def pwrite(fd, data, offset):
+    """在文件指定位置写入全部数据, 没有os.pwrite时fd不能与其他线程共享"""
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        if hasattr(os, 'pwrite'):
+            written += os.pwrite(fd, view[written:], offset + written)
+        else:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            written += os.write(fd, view[written:])
+    return written
+
+
 def croak(msg=None):
     if msg:
         print msg
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+import Queue
+
+# 命令行-P auto对应的并行度
+AUTO = 0
+MIN_READ_SIZE = 64*1024
+MAX_PARALLEL = 8
+# 单次读取的目标耗时, 读取大小的上限为单流吞吐下这段时间的数据量
+READ_INTERVAL = 0.1
+# 估算吞吐与延迟的指数平滑系数
+SMOOTHING = 0.3
+# 自动并行从START_WORKERS个线程开始, 每RAMP_INTERVAL秒比较一次总吞吐, 提升超过RAMP_GAIN才继续增加
+START_WORKERS = 2
+RAMP_INTERVAL = 2
+RAMP_GAIN = 1.1
+
+log = logging.getLogger(__name__)
+
+
+class Tuner:
+    """
+    根据实测的单流吞吐与首字节延迟调整读取大小, 由fork出的并行实例共享;
+    每个传输流的读取大小从min_read_size开始逐次翻倍, 首字节尽快写出, 上限为单流吞吐下READ_INTERVAL秒的数据量,
+    且不超过max_read_size(缓冲区大小); adaptive为False时始终使用max_read_size
+    """
+    def __init__(self, max_read_size, min_read_size=MIN_READ_SIZE, max_parallel=MAX_PARALLEL, adaptive=True):
+        self.max_read_size = max_read_size
+        self.min_read_size = min(min_read_size, max_read_size)
+        self.max_parallel = max_parallel
+        self.adaptive = adaptive
+        self.lock = threading.Lock()
+        self.stream_rate = None
+        self.latency = None
+        self.parallel = None
+
+    def observe_read(self, size, seconds):
+        """记录一次网络读取, 只统计足够大的读取, 避免小读取的计时误差"""
+        if size < self.min_read_size or seconds <= 0:
+            return
+        with self.lock:
+            self.stream_rate = self.__smooth(self.stream_rate, size / seconds)
+
+    def observe_latency(self, seconds):
+        """记录一次打开文件到可以读取数据的耗时, 包括NameNode重定向与DataNode响应"""
+        with self.lock:
+            self.latency = self.__smooth(self.latency, seconds)
+
+    def get_read_limit(self):
+        if not self.adaptive or self.stream_rate is None:
+            return self.max_read_size
+        limit = int(self.stream_rate * READ_INTERVAL) // MIN_READ_SIZE * MIN_READ_SIZE
+        return max(self.min_read_size, min(self.max_read_size, limit))
+
+    def new_sizer(self):
+        return ReadSizer(self)
+
+    def get_report(self):
+        """当前选择的参数与实测值"""
+        return {
+            'adaptive': self.adaptive,
+            'read_size': self.get_read_limit(),
+            'max_read_size': self.max_read_size,
+            'stream_rate': int(self.stream_rate or 0),
+            'latency_ms': round((self.latency or 0) * 1000, 1),
+            'parallel': self.parallel,
+            'max_parallel': self.max_parallel,
+        }
+
+    def __smooth(self, old, value):
+        return value if old is None else old + SMOOTHING * (value - old)
+
+
+class ReadSizer:
+    """一个传输流的读取大小, 从最小值开始每次翻倍, 直到Tuner给出的上限"""
+    def __init__(self, tuner):
+        self.tuner = tuner
+        self.size = tuner.min_read_size if tuner.adaptive else tuner.max_read_size
+
+    def next(self, remain):
+        size = min(self.size, remain)
+        self.size = min(self.size * 2, self.tuner.get_read_limit())
+        return size
+
+
+def run_adaptive(func, items, get_transferred, max_workers=MAX_PARALLEL, stop_on_failure=False):
+    """
+    与SysUtil.run_in_threads相同, 按items顺序返回结果, 线程数自动调整:
+    从START_WORKERS个开始, 每RAMP_INTERVAL秒用get_transferred()返回的累计字节数计算总吞吐,
+    比上一次提升超过RAMP_GAIN时增加一个线程, 否则保持当前线程数; 返回(结果列表, 最终线程数)
+    """
+    items = list(items)
+    results = [None] * len(items)
+    tasks = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+    failed = threading.Event()
+
+    def worker():
+        while not failed.is_set():
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception, e:
+                results[index] = e
+            if stop_on_failure and (results[index] is False or isinstance(results[index], Exception)):
+                failed.set()
+
+    threads = []
+
+    def add_worker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for i in range(max(1, min(START_WORKERS, max_workers, len(items)))):
+        add_worker()
+    ramping = True
+    last_rate = None
+    last_time, last_bytes = time.time(), get_transferred()
+    while any(thread.is_alive() for thread in threads):
+        # join带超时, 保证主线程能响应Ctrl-C
+        for thread in threads:
+            thread.join(0.2)
+        now = time.time()
+        if not ramping or now - last_time < RAMP_INTERVAL:
+            continue
+        transferred = get_transferred()
+        rate = (transferred - last_bytes) / (now - last_time)
+        last_time, last_bytes = now, transferred
+        if last_rate is not None and rate < last_rate * RAMP_GAIN:
+            ramping = False
+            log.debug("Throughput %d B/s did not improve, keep %s workers" % (rate, len(threads)))
+            continue
+        last_rate = rate
+        if len(threads) < max_workers and not tasks.empty():
+            add_worker()
+            log.debug("Throughput %d B/s, increase workers to %s" % (rate, len(threads)))
+
+    return results, len(threads)
@@ -32,6 +32,22 @@ setup(
     platforms='linux',
     py_modules=[
         'pyback.HdfsUtil',
+        'pyback.CacheUtil',
+        'pyback.JournalUtil',
+        'pyback.CompressUtil',
+        'pyback.ChecksumUtil',
+        'pyback.DedupUtil',
+        'pyback.RateUtil',
+        'pyback.ProgressUtil',
+        'pyback.StatsUtil',
+        'pyback.AsyncUtil',
+        'pyback.HaUtil',
+        'pyback.BufferUtil',
+        'pyback.TuneUtil',
+        'pyback.AgentUtil',
+        'pyback.SyncUtil',
+        'pyback.ReaderUtil',
+        'pyback.CatalogUtil',
         'pyback.SysUtil',
         'pyback.PyBack'
     ],